@@ -1,39 +1,69 @@
-from flask import Flask, render_template, request, abort
+from flask import Flask, render_template, request, abort, g
 import os
-import slack
-from urllib import request as req
-import random
-import xmltodict
-import urllib.parse
-import requests
+import importlib
+import time
+import threading
+from concurrent.futures import ThreadPoolExecutor
 import json
-import urllib.request
 # import util_refa レファ協だけでなくなったので、機能をmessage.pyに移動.
 import message as message_manager
+import jobs
+import kintone_log
+import http_client
+import text_utils
+import metrics
+import applog
+import singleflight
+import breaker
 
 
 app = Flask(__name__)
 
-client = slack.WebClient(token=os.environ['SLACK_API_TOKEN'])
-root_url = "https://crd.ndl.go.jp/api/refsearch"
+# 起動を速くするため、linebot の読み込みとクライアントの作成は最初に使うときまで遅らせる
+# '1' のときは起動時にすべて済ませる (gunicorn --preload でワーカー間で共有したいとき)
+EAGER_START = os.environ.get('REHATCH_EAGER_START', '0') == '1'
+
+_clients = {}
+_clients_lock = threading.Lock()
+
+def _get_client(name, factory):
+  '''
+  クライアントを返す (初回に factory() で作成)
+  '''
+  client = _clients.get(name)
+  if client is None:
+    with _clients_lock:
+      client = _clients.get(name)
+      if client is None:
+        client = factory()
+        _clients[name] = client
+  return client
 
 ##### LINE bot SETTING(START)
-from linebot import (
-    LineBotApi, WebhookParser
-)
-from linebot.exceptions import (
-    InvalidSignatureError
-)
-from linebot.models import (
-    MessageEvent, TextMessage, TextSendMessage,
-)
-
-line_channel_access_token = os.environ["LINE_CHANNEL_ACCESS_TOKEN"]
-line_channel_secret = os.environ["LINE_CHANNEL_SECRET"]
-
-line_bot_api = LineBotApi(line_channel_access_token)
-# handler = WebhookHandler(LINE_CHANNEL_SECRET)
-parser = WebhookParser(line_channel_secret)
+def get_line_bot_api():
+  def factory():
+    from linebot import LineBotApi
+    return LineBotApi(
+      os.environ["LINE_CHANNEL_ACCESS_TOKEN"],
+      endpoint=http_client.upstream('https://api.line.me'),
+      data_endpoint=http_client.upstream('https://api-data.line.me'))
+  return _get_client('line_bot_api', factory)
+
+def get_parser():
+  def factory():
+    from linebot import WebhookParser
+    # handler = WebhookHandler(LINE_CHANNEL_SECRET)
+    return WebhookParser(os.environ["LINE_CHANNEL_SECRET"])
+  return _get_client('parser', factory)
+
+# '1' のとき、webhookはイベントをキューに積んですぐに応答し、返信は裏のワーカーで送る
+LINE_ASYNC = os.environ.get('REHATCH_LINE_ASYNC', '0') == '1'
+line_jobs = jobs.JobQueue(name='line')
+
+# 1回のwebhookに含まれる複数のイベントを同時に処理する数
+LINE_EVENT_CONCURRENCY = int(os.environ.get('REHATCH_LINE_EVENT_CONCURRENCY', '4'))
+line_event_executor = ThreadPoolExecutor(
+  max_workers=LINE_EVENT_CONCURRENCY, thread_name_prefix='line-event')
 
 ##### LINE bot SETTING(END)
 
@@ -108,39 +138,31 @@ parser = WebhookParser(line_channel_secret)
 #     return reps,link
 
 
-# def send_to_slack(send_text,channel_name= "#botデバッグ用"):
-#   response = client.chat_postMessage(channel=channel_name, text=send_text,icon_emoji = ":rehatch_1:",username="れはっち" )
-
-
 def record_log_to_kintone( source, send_text, sender ):
-  
-  url = os.environ['KINTONE_URL']
-  headers = {
-    "X-Cybozu-API-Token": os.environ['CYBOZU_LOG_DB_API_TOKEN'],
-    "Content-type": "application/json",
-  }
-  data = {
-    "app": os.environ['CYBOZU_LOG_DB_APP_ID'],
-    "record": {
-      "type": {
-        "value": source
-      },
-      "questioner": {
-        "value": sender
-        },
-      "log": {
-        "value": send_text
-      },
-    }
-  }
-  req = urllib.request.Request(url, json.dumps(data).encode(), headers)
-  with urllib.request.urlopen(req) as res:
-    body = res.read()
-    # print("body=\n" + body.hex())
+  # ためておいて裏でまとめて送る (kintone_log.py)
+  with metrics.span('kintone.log'):
+    kintone_log.log(source, send_text, sender)
   
   
   
   
+@app.before_request
+def start_request_timer():
+  g.request_started = time.monotonic()
+  # ログの request_id (Heroku のルータがつける X-Request-ID があればそれを使う)
+  applog.start_request(request.headers.get('X-Request-ID'))
+
+@app.after_request
+def record_request_metrics(response):
+  # エンドポイントごとの応答時間とステータス (/metrics で見る)
+  started = g.get('request_started')
+  endpoint = request.endpoint or 'unknown'
+  if started is not None:
+    metrics.observe('rehatch_request_seconds', time.monotonic() - started, endpoint=endpoint)
+  metrics.inc('rehatch_requests_total', endpoint=endpoint, status=response.status_code)
+  response.headers['X-Request-ID'] = applog.request_id()
+  return response
+
 @app.route('/')
 def hello():
 
@@ -156,9 +178,6 @@ def recieve_get():
   # reps,link_url = make_response(url,query)
   # for r in reps:
   #   print('> {}'.format(r))
-  # if link_url:
-  #   send_to_slack(link_url)
-  #   reps += ['スラックに送ったよ！']
 
   # reqs = util_refa.get_response(query)
   reqs = message_manager.get_response(query)
@@ -168,11 +187,11 @@ def recieve_get():
   for r in reqs:
     if "v" in r:
       sent = r["v"]
-      print('> {}'.format(sent))
       message.append(sent)
     elif "vl" in r:
       link = r["vl"]
       links.append(link)
+  applog.payload('robohon', 'reply', query=query, message=message, links=links)
     
   ####### push to LINE(START) #########
   # https://developers.line.biz/en/reference/messaging-api/#send-push-message
@@ -180,10 +199,12 @@ def recieve_get():
   
   push_message = "{}\n{}".format(message[-1],links[-1])
   
-  line_bot_api.push_message(
-    os.environ['LINE_PUSH_DESTINATION'],
-    TextSendMessage( text=push_message )
-  )
+  from linebot.models import TextSendMessage
+  with metrics.span('line.push'):
+    get_line_bot_api().push_message(
+      os.environ['LINE_PUSH_DESTINATION'],
+      TextSendMessage( text=push_message )
+    )
   
   ####### push to LINE(END) ###########
   
@@ -191,39 +212,83 @@ def recieve_get():
 
   return ''.join(message[:-1])
 
-#for Slack
-# @app.route('/api/command/reference_talk/from_slack', methods=['POST'])
-# def recieve_post_slack():
-#   query = request.form['text']
-#   send_user = request.form['user_name']
-
-#   print(request.form)
-#   print('query: {}'.format(query))
+######## LINE bot (START) ########
+# https://github.com/line/line-bot-sdk-python/tree/master/examples/flask-echo
 
-#   url = make_url(query)
-#   reps,link_url = make_response(url,query)
-#   for r in reps:
-#     print('> {}'.format(r))
+@metrics.timed('line.event')
+def reply_to_event(event):
+  '''
+  LINEのメッセージイベント1件に返信して、ログを記録する
+  '''
+  from linebot.models import TextSendMessage
+  query = event.message.text
+  #url = make_url(query)
+  # reqs = util_refa.get_response(query)
+  reqs = message_manager.get_response(query)
+  #reqs,link_url = make_response(url,query)
   
+  message = []
+  for r in reqs:
+    if "t" in r:
+      sent = r["t"]
+      message.append(sent)
+    elif "tl" in r:
+      sent = r["tl"]
+      message.append(sent)
+
+
+  # if link_url:
+  #   reply_message = ''.join(reps) + "\n" + link_url
+  # else:
+  #   reply_message = ''.join(reps)
   
-#   if link_url:
-#     send_to_slack('{}さんは'.format(send_user) + ''.join(reps))
-#     send_to_slack(link_url)
-#   else:
-#     send_to_slack(''.join(reps))
-    
-#   return ''
+  reply_message = '\n'.join(message)
+  applog.payload('line', 'reply', query=query, message=reply_message)
 
+  with metrics.span('line.reply'):
+    get_line_bot_api().reply_message(
+        event.reply_token,
+        TextSendMessage( text=reply_message )
+      )
+  
+  record_log_to_kintone( "LINE_BOT", event.message.text, event.source.user_id )     #event.source.userIdで無い理由は不明
+  
+  
+  #line_bot_api.reply_message(
+  #  event.reply_token,
+  #  TextSendMessage(text=event.message.text)
+  #)
+  applog.info('line', 'reply_end', sentences=len(message))
+
+def safe_reply_to_event(event):
+  '''
+  reply_to_event の例外をそのイベントだけで止める (ほかのイベントの処理は続ける)
+  '''
+  try:
+    reply_to_event(event)
+  except Exception:
+    applog.error('line', 'reply_failed', exc_info=True, reply_token=event.reply_token)
+
+def reply_to_events(events):
+  '''
+  複数のイベントに同時に返信する (最大 LINE_EVENT_CONCURRENCY 件ずつ)
+  すべて終わるまで待つ
+  '''
+  if len(events) == 1:
+    safe_reply_to_event(events[0])
+    return
+  for _ in line_event_executor.map(applog.bind(safe_reply_to_event), events):
+    pass
 
-######## LINE bot (START) ########
-# https://github.com/line/line-bot-sdk-python/tree/master/examples/flask-echo
 
 @app.route("/line_callback", methods=['POST'])
 def callback():
+  from linebot.exceptions import InvalidSignatureError
+  from linebot.models import MessageEvent, TextMessage
   # get X-Line-Signature header value
   signature = request.headers['X-Line-Signature']
   
-  print( "start line callback" )
+  applog.debug('line', 'callback_start')
 
   # get request body as text
   body = request.get_data(as_text=True)
@@ -231,12 +296,14 @@ def callback():
 
   # parse webhook body
   try:
-    print("Request body: " + body)
-    events = parser.parse(body, signature)
+    applog.payload('line', 'webhook_body', body=body)
+    events = get_parser().parse(body, signature)
   except InvalidSignatureError:
+    applog.warning('line', 'invalid_signature')
     abort(400)
 
   # if event is MessageEvent and message is TextMessage, then get text
+  targets = []
   for event in events:
     if not isinstance(event, MessageEvent):
       continue
@@ -244,54 +311,54 @@ def callback():
       continue
 
     if event.reply_token == "00000000000000000000000000000000" or event.reply_token == "ffffffffffffffffffffffffffffffff":
-      print( " from system message. so do not to do.\n ")
-      return 'OK'
-    
-    #reply LINE bot
-    query = event.message.text
-    #url = make_url(query)
-    # reqs = util_refa.get_response(query)
-    reqs = message_manager.get_response(query)
-    #reqs,link_url = make_response(url,query)
-    
-    message = []
-    for r in reqs:
-      if "t" in r:
-        sent = r["t"]
-        print('> {}'.format(sent))
-        message.append(sent)
-      elif "tl" in r:
-        sent = r["tl"]
-        print('> {}'.format(sent))
-        message.append(sent)
-
-  
-    # if link_url:
-    #   reply_message = ''.join(reps) + "\n" + link_url
-    # else:
-    #   reply_message = ''.join(reps)
+      applog.debug('line', 'system_message')
+      continue
     
-    reply_message = '\n'.join(message)
+    if LINE_ASYNC and line_jobs.submit(applog.bind(reply_to_event), event):
+      continue
+    # 非同期モードでないとき (またはキューがいっぱいのとき) はその場で返信
+    targets += [event]
 
-    line_bot_api.reply_message(
-        event.reply_token,
-        TextSendMessage( text=reply_message )
-      )
-    
-    record_log_to_kintone( "LINE_BOT", event.message.text, event.source.user_id )     #event.source.userIdで無い理由は不明
-    
-    
-    #line_bot_api.reply_message(
-    #  event.reply_token,
-    #  TextSendMessage(text=event.message.text)
-    #)
-    print("line reply end.")
+  applog.info('line', 'callback', events=len(events), replies=len(targets))
+  if len(targets) > 0:
+    reply_to_events(targets)
 
   return 'OK'
+
+@app.route("/line_callback/stats", methods=['GET'])
+def line_callback_stats():
+  stats = {
+    'jobs': line_jobs.stats(),
+    'kintone_log': kintone_log.logger.stats(),
+    'fix_text': text_utils.fix_text_stats(),
+    'log': applog.stats(),
+    'singleflight': singleflight.stats(),
+    'breakers': breaker.stats(),
+    'cache': message_manager.cache_stats(),
+  }
+  return app.response_class(json.dumps(stats), mimetype='application/json')
+
+@app.route("/metrics", methods=['GET'])
+def prometheus_metrics():
+  # 処理段階・外部API・エンドポイントごとのレイテンシ (全ワーカーの合計)
+  return app.response_class(metrics.collect(), mimetype='text/plain; version=0.0.4')
   
 
 ######## LINE bot (END) ########
 
 
+def warm_up():
+  '''
+  最初のリクエストで行う読み込みとクライアントの作成を、いま済ませる
+  '''
+  for name in ('linebot.models', 'linebot.exceptions', 'ftfy', 'xmltodict'):
+    importlib.import_module(name)
+  get_line_bot_api()
+  get_parser()
+  http_client.get_session()
+
+if EAGER_START:
+  warm_up()
+
 if __name__ == '__main__':
   app.run(host='0.0.0.0', port=5000, debug=True)
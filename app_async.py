@@ -0,0 +1,238 @@
+'''
+非同期のサーバ (aiohttp)
+app.py の /line_callback と /api/command/reference_talk をコルーチンで処理する
+レファ協・wikipedia・LINE・kintone を待っている間もほかの会話を処理できるので、
+1プロセスで数百件の会話を同時に扱える (app.py は1件ごとにワーカーのスレッドを1つ使う)
+
+使い方 (Procfile の web を置き換える):
+  gunicorn app_async:app --worker-class aiohttp.GunicornWebWorker -b 0.0.0.0:$PORT
+
+  python app_async.py --port 5000   # 手元で動かす
+
+環境変数は app.py と同じ. ほかに:
+  REHATCH_LINE_ASYNC: '1' のとき、webhookはすぐに応答して返信は裏のタスクで送る
+  REHATCH_ASYNC_MAX_CONVERSATIONS: 同時に処理する会話の数の上限 (default: 256)
+'''
+
+import argparse
+import asyncio
+import os
+import time
+
+from aiohttp import web
+from linebot import AsyncLineBotApi, WebhookParser
+from linebot.aiohttp_async_http_client import AiohttpAsyncHttpClient
+from linebot.exceptions import InvalidSignatureError
+from linebot.models import MessageEvent, TextMessage, TextSendMessage
+
+import message as message_manager
+import kintone_log
+import http_client
+import http_client_async
+import text_utils
+import metrics
+import applog
+import singleflight
+import breaker
+
+LINE_ASYNC = os.environ.get('REHATCH_LINE_ASYNC', '0') == '1'
+MAX_CONVERSATIONS = int(os.environ.get('REHATCH_ASYNC_MAX_CONVERSATIONS', '256'))
+
+# LINE からのシステムメッセージの reply_token
+SYSTEM_REPLY_TOKENS = ("00000000000000000000000000000000", "ffffffffffffffffffffffffffffffff")
+
+parser = WebhookParser(os.environ["LINE_CHANNEL_SECRET"])
+
+# アプリの状態
+LINE_BOT_API = web.AppKey('line_bot_api', AsyncLineBotApi)
+CONVERSATIONS = web.AppKey('conversations', asyncio.Semaphore)
+TASKS = web.AppKey('tasks', set)
+STATS = web.AppKey('stats', dict)
+
+def make_line_bot_api():
+  '''
+  LINE Messaging API の非同期クライアント (イベントループの中で作る)
+  '''
+  return AsyncLineBotApi(
+    os.environ["LINE_CHANNEL_ACCESS_TOKEN"],
+    AiohttpAsyncHttpClient(http_client_async.get_session()),
+    endpoint=http_client.upstream('https://api.line.me'),
+    data_endpoint=http_client.upstream('https://api-data.line.me'))
+
+def line_text(reqs):
+  '''
+  get_response の出力から LINE の返信文を作る (app.reply_to_event と同じ)
+  '''
+  return '\n'.join(r["t"] if "t" in r else r["tl"] for r in reqs if "t" in r or "tl" in r)
+
+def robohon_text(reqs):
+  '''
+  get_response の出力から RoBoHon の発話と LINE に送る文を作る (app.recieve_get と同じ)
+  output: (発話, LINEに送る文)
+  '''
+  message = [r["v"] for r in reqs if "v" in r]
+  links = [r["vl"] for r in reqs if "v" not in r and "vl" in r]
+  return ''.join(message[:-1]), "{}\n{}".format(message[-1], links[-1])
+
+async def record_log_to_kintone(source, send_text, sender):
+  with metrics.span('kintone.log'):
+    await kintone_log.log_async(source, send_text, sender)
+
+@metrics.timed('line.event')
+async def reply_to_event(app, event):
+  '''
+  LINEのメッセージイベント1件に返信して、ログを記録する
+  '''
+  async with app[CONVERSATIONS]:
+    app[STATS]['in_flight'] += 1
+    try:
+      query = event.message.text
+      reqs = await message_manager.get_response_async(query)
+      reply_message = line_text(reqs)
+      applog.payload('line', 'reply', query=query, message=reply_message)
+
+      with metrics.span('line.reply'):
+        await app[LINE_BOT_API].reply_message(
+          event.reply_token,
+          TextSendMessage( text=reply_message )
+        )
+
+      await record_log_to_kintone( "LINE_BOT", event.message.text, event.source.user_id )
+    finally:
+      app[STATS]['in_flight'] -= 1
+  applog.info('line', 'reply_end')
+
+async def safe_reply_to_event(app, event):
+  '''
+  reply_to_event の例外をそのイベントだけで止める (ほかのイベントの処理は続ける)
+  '''
+  try:
+    await reply_to_event(app, event)
+  except Exception:
+    applog.error('line', 'reply_failed', exc_info=True, reply_token=event.reply_token)
+
+def run_in_background(app, coro):
+  '''
+  応答を返したあとも続けるタスク (終了時に待つ)
+  '''
+  task = asyncio.get_running_loop().create_task(coro)
+  app[TASKS].add(task)
+  task.add_done_callback(app[TASKS].discard)
+
+async def hello(request):
+  return web.Response(text="hello")
+
+async def recieve_get(request):
+  '''
+  RoBoHon から (app.recieve_get と同じ)
+  '''
+  query = request.query.get('content')
+  reqs = await message_manager.get_response_async(query)
+  voice, push_message = robohon_text(reqs)
+  applog.payload('robohon', 'reply', query=query, voice=voice, push=push_message)
+
+  with metrics.span('line.push'):
+    await request.app[LINE_BOT_API].push_message(
+      os.environ['LINE_PUSH_DESTINATION'],
+      TextSendMessage( text=push_message )
+    )
+
+  await record_log_to_kintone( "RoBoHon", query, "UNKNOWN" )
+  return web.Response(text=voice)
+
+async def callback(request):
+  '''
+  LINE の webhook (app.callback と同じ)
+  '''
+  signature = request.headers.get('X-Line-Signature', '')
+  body = await request.text()
+
+  try:
+    applog.payload('line', 'webhook_body', body=body)
+    events = parser.parse(body, signature)
+  except InvalidSignatureError:
+    applog.warning('line', 'invalid_signature')
+    raise web.HTTPBadRequest()
+
+  targets = [event for event in events
+             if isinstance(event, MessageEvent) and isinstance(event.message, TextMessage)
+             and event.reply_token not in SYSTEM_REPLY_TOKENS]
+  applog.info('line', 'callback', events=len(events), replies=len(targets))
+
+  if LINE_ASYNC:
+    for event in targets:
+      run_in_background(request.app, safe_reply_to_event(request.app, event))
+  else:
+    await asyncio.gather(*[safe_reply_to_event(request.app, event) for event in targets])
+  return web.Response(text='OK')
+
+async def line_callback_stats(request):
+  stats = {
+    'in_flight': request.app[STATS]['in_flight'],
+    'background_tasks': len(request.app[TASKS]),
+    'kintone_log': kintone_log.logger.stats(),
+    'fix_text': text_utils.fix_text_stats(),
+    'log': applog.stats(),
+    'singleflight': singleflight.stats(),
+    'breakers': breaker.stats(),
+    'cache': message_manager.cache_stats(),
+  }
+  return web.json_response(stats)
+
+async def prometheus_metrics(request):
+  return web.Response(text=metrics.collect(), content_type='text/plain', charset='utf-8')
+
+@web.middleware
+async def request_middleware(request, handler):
+  '''
+  ログの request_id と、エンドポイントごとの応答時間・ステータス (app.py の before/after_request と同じ)
+  '''
+  started = time.monotonic()
+  applog.start_request(request.headers.get('X-Request-ID'))
+  route = request.match_info.route
+  endpoint = getattr(route.handler, '__name__', None) if route.resource is not None else None
+  endpoint = endpoint or 'unknown'
+  status = 500
+  try:
+    response = await handler(request)
+    status = response.status
+  except web.HTTPException as e:
+    status = e.status
+    raise
+  finally:
+    metrics.observe('rehatch_request_seconds', time.monotonic() - started, endpoint=endpoint)
+    metrics.inc('rehatch_requests_total', endpoint=endpoint, status=status)
+  response.headers['X-Request-ID'] = applog.request_id()
+  return response
+
+async def on_startup(app):
+  app[LINE_BOT_API] = make_line_bot_api()
+
+async def on_shutdown(app):
+  # 裏で返信中の会話を待ってから閉じる
+  if len(app[TASKS]) > 0:
+    await asyncio.gather(*app[TASKS], return_exceptions=True)
+  await http_client_async.close()
+
+def make_app():
+  app = web.Application(middlewares=[request_middleware])
+  app[CONVERSATIONS] = asyncio.Semaphore(MAX_CONVERSATIONS)
+  app[STATS] = {'in_flight': 0}
+  app[TASKS] = set()
+  app.router.add_get('/', hello)
+  app.router.add_get('/api/command/reference_talk', recieve_get)
+  app.router.add_post('/line_callback', callback)
+  app.router.add_get('/line_callback/stats', line_callback_stats)
+  app.router.add_get('/metrics', prometheus_metrics)
+  app.on_startup.append(on_startup)
+  app.on_shutdown.append(on_shutdown)
+  return app
+
+app = make_app()
+
+if __name__ == '__main__':
+  argparser = argparse.ArgumentParser(description='非同期のサーバ')
+  argparser.add_argument('--host', default='0.0.0.0')
+  argparser.add_argument('--port', type=int, default=5000)
+  args = argparser.parse_args()
+  web.run_app(app, host=args.host, port=args.port)
@@ -0,0 +1,234 @@
+'''
+構造化ログ (1行1件のJSON)
+書き出しは裏のスレッドで行う (QueueHandler → QueueListener → 標準出力)
+リクエストの処理中は print のように待たされない. キューがいっぱいのときは捨てて数える
+
+各レコードには request_id がつく (リクエストの最初に start_request で決める)
+ほかのスレッドで続きを処理するときは bind で包むと、同じ request_id が引き継がれる
+
+webhook の本文や返答文のような大きいログ (payload) は、リクエストごとに抽選して一部だけ出す
+抽選はリクエストの最初に1回だけ行うので、選ばれたリクエストは最初から最後まで追える
+
+使い方:
+  import applog
+  applog.start_request(request.headers.get('X-Request-ID'))
+  applog.info('line', 'callback', events=3)
+  applog.payload('line', 'webhook_body', body=body)
+  applog.error('message', 'fetch_failed', source='wiki', exc_info=True)
+
+環境変数:
+  REHATCH_LOG_LEVEL: 全体のログレベル (既定 INFO)
+  REHATCH_LOG_LEVELS: 種類 (category) ごとのログレベル. 例 'message=DEBUG,payload=WARNING'
+  REHATCH_LOG_SAMPLE: 種類ごとに出すリクエストの割合. 例 'payload=0.05' (既定 payload=0.01)
+  REHATCH_LOG_QUEUE_SIZE: 書き出し待ちの最大件数
+'''
+
+import atexit
+import contextvars
+import functools
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import random
+import sys
+import threading
+import time
+import uuid
+
+def _parse_map(text, convert):
+  '''
+  'a=1,b=2' → {'a': convert('1'), 'b': convert('2')}
+  '''
+  ret = {}
+  for item in text.split(','):
+    if '=' not in item:
+      continue
+    k, v = item.split('=', 1)
+    ret[k.strip()] = convert(v.strip())
+  return ret
+
+def _level(name):
+  '''
+  ログレベルの名前か数字 → 数字. 知らない名前のときは INFO (標準エラーに知らせる)
+  '''
+  if name.isdigit():
+    return int(name)
+  level = logging.getLevelName(name.upper())
+  if not isinstance(level, int):
+    sys.stderr.write('applog: unknown log level {!r}, using INFO\n'.format(name))
+    return logging.INFO
+  return level
+
+LEVEL = _level(os.environ.get('REHATCH_LOG_LEVEL', 'INFO'))
+CATEGORY_LEVELS = _parse_map(os.environ.get('REHATCH_LOG_LEVELS', ''), _level)
+SAMPLE_RATES = dict({'payload': 0.01}, **_parse_map(os.environ.get('REHATCH_LOG_SAMPLE', ''), float))
+QUEUE_SIZE = int(os.environ.get('REHATCH_LOG_QUEUE_SIZE', '10000'))
+
+# payload で出すログの種類
+PAYLOAD = 'payload'
+
+_request_id = contextvars.ContextVar('rehatch_request_id', default=None)
+# リクエストの抽選に使う値 (0〜1). この値が SAMPLE_RATES より小さい種類だけ出す
+_sample_draw = contextvars.ContextVar('rehatch_sample_draw', default=None)
+
+class JsonFormatter(logging.Formatter):
+  '''
+  1行1件のJSONにする
+  '''
+  def format(self, record):
+    data = {
+      'ts': time.strftime('%Y-%m-%dT%H:%M:%S', time.gmtime(record.created)) + '.{:03d}Z'.format(int(record.msecs)),
+      'level': record.levelname,
+      'category': getattr(record, 'category', record.name),
+      'event': record.getMessage(),
+      'request_id': getattr(record, 'request_id', None),
+    }
+    data.update(getattr(record, 'fields', {}))
+    if record.exc_text:
+      data['exc'] = record.exc_text
+    elif record.exc_info:
+      data['exc'] = self.formatException(record.exc_info)
+    return json.dumps(data, ensure_ascii=False, default=str)
+
+_formatter = JsonFormatter()
+
+class DroppingQueueHandler(logging.handlers.QueueHandler):
+  '''
+  キューがいっぱいのときは待たずに捨てる
+  '''
+  def __init__(self, q):
+    super().__init__(q)
+    self.dropped = 0
+
+  def prepare(self, record):
+    # 例外の整形だけここで行う (traceback のフレームを書き出しまで残さないように)
+    if record.exc_info:
+      record.exc_text = _formatter.formatException(record.exc_info)
+      record.exc_info = None
+    return record
+
+  def enqueue(self, record):
+    try:
+      self.queue.put_nowait(record)
+    except queue.Full:
+      self.dropped += 1
+
+_root = logging.getLogger('rehatch')
+_root.propagate = False
+_root.setLevel(logging.DEBUG)
+_handler = None
+_listener = None
+_started_pid = None
+_start_lock = threading.Lock()
+
+def _start():
+  '''
+  書き出し用のスレッドを起動 (fork後のワーカーごとに1つ)
+  '''
+  global _handler, _listener, _started_pid
+  if _started_pid == os.getpid():
+    return
+  with _start_lock:
+    if _started_pid == os.getpid():
+      return
+    stream = logging.StreamHandler(sys.stdout)
+    stream.setFormatter(JsonFormatter())
+    handler = DroppingQueueHandler(queue.Queue(QUEUE_SIZE))
+    listener = logging.handlers.QueueListener(handler.queue, stream)
+    listener.start()
+    if _handler is not None:
+      _root.removeHandler(_handler)
+    _root.addHandler(handler)
+    _handler = handler
+    _listener = listener
+    _started_pid = os.getpid()
+  atexit.register(shutdown)
+
+def shutdown():
+  '''
+  書き出し待ちのログをすべて書き出して、スレッドを止める
+  '''
+  global _listener, _started_pid
+  with _start_lock:
+    listener = _listener
+    _listener = None
+    _started_pid = None
+  if listener is not None:
+    listener.stop()
+
+def level_of(category):
+  return CATEGORY_LEVELS.get(category, LEVEL)
+
+def enabled(category, level=logging.INFO):
+  '''
+  その種類・レベルのログを出すかどうか (重い整形の前に確かめる用)
+  '''
+  if level < level_of(category):
+    return False
+  rate = SAMPLE_RATES.get(category)
+  if rate is None:
+    return True
+  draw = _sample_draw.get()
+  if draw is None:
+    draw = random.random()
+  return draw < rate
+
+def start_request(request_id=None):
+  '''
+  リクエストの始まり. request_id を決めて、payload のログを出すかを抽選する
+  output: request_id
+  '''
+  request_id = request_id or uuid.uuid4().hex
+  _request_id.set(request_id)
+  _sample_draw.set(random.random())
+  return request_id
+
+def request_id():
+  return _request_id.get()
+
+def bind(fn):
+  '''
+  いまの request_id と抽選の結果を引き継いで、ほかのスレッドで fn を呼べるようにする
+  '''
+  context = contextvars.copy_context()
+  @functools.wraps(fn)
+  def wrapper(*args, **kwargs):
+    # 同じ context には同時に入れないので、呼ぶたびにコピーする
+    return context.copy().run(fn, *args, **kwargs)
+  return wrapper
+
+def log(category, level, event, exc_info=False, **fields):
+  if not enabled(category, level):
+    return
+  _start()
+  _root.log(level, event, exc_info=exc_info, extra={
+    'category': category,
+    'request_id': _request_id.get(),
+    'fields': fields,
+  })
+
+def debug(category, event, **fields):
+  log(category, logging.DEBUG, event, **fields)
+
+def info(category, event, **fields):
+  log(category, logging.INFO, event, **fields)
+
+def warning(category, event, **fields):
+  log(category, logging.WARNING, event, **fields)
+
+def error(category, event, exc_info=False, **fields):
+  log(category, logging.ERROR, event, exc_info=exc_info, **fields)
+
+def payload(category, event, **fields):
+  '''
+  大きいログ (webhook の本文、返答文など). 抽選で選ばれたリクエストだけ出す
+  '''
+  log(PAYLOAD, logging.INFO, event, source=category, **fields)
+
+def stats():
+  return {
+    'queued': _handler.queue.qsize() if _handler is not None else 0,
+    'dropped': _handler.dropped if _handler is not None else 0,
+  }
@@ -0,0 +1,211 @@
+'''
+ベンチマーク用のAPIレスポンス (レファ協 refsearch のXML, wikipedia API のXML) を作る
+
+ふつうは同じ乱数の種から、実際のレスポンスと同じ形のデータを作る (何度作っても同じ内容)
+--record を付けると、実際のAPIに問い合わせてレスポンスをそのまま保存する
+
+使い方:
+  python bench/fixtures/make_fixtures.py
+  python bench/fixtures/make_fixtures.py --record crd crd_kyoto 京都
+  python bench/fixtures/make_fixtures.py --record wiki wiki_kyoto 京都 京都市
+'''
+
+import sys
+import argparse
+import gzip
+import os
+import random
+from xml.sax.saxutils import escape, quoteattr
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..'))
+
+FIXTURE_DIR = os.path.dirname(os.path.abspath(__file__))
+
+PLACES = ['京都', '奈良', '平城京', '宇治', '大阪', '堺', '名古屋', '鎌倉', '江戸', '東京',
+          '武蔵国', '金沢', '出雲', '広島', '札幌', '太宰府', '飛鳥', '明日香村', '小樽', '函館',
+          '熊本', '首里', '長崎', '出島', '日光', '高千穂', '箱根', '琵琶湖', '吉野ヶ里', '一乗谷']
+LIBS = ['京都府立図書館', '奈良県立図書情報館', '大阪府立中央図書館', '国立国会図書館',
+        '堺市立中央図書館', '金沢市立玉川図書館', '鎌倉市中央図書館', '札幌市中央図書館']
+PHRASES = [
+  '{p}の地名の由来について知りたい',
+  '{p}に伝わる昔話が載っている資料はあるか',
+  '{p}の古い地図（明治時代のもの）を見たい',
+  '{p}で江戸時代に行われていた祭りについて',
+  '「{p}」という地名はいつから使われているのか',
+  '{p}の人口の移り変わりがわかる統計資料',
+]
+SENTENCES = [
+  '『{p}市史』第2巻（{p}市, 1979）p.120-135に記述あり。',
+  '【資料1】『角川日本地名大辞典 26 {p}』（角川書店, 1982）の「{p}」の項を参照。',
+  '当館所蔵の郷土資料を調査したところ、以下の資料に関連する記述がありました。',
+  '〈参考〉{p}の由来については諸説あり（詳しくは「{p}の歴史」〔{p}教育委員会〕を参照）。',
+  'インターネット上の情報として、https://example.jp/{n}/index.html （最終確認 2020年1月）も参考になります。',
+  '※この回答は調査時点の情報です。',
+  '{p}について［地名辞典］＜国史大辞典＞などを確認しましたが、該当する記述は見つかりませんでした。',
+  '調査の結果、次のことがわかりました？',
+  '{p}は古くから交通の要所として栄え（『{p}の歴史（改訂版（第3版））』による）、多くの記録が残っています。',
+]
+
+def _sentence(rnd, p):
+  return rnd.choice(SENTENCES).format(p=p, n=rnd.randint(1, 99999))
+
+def make_crd_result(rnd, i, answer_sentences):
+  p = rnd.choice(PLACES)
+  question = rnd.choice(PHRASES).format(p=p)
+  answer = '\n'.join(_sentence(rnd, rnd.choice([p, rnd.choice(PLACES)]))
+                     for _ in range(answer_sentences))
+  keywords = [p] + rnd.sample(PLACES, rnd.randint(0, 3))
+  lst = '20{:02d}{:02d}{:02d}'.format(rnd.randint(5, 23), rnd.randint(1, 12), rnd.randint(1, 28))
+  return ''.join([
+    '<result>\n<reference>\n',
+    '<question>{}</question>\n'.format(escape(question)),
+    '<reg-id>R{:08d}</reg-id>\n'.format(i),
+    '<answer>{}</answer>\n'.format(escape(answer)),
+    '<crt-date>{}</crt-date>\n'.format(lst),
+    '<solution>解決</solution>\n',
+    ''.join('<keyword>{}</keyword>\n'.format(escape(k)) for k in keywords),
+    '<class type="NDC" version="9">291</class>\n',
+    '<ans-proc>{}</ans-proc>\n'.format(escape(_sentence(rnd, p))),
+    '<bibl>\n<bibl-desc>{}</bibl-desc>\n</bibl>\n'.format(escape(_sentence(rnd, p))),
+    '<pre-res>{}</pre-res>\n'.format(escape(_sentence(rnd, p))),
+    '<url>https://crd.ndl.go.jp/reference/detail?page=ref_view&amp;id=1000{:06d}</url>\n'.format(i),
+    '<system>\n',
+    '<registration>{}</registration>\n'.format(lst),
+    '<reg-date>{}</reg-date>\n'.format(lst),
+    '<lst-date>{}120000</lst-date>\n'.format(lst),
+    '<sys-id>1000{:06d}</sys-id>\n'.format(i),
+    '<lib-id>{}</lib-id>\n'.format(rnd.randint(1000000, 9999999)),
+    '<lib-name>{}</lib-name>\n'.format(escape(rnd.choice(LIBS))),
+    '</system>\n</reference>\n</result>\n',
+  ])
+
+def make_crd(rnd, n, hit_num, answer_sentences):
+  '''
+  refsearch のレスポンス
+  '''
+  return ''.join([
+    '<?xml version="1.0" encoding="UTF-8"?>\n<result_set>\n',
+    '<hit_num>{}</hit_num>\n'.format(hit_num),
+    '<results_get_position>1</results_get_position>\n',
+    '<results_num>{}</results_num>\n'.format(n),
+    ''.join(make_crd_result(rnd, i, rnd.randint(*answer_sentences)) for i in range(n)),
+    '</result_set>\n',
+  ])
+
+def make_wikitext(rnd, title, paragraphs, not_enough=False):
+  p = rnd.choice(PLACES)
+  head = []
+  if rnd.random() < 0.5:
+    head += ['{{{{Redirect|{}|{}の旧名|{}}}}}'.format(p, title, p)]
+  if not_enough:
+    head += ['{{出典の明記|date=2020年1月}}']
+  head += ['{{Infobox 日本の市\n|画像 = {}.jpg\n|人口 = {}\n|備考 = {{{{lang|en|{}}}}}\n}}}}'.format(
+    title, rnd.randint(1000, 1000000), title)]
+  body = ["'''{}'''（{}）は、[[日本]]の[[{}|{}]]に位置する地域<ref>『{}の歴史』</ref>。".format(
+    title, title, p, p, title)]
+  for i in range(paragraphs):
+    s = []
+    for _ in range(rnd.randint(3, 8)):
+      q = rnd.choice(PLACES)
+      s += [rnd.choice([
+        '[[{}]]の{}にあたる<!-- 要確認 -->。'.format(q, rnd.choice(['北部', '南部', '中心部'])),
+        '{{{{要出典|date=2019年{}月}}}}古くは[[{}国|{}]]に属した。'.format(rnd.randint(1, 12), q, q),
+        '[[ファイル:{}.jpg|thumb|{}の風景]]'.format(q, q),
+        '{}年に[[{}]]と合併した<ref name="a{}">{{{{Cite web|url=https://example.jp/{}|title={}}}}}</ref>。'.format(
+          rnd.randint(1889, 2010), q, i, i, q),
+        "'''{}'''という名は[[古事記]]にも見える。".format(q),
+      ])]
+    body += [''.join(s)]
+    if i % 3 == 2:
+      body += ['== {} ==\n'.format(rnd.choice(['歴史', '地理', '交通', '文化']))]
+  tail = ['[[Category:{}]]'.format(rnd.choice(PLACES)) for _ in range(rnd.randint(2, 6))]
+  return '\n'.join(head) + '\n' + '\n\n'.join(body) + '\n\n' + '\n'.join(tail)
+
+def make_pathological_wikitext(rnd, n):
+  '''
+  以前の正規表現による概要の抽出で時間がかかっていた形 (入れ子のテンプレート, 閉じないリンク)
+  '''
+  s = []
+  for i in range(n):
+    s += ['{{' * rnd.randint(1, 6), 'x|' * rnd.randint(1, 10), '}}' * rnd.randint(0, 6),
+          '[[' * rnd.randint(0, 3), rnd.choice(PLACES), ':' * rnd.randint(0, 1),
+          ']]' * rnd.randint(0, 2), '\n' * rnd.randint(0, 2)]
+  return ''.join(s)
+
+def make_wiki(pages, redirects=()):
+  '''
+  wikipedia API (format=xml, prop=revisions) のレスポンス
+  pages: [(タイトル, 本文 or None (存在しないページ))]
+  '''
+  ret = ['<?xml version="1.0"?><api batchcomplete=""><query>']
+  if len(redirects) > 0:
+    ret += ['<redirects>']
+    ret += ['<r from={} to={} />'.format(quoteattr(a), quoteattr(b)) for a, b in redirects]
+    ret += ['</redirects>']
+  ret += ['<pages>']
+  for i, (title, text) in enumerate(pages):
+    if text is None:
+      ret += ['<page _idx="-{}" ns="0" title={} missing="" />'.format(i + 1, quoteattr(title))]
+      continue
+    ret += [
+      '<page _idx="{0}" pageid="{0}" ns="0" title={1}><revisions>'.format(1000 + i, quoteattr(title)),
+      '<rev contentformat="text/x-wiki" contentmodel="wikitext" xml:space="preserve">',
+      escape(text),
+      '</rev></revisions></page>',
+    ]
+  ret += ['</pages></query></api>']
+  return ''.join(ret)
+
+def generate():
+  '''
+  名前 → レスポンス本文
+  '''
+  rnd = random.Random(20201018)
+  return {
+    'crd_empty': make_crd(rnd, 0, 0, (1, 1)),
+    'crd_single': make_crd(rnd, 1, 1, (2, 4)),
+    'crd_small': make_crd(rnd, 5, 5, (2, 6)),
+    'crd_page200': make_crd(rnd, 200, 4321, (3, 40)),
+    'wiki_small': make_wiki([('京都', make_wikitext(rnd, '京都', 3))]),
+    'wiki_multi': make_wiki(
+      [('京都市', make_wikitext(rnd, '京都市', 8)),
+       ('奈良', make_wikitext(rnd, '奈良', 5, not_enough=True)),
+       ('平城京', make_wikitext(rnd, '平城京', 12)),
+       ('存在しないページ', None)],
+      redirects=[('キョウト', '京都市')]),
+    'wiki_long': make_wiki([('日本の歴史', make_wikitext(rnd, '日本の歴史', 600))]),
+    'wiki_pathological': make_wiki([('病的な記事', make_pathological_wikitext(rnd, 4000))]),
+  }
+
+def save(name, body):
+  path = os.path.join(FIXTURE_DIR, name + '.xml.gz')
+  # mtime=0 で、作り直しても同じバイト列にする
+  with open(path, 'wb') as f:
+    with gzip.GzipFile(filename='', mode='wb', fileobj=f, mtime=0) as gz:
+      gz.write(body.encode('utf-8'))
+  return path
+
+def record(source, name, keywords):
+  '''
+  実際のAPIのレスポンスを保存
+  '''
+  import http_client
+  if source == 'crd':
+    import refkyo
+    url = refkyo.make_url(keywords)
+  else:
+    import wikipedia
+    url = wikipedia.make_url(keywords)
+  return save(name, http_client.get(url).text)
+
+if __name__ == '__main__':
+  argparser = argparse.ArgumentParser(description='ベンチマーク用のAPIレスポンスを作る')
+  argparser.add_argument('--record', nargs='+', metavar='ARG',
+                         help='crd|wiki 名前 キーワード...: 実際のAPIのレスポンスを保存')
+  args = argparser.parse_args()
+
+  if args.record:
+    print(record(args.record[0], args.record[1], args.record[2:]))
+  else:
+    for name, body in generate().items():
+      print('{}: {} chars'.format(save(name, body), len(body)))
@@ -0,0 +1,124 @@
+'''
+起動時間 (モジュールの読み込み時間) のレポート
+python -X importtime で app.py などを読み込み、かかった時間と時間のかかったモジュールを表示する
+Heroku の dyno はスリープから起きるときに読み込みからやり直すので、最初の利用者の待ち時間に効く
+
+使い方:
+  python bench/importtime.py                        # app の読み込み時間 (5回の中央値)
+  python bench/importtime.py -m app_async -n 10
+  python bench/importtime.py --budget 250           # 中央値が 250ms を超えたら終了コード 1
+  REHATCH_EAGER_START=1 python bench/importtime.py  # 起動時にすべて済ませる場合
+
+本番の環境変数がなくても読み込めるように、必要な環境変数にはダミーの値を入れる
+'''
+
+import sys
+import argparse
+import json
+import os
+import re
+import subprocess
+
+ROOT_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+
+# 読み込みに必要な環境変数 (設定されていなければダミーを入れる)
+DUMMY_ENV = {
+  'LINE_CHANNEL_ACCESS_TOKEN': 'dummy',
+  'LINE_CHANNEL_SECRET': 'dummy',
+  # 計測中はワーカー間の共有キャッシュとメトリクスのファイルを使わない
+  'REHATCH_SHARED_CACHE_PATH': '',
+  'REHATCH_METRICS_DIR': '',
+}
+
+LINE_PATTERN = re.compile(r'^import time:\s+(\d+) \|\s+(\d+) \|( *)(\S+)$')
+
+def parse_importtime(text):
+  '''
+  -X importtime の出力をパース
+  output: [(モジュール名, 深さ, 自身の時間 (秒), 累積の時間 (秒))] (読み込みが終わった順)
+  '''
+  ret = []
+  for line in text.splitlines():
+    m = LINE_PATTERN.match(line)
+    if m is None:
+      continue
+    self_us, cumulative_us, indent, name = m.groups()
+    ret += [(name, (len(indent) - 1) // 2, int(self_us) / 1e6, int(cumulative_us) / 1e6)]
+  return ret
+
+def measure(module):
+  '''
+  新しいプロセスで module を1回読み込む
+  output: parse_importtime の出力
+  '''
+  env = dict(os.environ)
+  for k, v in DUMMY_ENV.items():
+    env.setdefault(k, v)
+  res = subprocess.run(
+    [sys.executable, '-X', 'importtime', '-c', 'import {}'.format(module)],
+    cwd=ROOT_DIR, env=env, capture_output=True, text=True)
+  if res.returncode != 0:
+    raise RuntimeError('failed to import {}:\n{}'.format(module, res.stderr[-2000:]))
+  return parse_importtime(res.stderr)
+
+def median(values):
+  values = sorted(values)
+  return values[len(values) // 2]
+
+def report(module, rounds=5, top=15):
+  '''
+  rounds 回読み込んだ中央値
+  output: {'total': 秒, 'cumulative': [(名前, 秒)], 'self': [(名前, 秒)]}
+    - cumulative: module が直接読み込んだモジュールの累積時間 (依存先を含む)
+    - self: モジュール自身の時間 (依存先を含まない)
+  '''
+  totals = []
+  cumulative = {}
+  self_times = {}
+  for _ in range(rounds):
+    rows = measure(module)
+    # module の行 (深さ0) の直前にある深さ1以上の行が module から読み込んだもの
+    # (それより前はインタプリタの起動時に読み込んだもの)
+    end = max(i for i, r in enumerate(rows) if r[0] == module and r[1] == 0)
+    start = end
+    while start > 0 and rows[start - 1][1] > 0:
+      start -= 1
+    totals += [rows[end][3]]
+    for name, depth, s, c in rows[start:end + 1]:
+      if depth == 1:
+        cumulative.setdefault(name, []).append(c)
+      self_times.setdefault(name, []).append(s)
+  return {
+    'module': module,
+    'rounds': rounds,
+    'total': median(totals),
+    'cumulative': sorted(((n, median(v)) for n, v in cumulative.items()), key=lambda x: -x[1])[:top],
+    'self': sorted(((n, median(v)) for n, v in self_times.items()), key=lambda x: -x[1])[:top],
+  }
+
+if __name__ == '__main__':
+  argparser = argparse.ArgumentParser(description='起動時間のレポート')
+  argparser.add_argument('-m', '--module', default='app', help='読み込むモジュール')
+  argparser.add_argument('-n', '--rounds', type=int, default=5, help='計測の回数')
+  argparser.add_argument('--top', type=int, default=15, help='表示するモジュールの数')
+  argparser.add_argument('--budget', type=float, default=None, help='許容する読み込み時間 (ミリ秒)')
+  argparser.add_argument('--json', action='store_true', help='結果をJSONで出す')
+  args = argparser.parse_args()
+
+  r = report(args.module, rounds=args.rounds, top=args.top)
+  if args.json:
+    print(json.dumps(r, indent=2, ensure_ascii=False))
+  else:
+    print('import {}: {:.1f}ms (median of {})'.format(r['module'], r['total'] * 1e3, r['rounds']))
+    print()
+    print('{:40s} {:>10s}'.format('direct imports (cumulative)', 'ms'))
+    for name, t in r['cumulative']:
+      print('{:40s} {:10.1f}'.format(name, t * 1e3))
+    print()
+    print('{:40s} {:>10s}'.format('modules (self)', 'ms'))
+    for name, t in r['self']:
+      print('{:40s} {:10.1f}'.format(name, t * 1e3))
+
+  if args.budget is not None and r['total'] * 1e3 > args.budget:
+    print('OVER BUDGET: {:.1f}ms > {:.1f}ms'.format(r['total'] * 1e3, args.budget))
+    sys.exit(1)
@@ -0,0 +1,198 @@
+'''
+マイクロベンチマーク
+bench/fixtures のレスポンスと入力文を使って、通信なしで各処理の速さを測る
+
+使い方:
+  python bench/run.py                          # 全部測る
+  python bench/run.py -k make_voice -k parse   # 名前に含む文字列で絞る
+  python bench/run.py --save bench/baseline.json
+  python bench/run.py --compare bench/baseline.json --tolerance 0.2
+
+--compare では、p50 が基準より tolerance (割合) を超えて遅くなったものを表示し、
+1つでもあれば終了コード 1 で終わる
+'''
+
+import sys
+import argparse
+import glob
+import io
+import gzip
+import json
+import os
+import platform
+import random
+import time
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+FIXTURE_DIR = os.path.join(BENCH_DIR, 'fixtures')
+sys.path.insert(0, os.path.join(BENCH_DIR, '..'))
+
+# ベンチマーク中はワーカー間の共有キャッシュとメトリクスのファイルを使わない
+os.environ.setdefault('REHATCH_SHARED_CACHE_PATH', '')
+os.environ.setdefault('REHATCH_METRICS_DIR', '')
+
+import text_utils
+import refkyo
+import wikipedia
+import message
+
+def load_fixture(name):
+  with gzip.open(os.path.join(FIXTURE_DIR, name + '.xml.gz')) as f:
+    return f.read()
+
+def fixture_names(prefix):
+  return sorted(os.path.basename(x)[:-len('.xml.gz')]
+                for x in glob.glob(os.path.join(FIXTURE_DIR, prefix + '*.xml.gz')))
+
+def load_utterances():
+  with open(os.path.join(FIXTURE_DIR, 'utterances.txt'), encoding='utf-8') as f:
+    return [l.strip() for l in f if len(l.strip()) > 0 and not l.startswith('#')]
+
+def make_benchmarks():
+  '''
+  名前 → (1回分の処理, 1回あたりの件数)
+  '''
+  utterances = load_utterances()
+  keywords = [text_utils.get_keywords(x) for x in utterances]
+
+  crd = {n: load_fixture(n) for n in fixture_names('crd_')}
+  wiki = {n: load_fixture(n) for n in fixture_names('wiki_')}
+  crd_results = {n: refkyo.parse_page_stream(io.BytesIO(x))[1] for n, x in crd.items()}
+  wiki_pages = {n: wikipedia.parse_pages_stream(io.BytesIO(x)) for n, x in wiki.items()}
+  answers = [r['reference']['answer'] for r in crd_results['crd_page200']]
+  questions = [r['reference']['question'] for r in crd_results['crd_page200']]
+
+  benchmarks = {}
+  benchmarks['text_utils.get_keywords'] = (
+    lambda: [text_utils.get_keywords(x) for x in utterances], len(utterances))
+  benchmarks['text_utils.make_voice/question'] = (
+    lambda: [text_utils.make_voice(x) for x in questions], len(questions))
+  benchmarks['text_utils.make_voice/answer'] = (
+    lambda: [text_utils.make_voice(x) for x in answers], len(answers))
+  benchmarks['text_utils.shorten_text/answer'] = (
+    lambda: [text_utils.shorten_text(x) for x in answers], len(answers))
+
+  for n, x in crd.items():
+    benchmarks['refkyo.parse_page_stream/{}'.format(n)] = (
+      lambda x=x: refkyo.parse_page_stream(io.BytesIO(x)), 1)
+    benchmarks['refkyo.parse_page_dom/{}'.format(n)] = (
+      lambda x=x: refkyo.parse_page_dom(x.decode('utf-8')), 1)
+    results = crd_results[n]
+    if len(results) > 0:
+      benchmarks['refkyo.parse_result/{}'.format(n)] = (
+        lambda results=results: [refkyo.parse_result(['京都', '奈良'], r) for r in results],
+        len(results))
+
+  for n, x in wiki.items():
+    benchmarks['wikipedia.parse_pages_stream/{}'.format(n)] = (
+      lambda x=x: wikipedia.parse_pages_stream(io.BytesIO(x)), 1)
+    pages = wiki_pages[n]
+    benchmarks['wikipedia.parse_result/{}'.format(n)] = (
+      lambda pages=pages: [wikipedia.parse_result(['京都', 'キョウト'], p) for p in pages],
+      len(pages))
+
+  # 返答の作成 (通信なし). 入力文ごとに取得済みのデータセットを組み合わせる
+  wiki_data = [wikipedia.parse_result(k, p) for k in keywords[:1] for p in wiki_pages['wiki_multi']]
+  ref_data = [refkyo.parse_result(k, r) for k in keywords[:1] for r in crd_results['crd_page200']]
+  datasets = []
+  for i, k in enumerate(keywords):
+    datasets += [(k, {
+      'wiki': [] if i % 4 == 0 else [dict(d, hit=random.choice(k)) for d in wiki_data],
+      'ref': [] if i % 5 == 0 else [dict(d, hit=random.choice(k)) for d in ref_data[i:i+50]],
+    })]
+  benchmarks['message.make_response'] = (
+    lambda: [message.make_response(k, d) for k, d in datasets], len(datasets))
+  return benchmarks
+
+def percentile(values, q):
+  values = sorted(values)
+  return values[min(len(values) - 1, int(len(values) * q))]
+
+def run(fn, count, min_time=1.0, min_rounds=5, max_rounds=10000):
+  '''
+  fn を min_time 秒以上 (かつ min_rounds 回以上) くり返して測る
+  output: 1件あたりの時間 (秒) の分位点と、1秒あたりの件数
+  '''
+  fn() # ウォームアップ
+  times = []
+  started = time.perf_counter()
+  while len(times) < max_rounds:
+    t0 = time.perf_counter()
+    fn()
+    times += [(time.perf_counter() - t0) / count]
+    if len(times) >= min_rounds and time.perf_counter() - started >= min_time:
+      break
+  return {
+    'rounds': len(times),
+    'per_call': count,
+    'p50': percentile(times, 0.5),
+    'p95': percentile(times, 0.95),
+    'p99': percentile(times, 0.99),
+    'ops': 1.0 / (sum(times) / len(times)),
+  }
+
+def format_time(t):
+  if t < 1e-3:
+    return '{:8.1f}us'.format(t * 1e6)
+  if t < 1:
+    return '{:8.2f}ms'.format(t * 1e3)
+  return '{:8.2f}s '.format(t)
+
+def compare(results, baseline, tolerance):
+  '''
+  基準より遅くなったもの [(名前, 基準のp50, 今回のp50)]
+  '''
+  ret = []
+  for name, r in results.items():
+    b = baseline.get('results', {}).get(name)
+    if b is None:
+      continue
+    if r['p50'] > b['p50'] * (1 + tolerance):
+      ret += [(name, b['p50'], r['p50'])]
+  return ret
+
+if __name__ == '__main__':
+  argparser = argparse.ArgumentParser(description='マイクロベンチマーク')
+  argparser.add_argument('-k', action='append', default=[], help='名前に含む文字列で絞る')
+  argparser.add_argument('--min-time', type=float, default=1.0, help='1項目あたりの最短時間 (秒)')
+  argparser.add_argument('--save', default=None, help='結果を保存するファイル')
+  argparser.add_argument('--compare', default=None, help='比較する基準のファイル')
+  argparser.add_argument('--tolerance', type=float, default=0.2, help='遅くなったとみなす割合')
+  args = argparser.parse_args()
+
+  random.seed(0)
+  benchmarks = make_benchmarks()
+  baseline = None
+  if args.compare:
+    with open(args.compare, encoding='utf-8') as f:
+      baseline = json.load(f)
+
+  results = {}
+  print('{:55s} {:>10s} {:>10s} {:>10s} {:>12s}'.format('name', 'p50', 'p95', 'p99', 'ops/s'))
+  for name, (fn, count) in benchmarks.items():
+    if len(args.k) > 0 and not any(k in name for k in args.k):
+      continue
+    r = run(fn, count, min_time=args.min_time)
+    results[name] = r
+    line = '{:55s} {} {} {} {:12.1f}'.format(
+      name, format_time(r['p50']), format_time(r['p95']), format_time(r['p99']), r['ops'])
+    if baseline is not None and name in baseline.get('results', {}):
+      line += '  ({:+.1f}%)'.format((r['p50'] / baseline['results'][name]['p50'] - 1) * 100)
+    print(line)
+
+  if args.save:
+    with open(args.save, 'w', encoding='utf-8') as f:
+      json.dump({
+        'python': platform.python_version(),
+        'machine': platform.machine(),
+        'created_at': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'results': results,
+      }, f, indent=2, ensure_ascii=False)
+    print('saved: {}'.format(args.save))
+
+  if baseline is not None:
+    slower = compare(results, baseline, args.tolerance)
+    for name, b, r in slower:
+      print('SLOWER: {} {} -> {}'.format(name, format_time(b).strip(), format_time(r).strip()))
+    if len(slower) > 0:
+      sys.exit(1)
@@ -0,0 +1,174 @@
+'''
+外部APIごとのサーキットブレーカー
+失敗 (例外, 5xx, SLOW_CALL 秒より遅い応答) が続いたら開いて、しばらくは問い合わせずにすぐに失敗させる
+reset_timeout 秒たったら半開になり、試しの問い合わせを half_open_calls 件だけ通す
+試しが成功したら閉じ (通常に戻る)、失敗したらまた開く
+
+  closed --(failures 回続けて失敗)--> open --(reset_timeout 秒)--> half_open
+  half_open --(成功)--> closed
+  half_open --(失敗)--> open
+
+状態が変わるたびに世代を1つ進める. check で通したときの世代を record_* に渡すと、
+それより前の世代に通した問い合わせの結果 (開く前に出して遅れて返った応答など) は数えない
+閉じるのは半開のときに通した試しの問い合わせが成功したときだけになる
+4xx (リクエストの問題) は record_client_error. 回復の合図にも失敗にも数えない
+
+http_client / http_client_async はホストごとのブレーカーを通して問い合わせる (get(ホスト名))
+
+環境変数:
+  REHATCH_BREAKER_FAILURES: 開くまでの連続の失敗の数 (default: 5)
+  REHATCH_BREAKER_RESET: 開いてから半開にするまでの秒数 (default: 30)
+  REHATCH_BREAKER_HALF_OPEN_CALLS: 半開のときに通す試しの問い合わせの数 (default: 1)
+  REHATCH_BREAKER_SLOW_CALL: これより遅い応答は成功しても失敗として数える秒数 (default: 5)
+    (message.fetch_dataset の期限に間に合わない応答. 遅いだけのときも開くように)
+'''
+
+import os
+import threading
+import time
+
+import metrics
+
+FAILURES = int(os.environ.get('REHATCH_BREAKER_FAILURES', '5'))
+RESET_TIMEOUT = float(os.environ.get('REHATCH_BREAKER_RESET', '30'))
+HALF_OPEN_CALLS = int(os.environ.get('REHATCH_BREAKER_HALF_OPEN_CALLS', '1'))
+SLOW_CALL = float(os.environ.get('REHATCH_BREAKER_SLOW_CALL', '5'))
+
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half_open'
+
+class CircuitOpenError(Exception):
+  '''
+  ブレーカーが開いているので問い合わせなかった
+  '''
+  def __init__(self, name):
+    super().__init__('circuit open: {}'.format(name))
+    self.name = name
+
+class CircuitBreaker:
+  def __init__(self, name, failures=FAILURES, reset_timeout=RESET_TIMEOUT,
+               half_open_calls=HALF_OPEN_CALLS, slow_call=SLOW_CALL):
+    self.name = name
+    self.slow_call = slow_call
+    self.failures = failures
+    self.reset_timeout = reset_timeout
+    self.half_open_calls = half_open_calls
+    self._lock = threading.Lock()
+    self.state = CLOSED
+    self._consecutive = 0
+    self._opened_at = 0
+    self._trials = 0
+    self._generation = 0
+    self.rejected = 0
+    self.opened = 0
+
+  def _set_state(self, state):
+    # ロックを取った状態で呼ぶ
+    self.state = state
+    self._generation += 1
+    if state == OPEN:
+      self._opened_at = time.monotonic()
+      self.opened += 1
+    self._trials = 0
+    metrics.inc('rehatch_breaker_transitions_total', breaker=self.name, state=state)
+
+  def _admit(self):
+    '''
+    いま問い合わせてよければ世代, だめなら None (半開のときは試しの枠を1つ使う)
+    '''
+    with self._lock:
+      if self.state == OPEN and time.monotonic() - self._opened_at >= self.reset_timeout:
+        self._set_state(HALF_OPEN)
+      if self.state == CLOSED:
+        return self._generation
+      if self.state == HALF_OPEN and self._trials < self.half_open_calls:
+        self._trials += 1
+        return self._generation
+      self.rejected += 1
+    metrics.inc('rehatch_breaker_rejected_total', breaker=self.name)
+    return None
+
+  def allow(self):
+    '''
+    いま問い合わせてよいかどうか (半開のときは試しの枠を1つ使う)
+    '''
+    return self._admit() is not None
+
+  def check(self):
+    '''
+    allow の結果が False なら CircuitOpenError
+    output: 通したときの世代 (record_* に渡す)
+    '''
+    generation = self._admit()
+    if generation is None:
+      raise CircuitOpenError(self.name)
+    return generation
+
+  def _stale(self, generation):
+    # ロックを取った状態で呼ぶ
+    return generation is not None and generation != self._generation
+
+  def record_success(self, generation=None):
+    with self._lock:
+      if self._stale(generation):
+        return
+      self._consecutive = 0
+      if self.state != CLOSED:
+        self._set_state(CLOSED)
+
+  def record_failure(self, generation=None):
+    with self._lock:
+      if self._stale(generation):
+        return
+      self._consecutive += 1
+      if self.state == HALF_OPEN or (self.state == CLOSED and self._consecutive >= self.failures):
+        self._set_state(OPEN)
+
+  def record_client_error(self, generation=None):
+    '''
+    4xx が返ったとき. 回復の合図にも失敗にも数えない (半開なら試しの枠を返す)
+    '''
+    with self._lock:
+      if self._stale(generation):
+        return
+      if self.state == HALF_OPEN and self._trials > 0:
+        self._trials -= 1
+
+  def record_result(self, elapsed, generation=None):
+    '''
+    応答が返ったとき. slow_call 秒より遅ければ失敗として数える
+    '''
+    if elapsed > self.slow_call:
+      self.record_failure(generation)
+    else:
+      self.record_success(generation)
+
+  def stats(self):
+    with self._lock:
+      return {
+        'name': self.name,
+        'state': self.state,
+        'consecutive_failures': self._consecutive,
+        'opened': self.opened,
+        'rejected': self.rejected,
+      }
+
+_breakers = {}
+_breakers_lock = threading.Lock()
+
+def get(name):
+  '''
+  名前 (ホスト名) ごとのブレーカー (初回に作成)
+  '''
+  b = _breakers.get(name)
+  if b is None:
+    with _breakers_lock:
+      b = _breakers.get(name)
+      if b is None:
+        b = CircuitBreaker(name)
+        _breakers[name] = b
+  return b
+
+def stats():
+  return [b.stats() for b in list(_breakers.values())]
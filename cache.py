@@ -0,0 +1,157 @@
+'''
+プロセス内キャッシュ
+データベース (レファ協, wikipedia) の抽出済みデータを、キーワードごとに保持する
+'''
+
+import threading
+import time
+from collections import OrderedDict
+
+def make_key(keywords):
+  '''
+  キーワードリストからキャッシュキーを作成
+  前後の空白・重複・順番の違いは同じキーにまとめる
+  '''
+  return tuple(sorted(set(k.strip() for k in keywords)))
+
+class TTLCache:
+  '''
+  有効期限 (TTL) つきのLRUキャッシュ
+  - maxsize: 最大エントリ数. 超えたら最も古く使われたものから捨てる
+  - ttl: 有効期限 (秒). Noneのとき期限なし
+  '''
+  def __init__(self, maxsize=256, ttl=600, name=None):
+    self.maxsize = maxsize
+    self.ttl = ttl
+    self.name = name
+    self._data = OrderedDict()
+    self._lock = threading.Lock()
+    self.hits = 0
+    self.misses = 0
+    self.evictions = 0
+    self.expirations = 0
+
+  def get(self, key, default=None):
+    '''
+    キャッシュから取得. なければ default
+    '''
+    now = time.monotonic()
+    with self._lock:
+      item = self._data.get(key)
+      if item is None:
+        self.misses += 1
+        return default
+      expire, value = item
+      if expire is not None and expire < now:
+        del self._data[key]
+        self.expirations += 1
+        self.misses += 1
+        return default
+      self._data.move_to_end(key)
+      self.hits += 1
+      return value
+
+  def set(self, key, value):
+    '''
+    キャッシュに保存
+    '''
+    if self.maxsize <= 0:
+      return
+    expire = None if self.ttl is None else time.monotonic() + self.ttl
+    with self._lock:
+      self._data[key] = (expire, value)
+      self._data.move_to_end(key)
+      while len(self._data) > self.maxsize:
+        self._data.popitem(last=False)
+        self.evictions += 1
+
+  def delete(self, key):
+    '''
+    キャッシュから削除 (なければ何もしない)
+    '''
+    with self._lock:
+      self._data.pop(key, None)
+
+  def clear(self):
+    with self._lock:
+      self._data.clear()
+
+  def __len__(self):
+    return len(self._data)
+
+  def stats(self):
+    '''
+    チューニング用のカウンタ
+    '''
+    with self._lock:
+      return {
+        'name': self.name,
+        'size': len(self._data),
+        'maxsize': self.maxsize,
+        'ttl': self.ttl,
+        'hits': self.hits,
+        'misses': self.misses,
+        'evictions': self.evictions,
+        'expirations': self.expirations,
+      }
+
+def cached_data(cache, keywords, loader, debug=False, shared=None, variant=()):
+  '''
+  キャッシュがあればそれを、なければ loader(keywords, debug=debug) の結果を返す
+  抽出済みの dict のリストを保存するので、ヒット時は通信もパースもしない
+  - cache: プロセス内キャッシュ (TTLCache)
+  - shared: ワーカー間の共有キャッシュ (shared_cache.SharedCache). Noneのとき使わない
+    古いデータはすぐに返して、裏で更新する (stale-while-revalidate)
+  - variant: 同じキーワードで別のデータを取得するとき、キーに加えるもの (タプル)
+  loader が例外を投げたときはキャッシュしない
+  '''
+  key = make_key(keywords) + variant
+  data = cache.get(key)
+  if data is not None:
+    return list(data)
+  
+  if shared is not None:
+    entry = shared.get(key)
+    if entry is not None:
+      data, fresh = entry
+      cache.set(key, data)
+      if not fresh:
+        shared.refresh_async(
+          key, lambda: loader(keywords),
+          on_done=lambda value: cache.set(key, value))
+      return list(data)
+  
+  data = loader(keywords, debug=debug)
+  cache.set(key, data)
+  if shared is not None:
+    shared.set(key, data)
+  # 呼び出し側でリストをいじっても壊れないようにコピーを返す
+  return list(data)
+
+async def cached_data_async(cache, keywords, loader, refresher, debug=False, shared=None, variant=()):
+  '''
+  cached_data の非同期版 (app_async.py 用)
+  - loader: キャッシュがないときに await loader(keywords, debug=debug) で取得
+  - refresher: 共有キャッシュの古いデータを裏のスレッドで更新するときの同期版の loader
+  '''
+  key = make_key(keywords) + variant
+  data = cache.get(key)
+  if data is not None:
+    return list(data)
+  
+  if shared is not None:
+    entry = shared.get(key)
+    if entry is not None:
+      data, fresh = entry
+      cache.set(key, data)
+      if not fresh:
+        shared.refresh_async(
+          key, lambda: refresher(keywords),
+          on_done=lambda value: cache.set(key, value))
+      return list(data)
+  
+  data = await loader(keywords, debug=debug)
+  cache.set(key, data)
+  if shared is not None:
+    shared.set(key, data)
+  return list(data)
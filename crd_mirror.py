@@ -0,0 +1,210 @@
+'''
+レファレンス協同データベース (レファ協) のローカル全文検索インデックス
+refsearch APIを順番にページングしてレファレンス事例を集め、SQLite FTS5に保存する
+2回目以降は前回の最終更新日以降に更新された事例だけを取り込む (差分同期)
+
+refkyo.py で REHATCH_REF_BACKEND=mirror とすると、APIの代わりにここから検索する
+
+使い方:
+  python crd_mirror.py sync            # 差分同期 (初回は全件)
+  python crd_mirror.py sync --full     # 全件取り直し
+  python crd_mirror.py search 京都 奈良
+'''
+
+import argparse
+import json
+import os
+import sqlite3
+import time
+
+import refkyo
+
+DB_PATH = os.environ.get('REHATCH_CRD_MIRROR_PATH', 'crd_mirror.sqlite3')
+
+# 1ページあたりの取得件数 (APIの上限)
+PAGE_SIZE = 200
+
+# 差分同期の検索式. {since} に YYYYMMDD が入る
+SYNC_QUERY = 'lst-date from {since}'
+# 全件取得のときの開始日
+EPOCH = '20020101'
+
+# 検索で返す最大件数 (APIのデフォルトページと同じ)
+SEARCH_LIMIT = 200
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS refs (
+  id INTEGER PRIMARY KEY,
+  url TEXT NOT NULL UNIQUE,
+  question TEXT NOT NULL,
+  answer TEXT NOT NULL,
+  lib_name TEXT NOT NULL,
+  keyword TEXT NOT NULL,
+  lst_date TEXT NOT NULL,
+  raw TEXT NOT NULL
+);
+CREATE VIRTUAL TABLE IF NOT EXISTS refs_fts USING fts5(
+  question, answer, lib_name, keyword,
+  content='refs', content_rowid='id', tokenize='trigram'
+);
+CREATE TRIGGER IF NOT EXISTS refs_ai AFTER INSERT ON refs BEGIN
+  INSERT INTO refs_fts(rowid, question, answer, lib_name, keyword)
+  VALUES (new.id, new.question, new.answer, new.lib_name, new.keyword);
+END;
+CREATE TRIGGER IF NOT EXISTS refs_ad AFTER DELETE ON refs BEGIN
+  INSERT INTO refs_fts(refs_fts, rowid, question, answer, lib_name, keyword)
+  VALUES ('delete', old.id, old.question, old.answer, old.lib_name, old.keyword);
+END;
+CREATE TABLE IF NOT EXISTS sync_state (
+  name TEXT PRIMARY KEY,
+  value TEXT NOT NULL
+);
+'''
+
+def connect(path=None):
+  '''
+  インデックスを開く (なければ作成)
+  '''
+  conn = sqlite3.connect(path or DB_PATH)
+  conn.executescript(SCHEMA)
+  return conn
+
+def available(path=None):
+  '''
+  検索に使えるインデックスがあるかどうか
+  '''
+  return os.path.exists(path or DB_PATH)
+
+def _text(x):
+  '''
+  xmltodictの値を文字列に
+  '''
+  if x is None:
+    return ''
+  if isinstance(x, list):
+    return ' '.join(_text(y) for y in x)
+  if isinstance(x, dict):
+    return _text(x.get('#text'))
+  return str(x)
+
+def store(conn, results):
+  '''
+  検索結果 (refkyo.db_access の出力) をインデックスに保存
+  output: 保存した事例のうち最新の最終更新日
+  '''
+  latest = ''
+  for result in results:
+    ref = result['reference']
+    system = ref.get('system') or {}
+    url = _text(ref.get('url')).strip()
+    if not url:
+      continue
+    lst_date = _text(system.get('lst-date') or system.get('reg-date'))
+    latest = max(latest, lst_date)
+    conn.execute('DELETE FROM refs WHERE url=?', (url,))
+    conn.execute(
+      'INSERT INTO refs (url, question, answer, lib_name, keyword, lst_date, raw) '
+      'VALUES (?, ?, ?, ?, ?, ?, ?)',
+      (url,
+       _text(ref.get('question')),
+       _text(ref.get('answer')),
+       _text(system.get('lib-name')),
+       _text(ref.get('keyword')),
+       lst_date,
+       json.dumps(result, ensure_ascii=False)))
+  return latest
+
+def get_state(conn, name, default=None):
+  row = conn.execute('SELECT value FROM sync_state WHERE name=?', (name,)).fetchone()
+  return default if row is None else row[0]
+
+def set_state(conn, name, value):
+  conn.execute('INSERT OR REPLACE INTO sync_state (name, value) VALUES (?, ?)', (name, value))
+
+def sync(path=None, since=None, full=False, interval=1.0, debug=False):
+  '''
+  refsearch APIをページングして、インデックスを更新
+  input:
+    - since: この日 (YYYYMMDD) 以降に更新された事例を取り込む. Noneのとき前回の続きから
+    - full: 全件取り直すかどうか
+    - interval: ページ取得の間隔 (秒). APIに負荷をかけすぎないように
+  output: 取り込んだ事例数
+  '''
+  conn = connect(path)
+  if since is None:
+    since = EPOCH if full else get_state(conn, 'lst_date', EPOCH)[:8]
+  query = SYNC_QUERY.format(since=since)
+
+  count = 0
+  latest = ''
+  position = 1
+  while True:
+    url = refkyo.make_query_url(query, results_num=PAGE_SIZE, results_get_position=position)
+    hit_num, results = refkyo.db_access_page(url)
+    if debug:
+      print('{}/{} {}'.format(position, hit_num, url))
+    with conn:
+      latest = max(latest, store(conn, results))
+    count += len(results)
+    position += PAGE_SIZE
+    if len(results) == 0 or position > hit_num:
+      break
+    time.sleep(interval)
+
+  # 最後まで取り込めたときだけ次回の開始日を進める
+  with conn:
+    if latest:
+      set_state(conn, 'lst_date', max(latest, get_state(conn, 'lst_date', '')))
+    set_state(conn, 'synced_at', time.strftime('%Y%m%d%H%M%S'))
+  conn.close()
+  return count
+
+def _fts_phrase(keyword):
+  return '"{}"'.format(keyword.replace('"', '""'))
+
+def search(keywords, path=None, limit=SEARCH_LIMIT):
+  '''
+  'question any キーワード' と同じく、どれかのキーワードを質問に含む事例を探す
+  output: refkyo.db_access と同じ形の検索結果のリスト
+  '''
+  keywords = [k.strip() for k in keywords if len(k.strip()) > 0]
+  if len(keywords) == 0:
+    return []
+
+  # trigramは3文字以上しか引けないので、短いキーワードはLIKEで探す
+  longs = [k for k in keywords if len(k) >= 3]
+  shorts = [k for k in keywords if len(k) < 3]
+  conds = []
+  args = []
+  if len(longs) > 0:
+    conds += ['id IN (SELECT rowid FROM refs_fts WHERE refs_fts MATCH ?)']
+    args += [' OR '.join('question : {}'.format(_fts_phrase(k)) for k in longs)]
+  for k in shorts:
+    conds += ["question LIKE ? ESCAPE '\\'"]
+    args += ['%{}%'.format(k.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_'))]
+
+  conn = sqlite3.connect(path or DB_PATH)
+  try:
+    rows = conn.execute(
+      'SELECT raw FROM refs WHERE {} ORDER BY lst_date DESC LIMIT ?'.format(' OR '.join(conds)),
+      args + [limit]).fetchall()
+  finally:
+    conn.close()
+  return [json.loads(r[0]) for r in rows]
+
+if __name__ == '__main__':
+  argparser = argparse.ArgumentParser(description='レファ協のローカル全文検索インデックス')
+  argparser.add_argument('command', choices=['sync', 'search'])
+  argparser.add_argument('keywords', nargs='*')
+  argparser.add_argument('--db', default=None, help='インデックスのパス')
+  argparser.add_argument('--since', default=None, help='この日 (YYYYMMDD) 以降の更新を取り込む')
+  argparser.add_argument('--full', action='store_true', help='全件取り直す')
+  argparser.add_argument('--interval', type=float, default=1.0, help='ページ取得の間隔 (秒)')
+  args = argparser.parse_args()
+
+  if args.command == 'sync':
+    n = sync(args.db, since=args.since, full=args.full, interval=args.interval, debug=True)
+    print('synced: {}'.format(n))
+  else:
+    for r in search(args.keywords, path=args.db):
+      print(json.dumps(refkyo.parse_result(args.keywords, r), ensure_ascii=False))
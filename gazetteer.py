@@ -0,0 +1,161 @@
+'''
+地名辞書 (ガゼッティア) によるキーワード抽出
+辞書の地名 (現在の地名と昔の地名) からAho-Corasickオートマトンを作り、
+テキストを1回なめるだけで、含まれる地名を左から最長一致で重ならないように取り出す
+処理時間は辞書の大きさによらず、テキストの長さ (と見つかった地名の数) にほぼ比例する
+
+REHATCH_GAZETTEER に辞書ファイルのパスを設定すると text_utils.get_keywords で使われる
+
+辞書ファイル: 1行目が見出しのTSV (拡張子が .csv のときはCSV)
+  place_name        昔の地名
+  modern_place_name 現在の地名
+  (ほかの列は無視)
+
+使い方:
+  python gazetteer.py places.tsv 武蔵国の国府はどこにありましたか
+'''
+
+import argparse
+import csv
+import os
+import threading
+from collections import deque
+
+GAZETTEER_PATH = os.environ.get('REHATCH_GAZETTEER', '')
+
+# これより短い地名は辞書に入れない (get_keywords の「極端に短いもの」と同じ)
+MIN_LENGTH = 2
+
+NAME_COLUMNS = ('place_name', 'modern_place_name')
+
+class Gazetteer:
+  '''
+  地名のAho-Corasickオートマトン
+  状態ごとに 遷移 (dict), 失敗遷移, その状態で終わる地名の長さ,
+  失敗遷移をたどって最初に地名が終わる状態 を持つ
+  '''
+  def __init__(self, names=()):
+    self._goto = [{}]
+    self._fail = [0]
+    self._out = [0]
+    self._dict = [0]
+    self.size = 0
+    for name in names:
+      self._add(name)
+    self._build()
+
+  def _add(self, name):
+    name = name.strip()
+    if len(name) < MIN_LENGTH:
+      return
+    s = 0
+    for c in name:
+      nxt = self._goto[s].get(c)
+      if nxt is None:
+        nxt = len(self._goto)
+        self._goto[s][c] = nxt
+        self._goto += [{}]
+        self._fail += [0]
+        self._out += [0]
+        self._dict += [0]
+      s = nxt
+    if self._out[s] == 0:
+      self.size += 1
+    self._out[s] = len(name)
+
+  def _build(self):
+    '''
+    幅優先で失敗遷移を作る
+    '''
+    goto, fail, out, dict_link = self._goto, self._fail, self._out, self._dict
+    q = deque(goto[0].values())
+    while len(q) > 0:
+      s = q.popleft()
+      for c, t in goto[s].items():
+        f = fail[s]
+        while f != 0 and c not in goto[f]:
+          f = fail[f]
+        f = goto[f].get(c, 0)
+        fail[t] = f if f != t else 0
+        dict_link[t] = f if out[f] > 0 else dict_link[f]
+        q.append(t)
+
+  def find(self, text):
+    '''
+    含まれる地名の (開始位置, 終了位置) のリスト
+    左から順に、同じ位置から始まるものは最長のものをとり、重なるものはとらない
+    '''
+    goto, fail, out, dict_link = self._goto, self._fail, self._out, self._dict
+    # 開始位置ごとの最長の地名の長さ
+    longest = [0] * (len(text) + 1)
+    s = 0
+    for i, c in enumerate(text):
+      while s != 0 and c not in goto[s]:
+        s = fail[s]
+      s = goto[s].get(c, 0)
+      t = s if out[s] > 0 else dict_link[s]
+      while t != 0:
+        start = i + 1 - out[t]
+        if out[t] > longest[start]:
+          longest[start] = out[t]
+        t = dict_link[t]
+
+    ret = []
+    end = 0
+    for start, length in enumerate(longest):
+      if length > 0 and start >= end:
+        end = start + length
+        ret += [(start, end)]
+    return ret
+
+  def extract(self, text):
+    '''
+    含まれる地名のリスト (重複なし, 出てきた順)
+    '''
+    ret = []
+    for start, end in self.find(text):
+      name = text[start:end]
+      if name not in ret:
+        ret += [name]
+    return ret
+
+def load_names(path):
+  '''
+  辞書ファイルから地名を読む
+  '''
+  delimiter = ',' if path.endswith('.csv') else '\t'
+  with open(path, encoding='utf-8', newline='') as f:
+    for row in csv.DictReader(f, delimiter=delimiter):
+      for col in NAME_COLUMNS:
+        name = (row.get(col) or '').strip()
+        if len(name) > 0:
+          yield name
+
+def load(path):
+  return Gazetteer(load_names(path))
+
+_gazetteer = None
+_gazetteer_lock = threading.Lock()
+
+def get_gazetteer():
+  '''
+  プロセス内で共有する辞書 (初回に読む). 設定されていないときは None
+  '''
+  global _gazetteer
+  if not GAZETTEER_PATH or not os.path.exists(GAZETTEER_PATH):
+    return None
+  if _gazetteer is None:
+    with _gazetteer_lock:
+      if _gazetteer is None:
+        _gazetteer = load(GAZETTEER_PATH)
+  return _gazetteer
+
+if __name__ == '__main__':
+  argparser = argparse.ArgumentParser(description='地名辞書によるキーワード抽出')
+  argparser.add_argument('path', help='辞書ファイル')
+  argparser.add_argument('text')
+  args = argparser.parse_args()
+
+  g = load(args.path)
+  print('names: {}'.format(g.size))
+  print(g.extract(args.text))
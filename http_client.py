@@ -0,0 +1,237 @@
+'''
+外部API (レファ協, wikipedia, kintone) へのHTTPアクセスを共通化する
+- ホストごとのコネクションプール + keep-alive (requests.Session)
+- 接続/読み込みタイムアウト
+- バックオフ付きのリトライ (回数上限あり)
+- ホストごとのプールサイズ上限
+- 期限 (deadline) の中の問い合わせは、タイムアウトを残り時間に縮め、期限内に終わらないリトライをしない
+
+設定は環境変数で変更できる
+- REHATCH_HTTP_CONNECT_TIMEOUT: 接続タイムアウト秒 (default: 3.05)
+- REHATCH_HTTP_READ_TIMEOUT: 読み込みタイムアウト秒 (default: 10)
+- REHATCH_HTTP_RETRIES: リトライ回数 (default: 2)
+- REHATCH_HTTP_BACKOFF: リトライ間隔の係数秒 (default: 0.3)
+- REHATCH_HTTP_POOL_MAXSIZE: 1ホストあたりのコネクション数上限 (default: 10)
+- REHATCH_HTTP_HOST_POOL_SIZES: ホスト別の上限. 例 'crd.ndl.go.jp=4,ja.wikipedia.org=8'
+- REHATCH_STUB_UPSTREAM: 負荷試験用. 外部APIの代わりに問い合わせる先. 例 'http://127.0.0.1:8700'
+  (loadtest/stub_server.py. LINE, kintone も含めて、URLのパスはそのままでホストだけ置き換える)
+'''
+
+import contextlib
+import contextvars
+import os
+import threading
+import time
+import urllib.parse
+
+import metrics
+import breaker
+
+CONNECT_TIMEOUT = float(os.environ.get('REHATCH_HTTP_CONNECT_TIMEOUT', '3.05'))
+READ_TIMEOUT = float(os.environ.get('REHATCH_HTTP_READ_TIMEOUT', '10'))
+RETRIES = int(os.environ.get('REHATCH_HTTP_RETRIES', '2'))
+BACKOFF = float(os.environ.get('REHATCH_HTTP_BACKOFF', '0.3'))
+POOL_MAXSIZE = int(os.environ.get('REHATCH_HTTP_POOL_MAXSIZE', '10'))
+
+USER_AGENT = 'Rehatch/1.0 (+https://github.com/gomi-kuzu/Rehatch_dev)'
+
+STUB_UPSTREAM = os.environ.get('REHATCH_STUB_UPSTREAM', '').rstrip('/')
+
+def upstream(url):
+  '''
+  外部APIのURL. REHATCH_STUB_UPSTREAM があればホストをそちらに置き換える
+  '''
+  if not STUB_UPSTREAM:
+    return url
+  parts = urllib.parse.urlsplit(url)
+  stub = urllib.parse.urlsplit(STUB_UPSTREAM)
+  return urllib.parse.urlunsplit((stub.scheme, stub.netloc) + tuple(parts[2:]))
+
+def parse_host_pool_sizes(spec):
+  '''
+  'host=N,host=N' 形式の設定をパース
+  '''
+  ret = {}
+  for item in spec.split(','):
+    item = item.strip()
+    if '=' not in item:
+      continue
+    host, size = item.split('=', 1)
+    ret[host.strip()] = int(size)
+  return ret
+
+HOST_POOL_SIZES = parse_host_pool_sizes(
+  os.environ.get('REHATCH_HTTP_HOST_POOL_SIZES', ''))
+
+class DeadlineExceeded(Exception):
+  '''
+  期限を過ぎているので問い合わせなかった
+  '''
+
+# いまの問い合わせの期限 (time.monotonic() の値). 期限がないときは None
+_deadline = contextvars.ContextVar('rehatch_http_deadline', default=None)
+# いまの問い合わせの1回の試行にかかりうる秒数 (接続 + 読み込みのタイムアウト)
+_attempt_seconds = contextvars.ContextVar('rehatch_http_attempt_seconds', default=0)
+
+@contextlib.contextmanager
+def deadline(at):
+  '''
+  この中の問い合わせを at (time.monotonic() の値) までに終わらせる. at が None のときは期限なし
+  '''
+  token = _deadline.set(at)
+  try:
+    yield
+  finally:
+    _deadline.reset(token)
+
+def attempt_timeout(connect_timeout=None, read_timeout=None):
+  '''
+  1回の試行のタイムアウト (connect, read)
+  期限があるときは、合わせて残り時間に収まるように縮める (接続は残りの半分まで)
+  期限を過ぎていれば DeadlineExceeded
+  '''
+  connect, read = timeout(connect_timeout, read_timeout)
+  at = _deadline.get()
+  if at is None:
+    return connect, read
+  remaining = at - time.monotonic()
+  if remaining <= 0:
+    raise DeadlineExceeded()
+  connect = min(connect, remaining / 2)
+  return connect, min(read, remaining - connect)
+
+def retry_fits(backoff, attempt_seconds=None):
+  '''
+  backoff 秒待ってからもう1回試行しても、期限までに終わるかどうか (期限がないときは True)
+  '''
+  at = _deadline.get()
+  if attempt_seconds is None:
+    attempt_seconds = _attempt_seconds.get()
+  return at is None or time.monotonic() + backoff + attempt_seconds <= at
+
+def make_adapter(pool_maxsize):
+  '''
+  リトライ・プール設定済みのアダプタを作成
+  POSTはリトライ対象外 (接続できなかったときだけ再送される)
+  期限の中では、期限までに終わらないリトライはしない
+  '''
+  from requests.adapters import HTTPAdapter
+  from urllib3.util.retry import Retry
+
+  class DeadlineRetry(Retry):
+    def is_exhausted(self):
+      return super().is_exhausted() or not retry_fits(self.get_backoff_time())
+
+    def sleep(self, response=None):
+      if _deadline.get() is None:
+        return super().sleep(response)
+      # 期限があるときは Retry-After は待たずにバックオフだけ (retry_fits で確かめた分)
+      time.sleep(self.get_backoff_time())
+
+  retry = DeadlineRetry(
+    total=RETRIES,
+    connect=RETRIES,
+    read=RETRIES,
+    status=RETRIES,
+    backoff_factor=BACKOFF,
+    status_forcelist=(429, 500, 502, 503, 504),
+    respect_retry_after_header=True,
+    raise_on_status=False,
+  )
+  # pool_block=True でホストごとの同時接続数を上限で止める
+  return HTTPAdapter(
+    pool_connections=8,
+    pool_maxsize=pool_maxsize,
+    max_retries=retry,
+    pool_block=True,
+  )
+
+def make_session():
+  '''
+  共有セッションを作成
+  requests は読み込みに時間がかかるので、起動時ではなく最初のリクエストで読み込む
+  '''
+  import requests
+  session = requests.Session()
+  session.headers['User-Agent'] = USER_AGENT
+  default = make_adapter(POOL_MAXSIZE)
+  session.mount('https://', default)
+  session.mount('http://', default)
+  for host, size in HOST_POOL_SIZES.items():
+    adapter = make_adapter(size)
+    session.mount('https://{}/'.format(host), adapter)
+    session.mount('http://{}/'.format(host), adapter)
+  return session
+
+_session = None
+_session_lock = threading.Lock()
+
+def get_session():
+  '''
+  プロセス内で共有するセッションを返す (初回に作成)
+  '''
+  global _session
+  if _session is None:
+    with _session_lock:
+      if _session is None:
+        _session = make_session()
+  return _session
+
+def timeout(connect=None, read=None):
+  '''
+  requests に渡すタイムアウト (connect, read)
+  '''
+  return (CONNECT_TIMEOUT if connect is None else connect,
+          READ_TIMEOUT if read is None else read)
+
+def is_upstream_failure(status):
+  '''
+  ブレーカーで失敗として数えるステータス (4xxはリクエストの問題なので数えない)
+  '''
+  return status >= 500 or status == 429
+
+def request(method, url, connect_timeout=None, read_timeout=None, **kwargs):
+  '''
+  リクエスト. ステータスが4xx/5xxのときは requests.HTTPError
+  ホストのブレーカーが開いているときは問い合わせずに breaker.CircuitOpenError
+  期限 (deadline) を過ぎているときは問い合わせずに DeadlineExceeded
+  ホストごとの所要時間と失敗数を metrics に記録する
+  '''
+  import requests
+  host = urllib.parse.urlsplit(url).netloc
+  connect, read = attempt_timeout(connect_timeout, read_timeout)
+  circuit = breaker.get(host)
+  generation = circuit.check()
+  started = time.monotonic()
+  token = _attempt_seconds.set(connect + read)
+  try:
+    res = get_session().request(method, url, timeout=(connect, read), **kwargs)
+    res.raise_for_status()
+  except requests.HTTPError as e:
+    metrics.inc('rehatch_upstream_errors_total', host=host, method=method)
+    if is_upstream_failure(e.response.status_code):
+      circuit.record_failure(generation)
+    else:
+      circuit.record_client_error(generation)
+    raise
+  except Exception:
+    metrics.inc('rehatch_upstream_errors_total', host=host, method=method)
+    circuit.record_failure(generation)
+    raise
+  finally:
+    _attempt_seconds.reset(token)
+    metrics.observe('rehatch_upstream_seconds', time.monotonic() - started, host=host, method=method)
+  circuit.record_result(time.monotonic() - started, generation)
+  return res
+
+def get(url, connect_timeout=None, read_timeout=None, **kwargs):
+  '''
+  GETリクエスト. ステータスが4xx/5xxのときは requests.HTTPError
+  '''
+  return request('GET', url, connect_timeout, read_timeout, **kwargs)
+
+def post(url, connect_timeout=None, read_timeout=None, **kwargs):
+  '''
+  POSTリクエスト. ステータスが4xx/5xxのときは requests.HTTPError
+  '''
+  return request('POST', url, connect_timeout, read_timeout, **kwargs)
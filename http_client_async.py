@@ -0,0 +1,142 @@
+'''
+外部APIへの非同期HTTPアクセス (app_async.py 用. aiohttp)
+http_client.py と同じ設定 (タイムアウト, リトライ, ホストごとの接続数上限, REHATCH_STUB_UPSTREAM) を使う
+待っている間はイベントループがほかの会話を処理できる
+
+セッション (コネクションプール) はイベントループごとに1つ作る
+1ホストあたりのコネクション数の上限は REHATCH_HTTP_ASYNC_POOL_MAXSIZE (default: 100)
+(スレッドの数に縛られないので、http_client の REHATCH_HTTP_POOL_MAXSIZE より大きくする)
+'''
+
+import asyncio
+import os
+import time
+import urllib.parse
+
+import aiohttp
+
+import http_client
+import metrics
+import breaker
+
+POOL_MAXSIZE = int(os.environ.get('REHATCH_HTTP_ASYNC_POOL_MAXSIZE', '100'))
+
+# リトライするステータス (http_client.make_adapter と同じ)
+RETRY_STATUS = (429, 500, 502, 503, 504)
+
+class HTTPStatusError(Exception):
+  '''
+  ステータスが4xx/5xxのとき
+  '''
+  def __init__(self, status, url):
+    super().__init__('{} for url: {}'.format(status, url))
+    self.status = status
+    self.url = url
+
+_sessions = {}
+
+def get_session():
+  '''
+  いまのイベントループで共有するセッションを返す (初回に作成)
+  '''
+  loop = asyncio.get_running_loop()
+  session = _sessions.get(loop)
+  if session is None or session.closed:
+    connector = aiohttp.TCPConnector(
+      limit=0, limit_per_host=POOL_MAXSIZE, keepalive_timeout=30)
+    session = aiohttp.ClientSession(
+      connector=connector, headers={'User-Agent': http_client.USER_AGENT})
+    _sessions[loop] = session
+  return session
+
+async def close():
+  '''
+  いまのイベントループのセッションを閉じる (サーバの終了時)
+  '''
+  session = _sessions.pop(asyncio.get_running_loop(), None)
+  if session is not None:
+    await session.close()
+
+_host_semaphores = {}
+
+def _semaphore(host):
+  '''
+  REHATCH_HTTP_HOST_POOL_SIZES で指定したホストの同時接続数の上限
+  '''
+  size = http_client.HOST_POOL_SIZES.get(host)
+  if size is None:
+    return None
+  key = (asyncio.get_running_loop(), host)
+  if key not in _host_semaphores:
+    _host_semaphores[key] = asyncio.Semaphore(size)
+  return _host_semaphores[key]
+
+async def _request_once(method, url, timeout, **kwargs):
+  async with get_session().request(method, url, timeout=timeout, **kwargs) as res:
+    body = await res.read()
+    return res.status, body
+
+async def request(method, url, connect_timeout=None, read_timeout=None, **kwargs):
+  '''
+  リクエスト. レスポンスの本文 (bytes) を返す. ステータスが4xx/5xxのときは HTTPStatusError
+  GETは接続の失敗と RETRY_STATUS のときに、POSTは接続の失敗のときだけリトライする
+  ホストのブレーカーが開いているときは問い合わせずに breaker.CircuitOpenError
+  期限 (http_client.deadline) の中では、タイムアウトを残り時間に縮め、期限内に終わらないリトライはしない
+  ホストごとの所要時間と失敗数を metrics に記録する
+  '''
+  connect, read = http_client.attempt_timeout(connect_timeout, read_timeout)
+  timeout = aiohttp.ClientTimeout(sock_connect=connect, sock_read=read)
+  host = urllib.parse.urlsplit(url).netloc
+  semaphore = _semaphore(urllib.parse.urlsplit(url).hostname)
+  circuit = breaker.get(host)
+  generation = circuit.check()
+  started = time.monotonic()
+  try:
+    for attempt in range(http_client.RETRIES + 1):
+      backoff = http_client.BACKOFF * (2 ** attempt)
+      def last():
+        return attempt == http_client.RETRIES or not http_client.retry_fits(backoff, connect + read)
+      try:
+        if semaphore is None:
+          status, body = await _request_once(method, url, timeout, **kwargs)
+        else:
+          async with semaphore:
+            status, body = await _request_once(method, url, timeout, **kwargs)
+      except aiohttp.ClientConnectorError:
+        if last():
+          raise
+      except (aiohttp.ClientError, asyncio.TimeoutError):
+        if method != 'GET' or last():
+          raise
+      else:
+        if status < 400:
+          circuit.record_result(time.monotonic() - started, generation)
+          return body
+        if method != 'GET' or status not in RETRY_STATUS or last():
+          raise HTTPStatusError(status, url)
+      await asyncio.sleep(backoff)
+  except HTTPStatusError as e:
+    metrics.inc('rehatch_upstream_errors_total', host=host, method=method)
+    if http_client.is_upstream_failure(e.status):
+      circuit.record_failure(generation)
+    else:
+      circuit.record_client_error(generation)
+    raise
+  except Exception:
+    metrics.inc('rehatch_upstream_errors_total', host=host, method=method)
+    circuit.record_failure(generation)
+    raise
+  finally:
+    metrics.observe('rehatch_upstream_seconds', time.monotonic() - started, host=host, method=method)
+
+async def get(url, connect_timeout=None, read_timeout=None, **kwargs):
+  '''
+  GETリクエスト. レスポンスの本文 (bytes)
+  '''
+  return await request('GET', url, connect_timeout, read_timeout, **kwargs)
+
+async def post(url, connect_timeout=None, read_timeout=None, **kwargs):
+  '''
+  POSTリクエスト. レスポンスの本文 (bytes)
+  '''
+  return await request('POST', url, connect_timeout, read_timeout, **kwargs)
@@ -0,0 +1,123 @@
+'''
+プロセス内のジョブキュー
+webhookではイベントを積むだけですぐに応答し、返信の作成・送信は裏のワーカーで行う
+'''
+
+import os
+import queue
+import threading
+import time
+from collections import deque
+
+import applog
+
+# 同時に処理するワーカー数
+WORKERS = int(os.environ.get('REHATCH_JOB_WORKERS', '4'))
+# キューに積める最大ジョブ数. あふれたら submit は False を返す
+MAX_QUEUE = int(os.environ.get('REHATCH_JOB_QUEUE_SIZE', '100'))
+
+# 処理時間の分位点を出すために保持する件数
+LATENCY_WINDOW = 1000
+
+def _percentile(values, q):
+  if len(values) == 0:
+    return None
+  values = sorted(values)
+  return values[min(len(values) - 1, int(len(values) * q))]
+
+class JobQueue:
+  '''
+  上限つきのキューと、それを処理する固定数のワーカースレッド
+  ワーカーは最初の submit で起動する (gunicornのfork後に作るため)
+  '''
+  def __init__(self, workers=WORKERS, maxsize=MAX_QUEUE, name='jobs'):
+    self.workers = workers
+    self.name = name
+    self._queue = queue.Queue(maxsize=maxsize)
+    self._threads = []
+    self._lock = threading.Lock()
+    self.submitted = 0
+    self.rejected = 0
+    self.completed = 0
+    self.failed = 0
+    self.running = 0
+    # (待ち時間, 処理時間) の直近 LATENCY_WINDOW 件
+    self._latency = deque(maxlen=LATENCY_WINDOW)
+
+  def _start(self):
+    with self._lock:
+      if len(self._threads) > 0:
+        return
+      for i in range(self.workers):
+        t = threading.Thread(
+          target=self._run, name='{}-{}'.format(self.name, i), daemon=True)
+        t.start()
+        self._threads += [t]
+
+  def submit(self, fn, *args, **kwargs):
+    '''
+    ジョブを積む
+    output: 積めたかどうか (キューがいっぱいのとき False)
+    '''
+    self._start()
+    try:
+      self._queue.put_nowait((time.monotonic(), fn, args, kwargs))
+    except queue.Full:
+      with self._lock:
+        self.rejected += 1
+      return False
+    with self._lock:
+      self.submitted += 1
+    return True
+
+  def _run(self):
+    while True:
+      queued_at, fn, args, kwargs = self._queue.get()
+      started = time.monotonic()
+      with self._lock:
+        self.running += 1
+      ok = True
+      try:
+        fn(*args, **kwargs)
+      except Exception:
+        ok = False
+        applog.error('jobs', 'job_failed', exc_info=True, job=getattr(fn, '__name__', repr(fn)))
+      finished = time.monotonic()
+      with self._lock:
+        self.running -= 1
+        if ok:
+          self.completed += 1
+        else:
+          self.failed += 1
+        self._latency.append((started - queued_at, finished - started))
+      self._queue.task_done()
+
+  def join(self):
+    '''
+    積まれたジョブがすべて終わるまで待つ (試験用)
+    '''
+    self._queue.join()
+
+  def stats(self):
+    '''
+    キューの深さとジョブごとの待ち時間・処理時間 (秒)
+    '''
+    with self._lock:
+      waits = [x[0] for x in self._latency]
+      runs = [x[1] for x in self._latency]
+      return {
+        'name': self.name,
+        'workers': self.workers,
+        'depth': self._queue.qsize(),
+        'maxsize': self._queue.maxsize,
+        'running': self.running,
+        'submitted': self.submitted,
+        'rejected': self.rejected,
+        'completed': self.completed,
+        'failed': self.failed,
+        'wait_p50': _percentile(waits, 0.5),
+        'wait_p95': _percentile(waits, 0.95),
+        'run_p50': _percentile(runs, 0.5),
+        'run_p95': _percentile(runs, 0.95),
+        'run_max': max(runs) if len(runs) > 0 else None,
+      }
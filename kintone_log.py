@@ -0,0 +1,383 @@
+'''
+kintoneへの会話ログの記録
+ログはメモリにためておき、裏のスレッドが一括登録API (records.json, 1回100件まで) でまとめて送る
+
+送れなかったとき:
+  - 一時的な失敗 (5xx, 429, 通信の失敗, ブレーカーが開いている) は、ローカルのファイル (スプール) に
+    追記しておき、あとで送り直す. MAX_ATTEMPTS 回送っても通らないものは dead letter に移す
+  - 送り直しても通らない失敗 (429以外の4xx) は、一括登録が1件の不正なレコードで全体ごと失敗するので、
+    半分ずつに分けて送り直し、1件でも通らないレコードだけを dead letter (スプールのパス + '.dead') に書く
+
+環境変数:
+  KINTONE_URL, CYBOZU_LOG_DB_API_TOKEN, CYBOZU_LOG_DB_APP_ID: 送り先 (以前と同じ)
+  REHATCH_KINTONE_ASYNC: '0' のとき、以前と同じくその場で1件ずつ送る
+  REHATCH_KINTONE_BULK_URL: 一括登録APIのURL (省略時は KINTONE_URL の record.json → records.json)
+  REHATCH_KINTONE_FLUSH_INTERVAL: まとめて送る間隔 (秒)
+  REHATCH_KINTONE_SPOOL_PATH: スプールファイルのパス (default: 作業ディレクトリの kintone_spool.jsonl)
+    Heroku の dyno のファイルシステムは再起動で消えるので、既定のままだとスプールは
+    dyno が動いている間の一時的な失敗しか救えない. 残したいときは永続的な場所を指定する
+    '' のときはスプールを使わず、送れなかったログは捨てる (ログに件数を出す)
+  REHATCH_KINTONE_REPLAY_INTERVAL: スプールを送り直す間隔 (秒)
+  REHATCH_KINTONE_MAX_ATTEMPTS: 一時的な失敗で送り直す回数の上限 (default: 10)
+'''
+
+import atexit
+import glob
+import json
+import os
+import threading
+import time
+from collections import deque
+
+import http_client
+import metrics
+import applog
+
+ASYNC = os.environ.get('REHATCH_KINTONE_ASYNC', '1') != '0'
+FLUSH_INTERVAL = float(os.environ.get('REHATCH_KINTONE_FLUSH_INTERVAL', '2'))
+SPOOL_PATH = os.environ.get('REHATCH_KINTONE_SPOOL_PATH', 'kintone_spool.jsonl')
+REPLAY_INTERVAL = float(os.environ.get('REHATCH_KINTONE_REPLAY_INTERVAL', '60'))
+MAX_ATTEMPTS = int(os.environ.get('REHATCH_KINTONE_MAX_ATTEMPTS', '10'))
+
+# 一括登録APIの1回あたりの上限
+BATCH_SIZE = 100
+# メモリにためておく最大件数. あふれた分はスプールに書く
+MAX_BUFFER = 10000
+# 送り直し中のまま残っているファイル (送り直し中にプロセスが落ちたもの) を拾うまでの時間 (秒)
+REPLAY_STALE = 600
+
+def make_record(source, send_text, sender):
+  '''
+  ログ1件分のレコード
+  '''
+  return {
+    "type": {
+      "value": source
+    },
+    "questioner": {
+      "value": sender
+    },
+    "log": {
+      "value": send_text
+    },
+  }
+
+def _headers():
+  return {
+    "X-Cybozu-API-Token": os.environ['CYBOZU_LOG_DB_API_TOKEN'],
+    "Content-type": "application/json",
+  }
+
+def bulk_url():
+  url = os.environ.get('REHATCH_KINTONE_BULK_URL')
+  if url:
+    return http_client.upstream(url)
+  url = os.environ['KINTONE_URL']
+  if url.endswith('/record.json'):
+    url = url[:-len('record.json')] + 'records.json'
+  return http_client.upstream(url)
+
+def post_record(record):
+  '''
+  1件だけその場で送る (以前の record_log_to_kintone と同じ)
+  '''
+  data = {
+    "app": os.environ['CYBOZU_LOG_DB_APP_ID'],
+    "record": record,
+  }
+  http_client.post(
+    http_client.upstream(os.environ['KINTONE_URL']), data=json.dumps(data).encode(), headers=_headers())
+
+def post_records(records):
+  '''
+  まとめて送る (BATCH_SIZE 件まで)
+  '''
+  data = {
+    "app": os.environ['CYBOZU_LOG_DB_APP_ID'],
+    "records": records,
+  }
+  http_client.post(bulk_url(), data=json.dumps(data).encode(), headers=_headers())
+
+def status_of(error):
+  '''
+  送信に失敗したときのHTTPステータス (応答がないときは None)
+  '''
+  return getattr(getattr(error, 'response', None), 'status_code', None)
+
+def is_permanent(error):
+  '''
+  送り直しても通らない失敗か (429以外の4xx. レコードかリクエストの内容の問題)
+  '''
+  status = status_of(error)
+  return status is not None and status < 500 and status != 429
+
+class KintoneLogger:
+  '''
+  ログをためて裏のスレッドでまとめて送る
+  スレッドは最初の log で起動する (gunicornのfork後に作るため)
+  '''
+  def __init__(self, spool_path=SPOOL_PATH, flush_interval=FLUSH_INTERVAL,
+               replay_interval=REPLAY_INTERVAL, sender=post_records):
+    self.spool_path = spool_path
+    self.flush_interval = flush_interval
+    self.replay_interval = replay_interval
+    self.sender = sender
+    self._buffer = deque()
+    # メモリにためきれなかった分 (スプールへの書き込みは裏のスレッドで行う)
+    self._overflow = []
+    self._cond = threading.Condition()
+    self._spool_lock = threading.Lock()
+    self._thread = None
+    self._last_replay = 0
+    self.queued = 0
+    self.sent = 0
+    self.failed_batches = 0
+    self.spooled = 0
+    self.replayed = 0
+    self.dead_lettered = 0
+    self.dropped = 0
+
+  def _start(self):
+    with self._cond:
+      if self._thread is not None:
+        return
+      self._thread = threading.Thread(target=self._run, name='kintone-log', daemon=True)
+      self._thread.start()
+    atexit.register(self.flush)
+
+  def log(self, record):
+    '''
+    ログを1件ためる (通信はしない)
+    '''
+    self._start()
+    with self._cond:
+      self._buffer.append(record)
+      self.queued += 1
+      if len(self._buffer) > MAX_BUFFER:
+        self._overflow.append(self._buffer.popleft())
+        self._cond.notify()
+      elif len(self._buffer) >= BATCH_SIZE:
+        self._cond.notify()
+
+  def _take(self):
+    with self._cond:
+      n = min(BATCH_SIZE, len(self._buffer))
+      return [self._buffer.popleft() for _ in range(n)]
+
+  def _send(self, records, attempts=0):
+    '''
+    送る. attempts: これまでに一時的な失敗で送れなかった回数
+    一時的な失敗のときはスプールに書き、送り直しても通らない失敗のときは半分ずつに分けて送る
+    output: 一時的な失敗がなかったかどうか
+    '''
+    try:
+      with metrics.span('kintone.flush'):
+        self.sender(records)
+    except Exception as e:
+      self.failed_batches += 1
+      if not is_permanent(e):
+        applog.warning('kintone', 'send_failed', exc_info=True,
+                       records=len(records), status=status_of(e), attempts=attempts + 1)
+        self._spool(records, attempts + 1)
+        return False
+      if len(records) == 1:
+        applog.error('kintone', 'record_rejected', exc_info=True, status=status_of(e))
+        self._dead_letter(records, 'rejected with status {}'.format(status_of(e)))
+        return True
+      half = len(records) // 2
+      ok = self._send(records[:half], attempts)
+      return self._send(records[half:], attempts) and ok
+    self.sent += len(records)
+    return True
+
+  def flush(self):
+    '''
+    ためているログをすべて送る
+    output: 一時的な失敗がなかったかどうか
+    '''
+    self._spool_overflow()
+    ok = True
+    while True:
+      records = self._take()
+      if len(records) == 0:
+        return ok
+      ok = self._send(records) and ok
+
+  def _spool_overflow(self):
+    with self._cond:
+      records = self._overflow
+      self._overflow = []
+    if len(records) > 0:
+      applog.warning('kintone', 'buffer_overflow', records=len(records))
+      self._spool(records, 0)
+
+  def _spool(self, records, attempts):
+    '''
+    スプールに追記 (1行1件のJSON. {'attempts': 送れなかった回数, 'record': レコード})
+    MAX_ATTEMPTS 回に達したものは dead letter に書く
+    '''
+    if attempts >= MAX_ATTEMPTS:
+      applog.error('kintone', 'gave_up', records=len(records), attempts=attempts)
+      self._dead_letter(records, 'gave up after {} attempts'.format(attempts))
+      return
+    if not self.spool_path:
+      applog.error('kintone', 'dropped', records=len(records))
+      self.dropped += len(records)
+      return
+    lines = ''.join(json.dumps({'attempts': attempts, 'record': r}, ensure_ascii=False) + '\n'
+                    for r in records)
+    with self._spool_lock:
+      with open(self.spool_path, 'a', encoding='utf-8') as f:
+        f.write(lines)
+        f.flush()
+        os.fsync(f.fileno())
+    self.spooled += len(records)
+
+  def _dead_letter(self, records, reason):
+    '''
+    送らないことにしたレコードを dead letter (スプールのパス + '.dead') に書く
+    '''
+    self.dead_lettered += len(records)
+    if not self.spool_path:
+      return
+    lines = ''.join(json.dumps({'reason': reason, 'record': r}, ensure_ascii=False) + '\n'
+                    for r in records)
+    with self._spool_lock:
+      with open(self.spool_path + '.dead', 'a', encoding='utf-8') as f:
+        f.write(lines)
+
+  def _claim_spool(self):
+    '''
+    送り直すファイルを名前を変えて確保する (ほかのプロセスと取り合わないように)
+    '''
+    claimed = []
+    mine = '{}.replay.{}'.format(self.spool_path, os.getpid())
+    if os.path.exists(mine):
+      claimed += [mine]
+    now = time.time()
+    if not self.spool_path:
+      return claimed
+    for path in glob.glob(self.spool_path + '.replay.*'):
+      if path == mine:
+        continue
+      try:
+        if now - os.path.getmtime(path) < REPLAY_STALE:
+          continue
+        target = '{}.{}'.format(mine, len(claimed))
+        os.rename(path, target)
+        claimed += [target]
+      except OSError:
+        continue
+    with self._spool_lock:
+      if os.path.exists(self.spool_path):
+        target = '{}.{}'.format(mine, len(claimed)) if len(claimed) > 0 else mine
+        try:
+          os.rename(self.spool_path, target)
+          claimed += [target]
+        except OSError:
+          pass
+    return claimed
+
+  @staticmethod
+  def _read_spool(path):
+    '''
+    スプールを読んで、送れなかった回数が同じ連続したレコードを BATCH_SIZE 件ずつにまとめる
+    output: [(送れなかった回数, レコードのリスト)]
+    '''
+    ret = []
+    with open(path, encoding='utf-8') as f:
+      for l in f:
+        if len(l.strip()) == 0:
+          continue
+        entry = json.loads(l)
+        if 'record' in entry and 'attempts' in entry:
+          attempts, record = entry['attempts'], entry['record']
+        else:
+          # 回数を持たない以前の形式
+          attempts, record = 0, entry
+        if len(ret) > 0 and ret[-1][0] == attempts and len(ret[-1][1]) < BATCH_SIZE:
+          ret[-1][1].append(record)
+        else:
+          ret += [(attempts, [record])]
+    return ret
+
+  def replay(self):
+    '''
+    スプールのログを送り直す
+    一時的な失敗があったら、残りは送らずにスプールに戻して次の機会にする
+    output: 送り直せた件数
+    '''
+    sent = self.sent
+    for path in self._claim_spool():
+      batches = self._read_spool(path)
+      for k, (attempts, batch) in enumerate(batches):
+        if not self._send(batch, attempts):
+          for _attempts, _batch in batches[k+1:]:
+            self._spool(_batch, _attempts)
+          os.remove(path)
+          self.replayed += self.sent - sent
+          return self.sent - sent
+      os.remove(path)
+    self.replayed += self.sent - sent
+    return self.sent - sent
+
+  def _run(self):
+    while True:
+      with self._cond:
+        if len(self._buffer) < BATCH_SIZE and len(self._overflow) == 0:
+          self._cond.wait(self.flush_interval)
+      try:
+        ok = self.flush()
+      except Exception:
+        # スプールに書けない (ディスクがいっぱいなど) ときも、スレッドは止めずに次の回で続ける
+        applog.error('kintone', 'flush_failed', exc_info=True)
+        ok = False
+      now = time.monotonic()
+      if ok and now - self._last_replay >= self.replay_interval:
+        self._last_replay = now
+        try:
+          self.replay()
+        except Exception:
+          applog.error('kintone', 'replay_failed', exc_info=True)
+
+  def stats(self):
+    return {
+      'buffered': len(self._buffer),
+      'queued': self.queued,
+      'sent': self.sent,
+      'failed_batches': self.failed_batches,
+      'spooled': self.spooled,
+      'replayed': self.replayed,
+      'dead_lettered': self.dead_lettered,
+      'dropped': self.dropped,
+    }
+
+logger = KintoneLogger()
+
+def log(source, send_text, sender):
+  '''
+  会話ログを記録
+  ASYNC のときはためておくだけで、すぐに戻る
+  '''
+  record = make_record(source, send_text, sender)
+  if ASYNC:
+    logger.log(record)
+  else:
+    post_record(record)
+
+async def log_async(source, send_text, sender):
+  '''
+  log の非同期版 (app_async.py 用)
+  ASYNC でないときも、送っている間はほかの会話を処理できる
+  '''
+  record = make_record(source, send_text, sender)
+  if ASYNC:
+    logger.log(record)
+    return
+  import http_client_async
+  data = {
+    "app": os.environ['CYBOZU_LOG_DB_APP_ID'],
+    "record": record,
+  }
+  await http_client_async.post(
+    http_client.upstream(os.environ['KINTONE_URL']), data=json.dumps(data).encode(), headers=_headers())
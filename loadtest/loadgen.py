@@ -0,0 +1,176 @@
+'''
+負荷試験のリクエスト生成
+署名つきの LINE webhook (/line_callback) と、RoBoHon の GET (/api/command/reference_talk) を
+決まったレートで送り、スループット・エラー率・レイテンシの分位点を表示する
+
+送る時刻は最初に決めておき、応答を待たずに送る (オープンループ)
+サーバが詰まると待ち時間もレイテンシに入るので、飽和点がそのまま見える
+
+使い方:
+  python loadtest/loadgen.py --target http://127.0.0.1:8000 --secret loadtest \
+    --rate 20 --duration 60 --line-ratio 0.8 --events 1
+'''
+
+import sys
+import argparse
+import base64
+import hashlib
+import hmac
+import json
+import os
+import random
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+UTTERANCES_PATH = os.path.join(
+  os.path.dirname(os.path.abspath(__file__)), '..', 'bench', 'fixtures', 'utterances.txt')
+
+def load_utterances(path=UTTERANCES_PATH):
+  with open(path, encoding='utf-8') as f:
+    return [l.strip() for l in f if len(l.strip()) > 0 and not l.startswith('#')]
+
+def sign(body, secret):
+  '''
+  X-Line-Signature (チャネルシークレットによる本文のHMAC-SHA256)
+  '''
+  digest = hmac.new(secret.encode('utf-8'), body, hashlib.sha256).digest()
+  return base64.b64encode(digest).decode('utf-8')
+
+def make_message_event(text):
+  '''
+  テキストメッセージイベント1件
+  '''
+  return {
+    'type': 'message',
+    'mode': 'active',
+    'timestamp': int(time.time() * 1000),
+    'source': {'type': 'user', 'userId': 'U' + uuid.uuid4().hex},
+    'webhookEventId': uuid.uuid4().hex.upper()[:26],
+    'deliveryContext': {'isRedelivery': False},
+    'replyToken': uuid.uuid4().hex,
+    'message': {'id': str(random.randint(10**17, 10**18)), 'type': 'text', 'text': text},
+  }
+
+def make_webhook_body(texts):
+  return json.dumps({
+    'destination': 'U' + '0' * 32,
+    'events': [make_message_event(t) for t in texts],
+  }, ensure_ascii=False).encode('utf-8')
+
+class Recorder:
+  '''
+  種類ごとのレイテンシと結果を集める
+  '''
+  def __init__(self):
+    self._lock = threading.Lock()
+    self.latency = {}
+    self.errors = {}
+
+  def add(self, kind, latency, ok):
+    with self._lock:
+      self.latency.setdefault(kind, []).append(latency)
+      self.errors.setdefault(kind, 0)
+      if not ok:
+        self.errors[kind] += 1
+
+  def report(self, elapsed):
+    ret = {}
+    with self._lock:
+      for kind, values in self.latency.items():
+        values = sorted(values)
+        n = len(values)
+        ret[kind] = {
+          'requests': n,
+          'throughput': n / elapsed,
+          'error_rate': self.errors[kind] / n,
+          'p50': values[int(n * 0.5)],
+          'p90': values[min(n - 1, int(n * 0.9))],
+          'p99': values[min(n - 1, int(n * 0.99))],
+          'max': values[-1],
+        }
+    return ret
+
+_local = threading.local()
+
+def _session():
+  if not hasattr(_local, 'session'):
+    _local.session = requests.Session()
+  return _local.session
+
+def send_line(target, secret, texts, timeout):
+  body = make_webhook_body(texts)
+  res = _session().post(
+    target + '/line_callback', data=body, timeout=timeout,
+    headers={'Content-Type': 'application/json', 'X-Line-Signature': sign(body, secret)})
+  return res.status_code == 200
+
+def send_robohon(target, text, timeout):
+  res = _session().get(
+    target + '/api/command/reference_talk', params={'content': text}, timeout=timeout)
+  return res.status_code == 200
+
+def run(target, secret, rate, duration, line_ratio=1.0, events=1, timeout=30.0,
+        max_inflight=256, utterances=None, recorder=None):
+  '''
+  rate (件/秒) で duration 秒送る
+  output: 種類ごとの集計
+  '''
+  utterances = utterances or load_utterances()
+  recorder = recorder or Recorder()
+  executor = ThreadPoolExecutor(max_workers=max_inflight)
+
+  def one(scheduled, kind):
+    ok = False
+    try:
+      if kind == 'line':
+        ok = send_line(target, secret, random.sample(utterances, events), timeout)
+      else:
+        ok = send_robohon(target, random.choice(utterances), timeout)
+    except requests.RequestException:
+      ok = False
+    # 予定時刻からの時間 (送信が遅れた分も含める)
+    recorder.add(kind, time.monotonic() - scheduled, ok)
+
+  started = time.monotonic()
+  n = int(rate * duration)
+  for i in range(n):
+    scheduled = started + i / rate
+    wait = scheduled - time.monotonic()
+    if wait > 0:
+      time.sleep(wait)
+    kind = 'line' if random.random() < line_ratio else 'robohon'
+    executor.submit(one, scheduled, kind)
+  executor.shutdown(wait=True)
+  return recorder.report(time.monotonic() - started)
+
+if __name__ == '__main__':
+  argparser = argparse.ArgumentParser(description='負荷試験のリクエスト生成')
+  argparser.add_argument('--target', default='http://127.0.0.1:8000')
+  argparser.add_argument('--secret', default=os.environ.get('LINE_CHANNEL_SECRET', 'loadtest'),
+                         help='LINE_CHANNEL_SECRET (アプリ側と同じもの)')
+  argparser.add_argument('--rate', type=float, default=10.0, help='1秒あたりのリクエスト数')
+  argparser.add_argument('--duration', type=float, default=30.0, help='送る時間 (秒)')
+  argparser.add_argument('--line-ratio', type=float, default=1.0,
+                         help='LINE webhook の割合 (残りは RoBoHon の GET)')
+  argparser.add_argument('--events', type=int, default=1, help='1回のwebhookに入れるイベント数')
+  argparser.add_argument('--timeout', type=float, default=30.0)
+  argparser.add_argument('--max-inflight', type=int, default=256, help='同時に待てるリクエスト数')
+  argparser.add_argument('--json', action='store_true', help='結果をJSONで出す')
+  args = argparser.parse_args()
+
+  report = run(args.target, args.secret, args.rate, args.duration,
+               line_ratio=args.line_ratio, events=args.events, timeout=args.timeout,
+               max_inflight=args.max_inflight)
+  if args.json:
+    print(json.dumps(report, indent=2))
+    sys.exit(0)
+  print('{:8s} {:>8s} {:>8s} {:>7s} {:>8s} {:>8s} {:>8s} {:>8s}'.format(
+    'kind', 'requests', 'req/s', 'error', 'p50', 'p90', 'p99', 'max'))
+  for kind, r in report.items():
+    print('{:8s} {:8d} {:8.1f} {:6.1f}% {:7.3f}s {:7.3f}s {:7.3f}s {:7.3f}s'.format(
+      kind, r['requests'], r['throughput'], r['error_rate'] * 100,
+      r['p50'], r['p90'], r['p99'], r['max']))
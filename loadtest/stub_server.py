@@ -0,0 +1,232 @@
+'''
+負荷試験用の外部APIの代役 (レファ協, wikipedia, LINE Messaging API, kintone)
+bench/fixtures の記録済みレスポンスを返す. 応答の遅れとエラーを混ぜられる
+
+アプリ側は REHATCH_STUB_UPSTREAM をこのサーバに向けると、すべての外部APIの代わりにここを使う
+(http_client.upstream. URLのパスはそのままで、ホストだけ置き換わる)
+
+使い方:
+  python loadtest/stub_server.py --port 8700 --latency 0.2 --jitter 0.1 --error-rate 0.01
+
+  REHATCH_STUB_UPSTREAM=http://127.0.0.1:8700 \
+  LINE_CHANNEL_ACCESS_TOKEN=dummy LINE_CHANNEL_SECRET=loadtest \
+  LINE_PUSH_DESTINATION=U0 KINTONE_URL=https://example.cybozu.com/k/v1/record.json \
+  CYBOZU_LOG_DB_API_TOKEN=dummy CYBOZU_LOG_DB_APP_ID=1 \
+  gunicorn -w 4 -b 127.0.0.1:8000 app:app
+  (非同期のサーバは gunicorn -b 127.0.0.1:8000 app_async:app --worker-class aiohttp.GunicornWebWorker)
+
+  curl http://127.0.0.1:8700/stats   # 受けたリクエストの数
+'''
+
+import sys
+import argparse
+import gzip
+import hashlib
+import json
+import os
+import random
+import re
+import threading
+import time
+import urllib.parse
+import xml.etree.ElementTree as ET
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+# wikipedia の概要の抽出だけ使うので、共有キャッシュとメトリクスのファイルは使わない
+os.environ.setdefault('REHATCH_SHARED_CACHE_PATH', '')
+os.environ.setdefault('REHATCH_METRICS_DIR', '')
+
+import wikipedia
+
+FIXTURE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'bench', 'fixtures')
+
+CRD_FIXTURES = ['crd_empty', 'crd_single', 'crd_small', 'crd_small', 'crd_page200']
+# レファ協APIで1回に取得できる件数の上限 (results_num)
+CRD_MAX_RESULTS = 200
+WIKI_FIXTURES = ['wiki_small', 'wiki_multi', 'wiki_multi', 'wiki_long']
+
+def load_fixture(name):
+  with gzip.open(os.path.join(FIXTURE_DIR, name + '.xml.gz')) as f:
+    return f.read()
+
+def make_extracts(body):
+  '''
+  wikipedia API (format=xml, prop=revisions) のレスポンスから、
+  prop=extracts (format=json, formatversion=2) のレスポンスを作る
+  '''
+  root = ET.fromstring(body)
+  pages = []
+  for page in root.iter('page'):
+    rev = page.find('revisions/rev')
+    if rev is None:
+      pages += [{'ns': 0, 'title': page.get('title'), 'missing': True}]
+      continue
+    text = rev.text or ''
+    pages += [{
+      'pageid': int(page.get('pageid')),
+      'ns': 0,
+      'title': page.get('title'),
+      'extract': wikipedia.make_summary(text),
+      'categories': [{'ns': 14, 'title': 'Category:' + x} for x in wikipedia.get_categories(text)],
+    }]
+    if wikipedia.is_not_enough(text):
+      pages[-1]['templates'] = [{'ns': 10, 'title': wikipedia.NOT_ENOUGH_TEMPLATE}]
+  redirects = [{'from': r.get('from'), 'to': r.get('to')} for r in root.iter('r')]
+  return json.dumps({'batchcomplete': True, 'query': {'redirects': redirects, 'pages': pages}},
+                    ensure_ascii=False).encode('utf-8')
+
+def split_results(body):
+  '''
+  レファ協APIのレスポンスを (ヒット件数, <result> 要素 (bytes) のリスト) に分ける
+  '''
+  hit_num = int(re.search(rb'<hit_num>(\d+)</hit_num>', body).group(1))
+  return hit_num, re.findall(rb'<result>.*?</result>\n', body, re.S)
+
+def make_crd_window(hit_num, results, position, num):
+  '''
+  results_get_position (1から) から results_num 件 (CRD_MAX_RESULTS 件まで) のレスポンス
+  記録済みの結果より後ろの位置 (ヒット件数まで) は、記録済みの結果を繰り返して埋める
+  '''
+  end = min(position + min(num, CRD_MAX_RESULTS), hit_num + 1) if len(results) > 0 else position
+  picked = [results[(p - 1) % len(results)] for p in range(position, end)]
+  return (b'<?xml version="1.0" encoding="UTF-8"?>\n<result_set>\n'
+          + b'<hit_num>%d</hit_num>\n' % hit_num
+          + b'<results_get_position>%d</results_get_position>\n' % position
+          + b'<results_num>%d</results_num>\n' % len(picked)
+          + b''.join(picked) + b'</result_set>\n')
+
+class Stats:
+  def __init__(self):
+    self._lock = threading.Lock()
+    self.counts = {}
+
+  def add(self, name):
+    with self._lock:
+      self.counts[name] = self.counts.get(name, 0) + 1
+
+  def snapshot(self):
+    with self._lock:
+      return dict(self.counts)
+
+class StubHandler(BaseHTTPRequestHandler):
+  protocol_version = 'HTTP/1.1'
+  disable_nagle_algorithm = True
+  # サーバの設定 (make_server で設定)
+  config = None
+  stats = None
+  crd = {}
+  crd_results = {}
+  wiki = {}
+  extracts = {}
+
+  def log_message(self, format, *args):
+    if self.config.verbose:
+      super().log_message(format, *args)
+
+  def _pick(self, names, query):
+    '''
+    クエリごとに同じレスポンスになるように選ぶ
+    '''
+    h = int.from_bytes(hashlib.blake2b(query.encode('utf-8'), digest_size=4).digest(), 'little')
+    return names[h % len(names)]
+
+  def _delay(self):
+    c = self.config
+    delay = c.latency + random.uniform(-c.jitter, c.jitter)
+    if c.slow_rate > 0 and random.random() < c.slow_rate:
+      delay += c.slow_latency
+    if delay > 0:
+      time.sleep(delay)
+
+  def _send(self, status, body, content_type):
+    self.send_response(status)
+    self.send_header('Content-Type', content_type)
+    self.send_header('Content-Length', str(len(body)))
+    self.end_headers()
+    self.wfile.write(body)
+
+  def _handle(self, method):
+    url = urllib.parse.urlsplit(self.path)
+    name = '{} {}'.format(method, url.path)
+    if method == 'POST':
+      length = int(self.headers.get('Content-Length') or 0)
+      self.rfile.read(length)
+    if url.path == '/stats':
+      return self._send(200, json.dumps(self.stats.snapshot()).encode(), 'application/json')
+    self.stats.add(name)
+
+    self._delay()
+    if self.config.error_rate > 0 and random.random() < self.config.error_rate:
+      self.stats.add('error ' + name)
+      return self._send(503, b'{"message":"injected error"}', 'application/json')
+
+    if method == 'GET' and url.path == '/api/refsearch':
+      # 同じ検索式には、取得する範囲 (results_num, results_get_position) によらず同じ記録を使う
+      params = urllib.parse.parse_qs(url.query)
+      fixture = self._pick(CRD_FIXTURES, params.get('query', [''])[0])
+      if 'results_num' in params or 'results_get_position' in params:
+        hit_num, results = self.crd_results[fixture]
+        body = make_crd_window(
+          hit_num, results, int(params.get('results_get_position', ['1'])[0]),
+          int(params.get('results_num', [str(CRD_MAX_RESULTS)])[0]))
+      else:
+        body = self.crd[fixture]
+      return self._send(200, body, 'application/xml; charset=utf-8')
+    if method == 'GET' and url.path == '/w/api.php':
+      fixture = self._pick(WIKI_FIXTURES, url.query)
+      if 'format=json' in url.query:
+        return self._send(200, self.extracts[fixture], 'application/json; charset=utf-8')
+      return self._send(200, self.wiki[fixture], 'text/xml; charset=utf-8')
+    if method == 'POST' and url.path.startswith('/v2/bot/message/'):
+      return self._send(200, b'{}', 'application/json')
+    if method == 'POST' and url.path == '/k/v1/record.json':
+      return self._send(200, b'{"id":"1","revision":"1"}', 'application/json')
+    if method == 'POST' and url.path == '/k/v1/records.json':
+      return self._send(200, b'{"ids":[],"revisions":[]}', 'application/json')
+    self.stats.add('unknown ' + name)
+    return self._send(404, b'{}', 'application/json')
+
+  def do_GET(self):
+    self._handle('GET')
+
+  def do_POST(self):
+    self._handle('POST')
+
+def make_server(host, port, config):
+  '''
+  スタブサーバを作る (serve_forever で起動)
+  '''
+  crd = {n: load_fixture(n) for n in set(CRD_FIXTURES)}
+  wiki = {n: load_fixture(n) for n in set(WIKI_FIXTURES)}
+  handler = type('Handler', (StubHandler,), {
+    'config': config,
+    'stats': Stats(),
+    'crd': crd,
+    'crd_results': {n: split_results(x) for n, x in crd.items()},
+    'wiki': wiki,
+    'extracts': {n: make_extracts(x) for n, x in wiki.items()},
+  })
+  server = ThreadingHTTPServer((host, port), handler)
+  server.daemon_threads = True
+  return server
+
+if __name__ == '__main__':
+  argparser = argparse.ArgumentParser(description='負荷試験用の外部APIの代役')
+  argparser.add_argument('--host', default='127.0.0.1')
+  argparser.add_argument('--port', type=int, default=8700)
+  argparser.add_argument('--latency', type=float, default=0.0, help='応答の遅れ (秒)')
+  argparser.add_argument('--jitter', type=float, default=0.0, help='遅れのばらつき (秒, ±)')
+  argparser.add_argument('--slow-rate', type=float, default=0.0, help='とても遅い応答の割合')
+  argparser.add_argument('--slow-latency', type=float, default=5.0, help='とても遅い応答の遅れ (秒)')
+  argparser.add_argument('--error-rate', type=float, default=0.0, help='503を返す割合')
+  argparser.add_argument('--verbose', action='store_true', help='リクエストごとにログを出す')
+  args = argparser.parse_args()
+
+  server = make_server(args.host, args.port, args)
+  print('stub upstream: http://{}:{}'.format(args.host, args.port))
+  try:
+    server.serve_forever()
+  except KeyboardInterrupt:
+    pass
@@ -4,10 +4,41 @@ import re
 import json
 import os
 import random
+import time
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeoutError
 
 from text_utils import get_keywords, shorten_text, make_voice
 import refkyo
 import wikipedia
+import metrics
+import applog
+import breaker
+import http_client
+
+# 各種データベースへの問い合わせ先モジュール. key は dataset のキー
+SOURCES = {
+  'wiki': wikipedia,
+  'ref': refkyo,
+}
+
+# 各データベースへの問い合わせを並列に投げるかどうか
+PARALLEL = os.environ.get('REHATCH_PARALLEL_FETCH', '1') != '0'
+
+# 各データベースを待つ時間の上限 (秒). 過ぎたら空として、もう片方のデータだけで返答する
+# 例 REHATCH_FETCH_DEADLINES='ref=4,wiki=3'
+DEFAULT_DEADLINE = float(os.environ.get('REHATCH_FETCH_DEADLINE', '5'))
+DEADLINES = {k.strip(): float(v) for k, v in (
+  x.split('=', 1) for x in os.environ.get('REHATCH_FETCH_DEADLINES', '').split(',') if '=' in x)}
+
+def deadline_of(name):
+  return DEADLINES.get(name, DEFAULT_DEADLINE)
+
+# 問い合わせ用のスレッドプール. データベースごとに分ける (プロセス内で共有)
+# 片方が応答しなくなってスレッドが埋まっても、もう片方の問い合わせは待たされない
+FETCH_WORKERS = int(os.environ.get('REHATCH_FETCH_WORKERS', '4'))
+_executors = {
+  name: ThreadPoolExecutor(max_workers=FETCH_WORKERS, thread_name_prefix='rehatch-fetch-' + name)
+  for name in SOURCES}
 
 def make_wait_res():
   '''
@@ -367,12 +398,134 @@ def make_response(keywords, dataset):
   
   return None
 
-def get_response(text, debug=False):
+def _fetch_failed(name, error):
+  if isinstance(error, breaker.CircuitOpenError):
+    # ブレーカーが開いているので問い合わせなかった (breaker.py)
+    applog.warning('message', 'circuit_open', source=name, host=error.name)
+  elif isinstance(error, http_client.DeadlineExceeded):
+    # 期限を過ぎたので次の問い合わせをしなかった (期限切れは _deadline_exceeded で記録済み)
+    applog.debug('message', 'fetch_abandoned', source=name)
+  else:
+    applog.error('message', 'fetch_failed', exc_info=True, source=name)
+
+def _deadline_exceeded(name):
+  metrics.inc('rehatch_fetch_deadline_exceeded_total', source=name)
+  applog.warning('message', 'deadline_exceeded', source=name, deadline=deadline_of(name))
+
+def cache_stats():
+  '''
+  各データベースの抽出済みデータのキャッシュのヒット/ミス/追い出し回数
+  '''
+  return {name: source.cache_stats() for name, source in SOURCES.items()}
+
+def choose_hits(data):
+  '''
+  各データの 'hit' (ヒットしたキーワード) を 'hits' (候補) からランダムに選ぶ
+  データはキャッシュされるので、選ぶのは取得したあと (問い合わせごとに選び直す)
+  キャッシュの中のデータは書き換えずにコピーする
+  '''
+  ret = []
+  for d in data:
+    if 'hits' in d:
+      d = dict(d, hit=None if len(d['hits'])==0 else random.choice(d['hits']))
+    ret += [d]
+  return ret
+
+def fetch_source(name, keywords, debug=False, deadline=None):
+  '''
+  1つのデータベースからデータを取得
+  deadline (time.monotonic() の値) があれば、HTTPの問い合わせ (リトライも含めて) をそれまでに打ち切る
+  失敗したときは空リストを返す (もう片方のデータベースだけで返答できるように)
+  '''
+  try:
+    with metrics.span('fetch', source=name), http_client.deadline(deadline):
+      return choose_hits(SOURCES[name].access_db_to_data(keywords, debug=debug))
+  except Exception as e:
+    _fetch_failed(name, e)
+    return []
+
+def _submit_source(name, keywords, debug, deadline):
+  return _executors[name].submit(applog.bind(fetch_source), name, keywords, debug, deadline)
+
+def _wait_source(name, future, deadline):
+  '''
+  deadline (time.monotonic() の値) まで結果を待つ. 間に合わなければ空リスト
+  まだ始まっていない問い合わせは取り消す (始まったものも deadline で打ち切られる)
+  '''
+  try:
+    return future.result(timeout=max(0, deadline - time.monotonic()))
+  except FutureTimeoutError:
+    future.cancel()
+    _deadline_exceeded(name)
+    return []
+
+def fetch_dataset(keywords, parallel=None, debug=False):
+  '''
+  各種データベースからデータ抽出
+  データベースごとに deadline_of(name) 秒まで待ち、間に合わなかったものは空として扱う
+  input:
+    - keywords: キーワードリスト (unicode)
+    - parallel: 並列に問い合わせるかどうか. Noneのとき PARALLEL に従う
+    - debug: 中間結果を表示するかどうか (bool)
+  output: {'ref':レファレンスデータ, 'wiki':wikipediaデータ}
+  '''
+  if parallel is None:
+    parallel = PARALLEL
+  
+  if not parallel:
+    # 1つずつ問い合わせる (それぞれの期限は問い合わせを始めてから数える)
+    ret = {}
+    for name in SOURCES:
+      deadline = time.monotonic() + deadline_of(name)
+      ret[name] = _wait_source(name, _submit_source(name, keywords, debug, deadline), deadline)
+    return ret
+  
+  # 全データベースに同時に問い合わせ、期限までにそろったものを使う
+  started = time.monotonic()
+  deadlines = {name: started + deadline_of(name) for name in SOURCES}
+  futures = {name: _submit_source(name, keywords, debug, deadlines[name]) for name in SOURCES}
+  return {name: _wait_source(name, f, deadlines[name]) for name, f in futures.items()}
+
+async def fetch_source_async(name, keywords, debug=False, deadline=None):
+  '''
+  fetch_source の非同期版
+  '''
+  try:
+    with metrics.span('fetch', source=name), http_client.deadline(deadline):
+      return choose_hits(await SOURCES[name].access_db_to_data_async(keywords, debug=debug))
+  except Exception as e:
+    _fetch_failed(name, e)
+    return []
+
+async def _wait_source_async(name, keywords, debug=False):
+  import asyncio
+  # 期限を過ぎて打ち切られるまでは問い合わせを続け、終わればキャッシュに入る
+  deadline = time.monotonic() + deadline_of(name)
+  task = asyncio.get_running_loop().create_task(
+    fetch_source_async(name, keywords, debug=debug, deadline=deadline))
+  try:
+    return await asyncio.wait_for(asyncio.shield(task), deadline_of(name))
+  except asyncio.TimeoutError:
+    _deadline_exceeded(name)
+    return []
+
+async def fetch_dataset_async(keywords, debug=False):
+  '''
+  fetch_dataset の非同期版. 全データベースに同時に問い合わせ、期限までにそろったものを使う
+  '''
+  import asyncio
+  names = list(SOURCES)
+  results = await asyncio.gather(*[_wait_source_async(name, keywords, debug=debug) for name in names])
+  return dict(zip(names, results))
+
+@metrics.timed('get_response')
+def get_response(text, debug=False, parallel=None):
   '''
   入力から返答を作成
   input:
     - text: ユーザ入力文 (unicode)
     - debug: 中間結果を表示するかどうか (bool)
+    - parallel: データベースに並列に問い合わせるかどうか. Noneのとき PARALLEL に従う
   output: 会話文のリスト [文, 文, ...]
     - 文: dict. key='t' or 'v'. val=返答文.
       - 't': text. text modeのみの返答
@@ -387,21 +540,42 @@ def get_response(text, debug=False):
     print()
   
   # キーワードを抽出
-  keywords = get_keywords(text)
+  with metrics.span('get_keywords'):
+    keywords = get_keywords(text)
   if debug:
     print('keywords: {}'.format(keywords))
     print()
+  applog.debug('message', 'keywords', keywords=keywords)
   
   # 各種データベースからデータ抽出
-  dataset = {}
-  dataset['wiki'] = wikipedia.access_db_to_data(keywords)
-  dataset['ref'] = refkyo.access_db_to_data(keywords)
+  dataset = fetch_dataset(keywords, parallel=parallel)
   
   # データもとにレスポンス作成
-  res = make_response(keywords, dataset)
+  with metrics.span('make_response'):
+    res = make_response(keywords, dataset)
+  applog.debug('message', 'response', hits={name: len(d) for name, d in dataset.items()},
+               sentences=len(res))
   
   return res
 
+async def get_response_async(text, debug=False):
+  '''
+  get_response の非同期版 (app_async.py 用)
+  データベースに問い合わせている間は、ほかの会話を処理できる
+  '''
+  with metrics.span('get_response'):
+    with metrics.span('get_keywords'):
+      keywords = get_keywords(text)
+    applog.debug('message', 'keywords', keywords=keywords)
+    
+    dataset = await fetch_dataset_async(keywords, debug=debug)
+    
+    with metrics.span('make_response'):
+      res = make_response(keywords, dataset)
+    applog.debug('message', 'response', hits={name: len(d) for name, d in dataset.items()},
+                 sentences=len(res))
+  return res
+
 def test(text):
   res = get_response(text, debug=True)
   for r in res:
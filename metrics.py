@@ -0,0 +1,256 @@
+'''
+処理段階ごとのレイテンシとエラーの計測 (Prometheus のテキスト形式で出力)
+
+- span(stage): with で囲んだ処理の時間をヒストグラムに記録. 例外のときはエラー数も数える
+- timed(stage): 関数全体を span で囲むデコレータ
+- observe / inc: ヒストグラム・カウンタに直接記録
+
+gunicornの各ワーカーは自分の値を REHATCH_METRICS_DIR にファイルとして定期的に書き出し、
+/metrics ではすべてのワーカーのファイルを足し合わせて返す
+(REHATCH_METRICS_DIR を空にすると、そのワーカーの値だけ返す)
+終了したワーカーのファイルも合計に残るので、サーバを起動しなおすときはディレクトリを空にする
+'''
+
+import functools
+import inspect
+import json
+import os
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
+
+import applog
+
+METRICS_DIR = os.environ.get(
+  'REHATCH_METRICS_DIR', os.path.join(tempfile.gettempdir(), 'rehatch_metrics'))
+FLUSH_INTERVAL = float(os.environ.get('REHATCH_METRICS_FLUSH_INTERVAL', '5'))
+
+# ヒストグラムのバケット (秒)
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+HELP = {
+  'rehatch_stage_seconds': '処理段階ごとの所要時間',
+  'rehatch_stage_errors_total': '処理段階ごとの例外の数',
+  'rehatch_upstream_seconds': '外部APIへのリクエストの所要時間',
+  'rehatch_upstream_errors_total': '外部APIへのリクエストの失敗数',
+  'rehatch_request_seconds': 'エンドポイントごとの応答時間',
+  'rehatch_requests_total': 'エンドポイントごとのリクエスト数',
+  'rehatch_fetch_deadline_exceeded_total': '期限までに取得できず、空として返答したデータベースの数',
+  'rehatch_breaker_transitions_total': 'サーキットブレーカーの状態が変わった数 (変わった先の状態ごと)',
+  'rehatch_breaker_rejected_total': 'サーキットブレーカーが開いていて問い合わせなかった数',
+  'rehatch_singleflight_total': '外部APIへの問い合わせの数 (leader) と、進行中の問い合わせに合流した数 (coalesced)',
+}
+
+def _labels(labels):
+  return tuple(sorted((k, str(v)) for k, v in labels.items()))
+
+class Registry:
+  '''
+  プロセス内のカウンタとヒストグラム
+  '''
+  def __init__(self, buckets=BUCKETS):
+    self.buckets = buckets
+    self._lock = threading.Lock()
+    self._counters = {}
+    # (名前, ラベル) → [バケットごとの数..., 合計, 件数]
+    self._histograms = {}
+
+  def inc(self, name, value=1, **labels):
+    key = (name, _labels(labels))
+    with self._lock:
+      self._counters[key] = self._counters.get(key, 0) + value
+
+  def observe(self, name, value, **labels):
+    key = (name, _labels(labels))
+    with self._lock:
+      h = self._histograms.get(key)
+      if h is None:
+        h = [0] * (len(self.buckets) + 2)
+        self._histograms[key] = h
+      for i, b in enumerate(self.buckets):
+        if value <= b:
+          h[i] += 1
+          break
+      h[-2] += value
+      h[-1] += 1
+
+  def snapshot(self):
+    '''
+    JSONにできる形の値
+    '''
+    with self._lock:
+      return {
+        'buckets': list(self.buckets),
+        'counters': [[name, [list(x) for x in labels], value]
+                     for (name, labels), value in self._counters.items()],
+        'histograms': [[name, [list(x) for x in labels], list(h)]
+                       for (name, labels), h in self._histograms.items()],
+      }
+
+registry = Registry()
+
+def inc(name, value=1, **labels):
+  _ensure_flusher()
+  registry.inc(name, value, **labels)
+
+def observe(name, value, **labels):
+  _ensure_flusher()
+  registry.observe(name, value, **labels)
+
+@contextmanager
+def span(stage, **labels):
+  '''
+  with span('get_keywords'): ... の処理時間を rehatch_stage_seconds に記録
+  '''
+  started = time.monotonic()
+  try:
+    yield
+  except BaseException:
+    inc('rehatch_stage_errors_total', stage=stage, **labels)
+    raise
+  finally:
+    observe('rehatch_stage_seconds', time.monotonic() - started, stage=stage, **labels)
+
+def timed(stage, **labels):
+  '''
+  関数全体を span で囲むデコレータ (async def の関数にも使える)
+  '''
+  def decorator(fn):
+    if inspect.iscoroutinefunction(fn):
+      @functools.wraps(fn)
+      async def async_wrapper(*args, **kwargs):
+        with span(stage, **labels):
+          return await fn(*args, **kwargs)
+      return async_wrapper
+    @functools.wraps(fn)
+    def wrapper(*args, **kwargs):
+      with span(stage, **labels):
+        return fn(*args, **kwargs)
+    return wrapper
+  return decorator
+
+def _snapshot_path(pid=None):
+  return os.path.join(METRICS_DIR, 'metrics.{}.json'.format(pid or os.getpid()))
+
+def write_snapshot():
+  '''
+  このワーカーの値をファイルに書き出す
+  '''
+  if not METRICS_DIR:
+    return
+  os.makedirs(METRICS_DIR, exist_ok=True)
+  path = _snapshot_path()
+  with open(path + '.tmp', 'w') as f:
+    json.dump(registry.snapshot(), f)
+  os.replace(path + '.tmp', path)
+
+_flusher_pid = None
+_flusher_lock = threading.Lock()
+
+def _flush_loop():
+  while True:
+    time.sleep(FLUSH_INTERVAL)
+    try:
+      write_snapshot()
+    except OSError:
+      applog.error('metrics', 'snapshot_failed', exc_info=True)
+
+def _ensure_flusher():
+  '''
+  書き出し用のスレッドを起動 (fork後のワーカーごとに1つ)
+  '''
+  global _flusher_pid
+  if not METRICS_DIR or _flusher_pid == os.getpid():
+    return
+  with _flusher_lock:
+    if _flusher_pid == os.getpid():
+      return
+    _flusher_pid = os.getpid()
+    threading.Thread(target=_flush_loop, name='metrics-flush', daemon=True).start()
+
+def load_snapshots():
+  '''
+  すべてのワーカーの値 (自分の分は最新の値)
+  '''
+  ret = [registry.snapshot()]
+  if not METRICS_DIR or not os.path.isdir(METRICS_DIR):
+    return ret
+  mine = os.path.basename(_snapshot_path())
+  for name in os.listdir(METRICS_DIR):
+    if not name.endswith('.json') or name == mine:
+      continue
+    try:
+      with open(os.path.join(METRICS_DIR, name)) as f:
+        ret += [json.load(f)]
+    except (OSError, ValueError):
+      continue
+  return ret
+
+def merge(snapshots):
+  '''
+  ワーカーごとの値を足し合わせる
+  output: (カウンタ {(名前, ラベル): 値}, ヒストグラム {(名前, ラベル): [...]})
+  '''
+  counters = {}
+  histograms = {}
+  for s in snapshots:
+    if tuple(s['buckets']) != BUCKETS:
+      continue # バケットの設定が違う古いファイル
+    for name, labels, value in s['counters']:
+      key = (name, tuple(tuple(x) for x in labels))
+      counters[key] = counters.get(key, 0) + value
+    for name, labels, h in s['histograms']:
+      key = (name, tuple(tuple(x) for x in labels))
+      if key not in histograms:
+        histograms[key] = [0] * len(h)
+      histograms[key] = [a + b for a, b in zip(histograms[key], h)]
+  return counters, histograms
+
+def _format_labels(labels, extra=()):
+  items = list(labels) + list(extra)
+  if len(items) == 0:
+    return ''
+  return '{' + ','.join('{}="{}"'.format(
+    k, str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')) for k, v in items) + '}'
+
+def _format_value(v):
+  return repr(float(v)) if isinstance(v, float) else str(v)
+
+def render(counters, histograms):
+  '''
+  Prometheus のテキスト形式
+  '''
+  lines = []
+  names = sorted(set(k[0] for k in counters) | set(k[0] for k in histograms))
+  for name in names:
+    kind = 'counter' if any(k[0] == name for k in counters) else 'histogram'
+    if name in HELP:
+      lines += ['# HELP {} {}'.format(name, HELP[name])]
+    lines += ['# TYPE {} {}'.format(name, kind)]
+    if kind == 'counter':
+      for (n, labels), value in sorted(counters.items()):
+        if n == name:
+          lines += ['{}{} {}'.format(name, _format_labels(labels), _format_value(value))]
+      continue
+    for (n, labels), h in sorted(histograms.items()):
+      if n != name:
+        continue
+      total = 0
+      for b, count in zip(BUCKETS, h):
+        total += count
+        lines += ['{}_bucket{} {}'.format(name, _format_labels(labels, [('le', repr(b))]), total)]
+      lines += ['{}_bucket{} {}'.format(name, _format_labels(labels, [('le', '+Inf')]), h[-1])]
+      lines += ['{}_sum{} {}'.format(name, _format_labels(labels), repr(float(h[-2])))]
+      lines += ['{}_count{} {}'.format(name, _format_labels(labels), h[-1])]
+  return '\n'.join(lines) + '\n'
+
+def collect():
+  '''
+  全ワーカーを足し合わせた値 (Prometheus のテキスト形式)
+  '''
+  try:
+    write_snapshot()
+  except OSError:
+    applog.error('metrics', 'snapshot_failed', exc_info=True)
+  return render(*merge(load_snapshots()))
@@ -1,40 +1,242 @@
 import sys
+import io
 import argparse
 import re
 import json
 import os
-from urllib import request as req
 import random
-import xmltodict
 import urllib.parse
-import requests
 
-def make_url(keywords, serch_type="question"):
+import http_client
+import cache
+import shared_cache
+import xml_stream
+import metrics
+import singleflight
+
+# 抽出済みデータのキャッシュ
+_cache = cache.TTLCache(
+  maxsize=int(os.environ.get('REHATCH_CACHE_REF_SIZE', '512')),
+  ttl=float(os.environ.get('REHATCH_CACHE_REF_TTL', '21600')),
+  name='ref')
+# ワーカー間の共有キャッシュ (古くなっても max_stale の間は返して裏で更新)
+_shared = shared_cache.make_shared_cache(
+  'ref',
+  ttl=float(os.environ.get('REHATCH_SHARED_CACHE_REF_TTL', '21600')),
+  max_stale=float(os.environ.get('REHATCH_SHARED_CACHE_REF_MAX_STALE', '604800')))
+
+ROOT_URL = http_client.upstream("https://crd.ndl.go.jp/api/refsearch")
+
+# 同じURLへの同時の問い合わせを1つにまとめる
+_flight = singleflight.Group('ref')
+
+# データ取得元. 'api': レファ協API, 'mirror': ローカルの全文検索インデックス (crd_mirror.py)
+BACKEND = os.environ.get('REHATCH_REF_BACKEND', 'api')
+
+# APIから取得する件数. 0 のときは以前と同じく既定の1ページ分 (ヒット件数が多いほど転送とパースが重い)
+# 1以上のとき、検索結果をこの件数ずつの窓に区切り、呼び出しごとにランダムに選んだ窓だけを取得する
+# (make_ref_res は1件しか使わないので、ランダムさを保ったまま通信とパースの量が一定になる)
+# ヒット件数は _hit_nums に、窓は窓ごとに _cache / _shared にキャッシュする
+# APIで1回に取得できるのは MAX_RESULTS_NUM 件までなので、それより大きい値は MAX_RESULTS_NUM にする
+# (大きいままだと返る件数が窓より少なくなり、pick_window の窓の数とずれる)
+MAX_RESULTS_NUM = 200
+SAMPLE_WINDOW = min(int(os.environ.get('REHATCH_REF_SAMPLE_WINDOW', '0')), MAX_RESULTS_NUM)
+# ヒット件数のキャッシュ (検索式 → 件数). 件数はゆっくりしか変わらない
+_hit_nums = cache.TTLCache(
+  maxsize=int(os.environ.get('REHATCH_CACHE_REF_HITS_SIZE', '2048')),
+  ttl=float(os.environ.get('REHATCH_CACHE_REF_HITS_TTL', '86400')),
+  name='ref_hits')
+
+def make_query_url(query, **params):
   '''
-  レファレンス協同DBに投げるクエリ作成
+  レファレンス協同DBに投げる検索式からURL作成
+  params: results_num などの追加パラメータ
   '''
-  root_url = "https://crd.ndl.go.jp/api/refsearch"
-  query = '{} any {}'.format(serch_type, ' '.join(keywords))
   url = '{}?type=reference&query={}'.format(
-    root_url, urllib.parse.quote(query))
+    ROOT_URL, urllib.parse.quote(query))
+  for k, v in params.items():
+    url += '&{}={}'.format(k, urllib.parse.quote(str(v)))
   return url
 
-def db_access(query):
+def make_query(keywords, serch_type="question"):
   '''
-  レファレンス協同DBにクエリ投げる
+  レファレンス協同DBに投げる検索式
+  '''
+  return '{} any {}'.format(serch_type, ' '.join(keywords))
+
+def make_url(keywords, serch_type="question"):
+  '''
+  レファレンス協同DBに投げるクエリ作成
   '''
-  results = requests.get(query)
-  results = xmltodict.parse(results.text)
+  return make_query_url(make_query(keywords, serch_type))
+
+def make_count_url(query):
+  '''
+  ヒット件数を調べるクエリ (1件だけ取得)
+  '''
+  return make_query_url(query, results_num=1)
+
+def make_window_url(query, page, window=None):
+  '''
+  page 番目 (0から) の窓の window 件を取得するクエリ
+  '''
+  window = window or SAMPLE_WINDOW
+  return make_query_url(query, results_num=window, results_get_position=page * window + 1)
+
+# <system> の中で取り出す項目 (lib-name 以外は crd_mirror の差分同期用)
+SYSTEM_FIELDS = ('lib-name', 'reg-date', 'lst-date')
+
+def project_result(elem):
+  '''
+  <result> 要素から parse_result で使う項目だけを、xmltodictと同じ形で取り出す
+  '''
+  ref = {}
+  keywords = []
+  reference = xml_stream.find_child(elem, 'reference')
+  for child in ([] if reference is None else reference):
+    name = xml_stream.local_name(child.tag)
+    if name in ('question', 'answer', 'url'):
+      ref[name] = xml_stream.text_of(child)
+    elif name == 'keyword':
+      keywords += [xml_stream.text_of(child)]
+    elif name == 'system':
+      ref['system'] = {}
+      for c in child:
+        n = xml_stream.local_name(c.tag)
+        if n in SYSTEM_FIELDS:
+          ref['system'][n] = xml_stream.text_of(c)
+  # keyword は xmltodict と同じく 1つなら文字列, 複数ならリスト
+  if len(keywords) == 1:
+    ref['keyword'] = keywords[0]
+  elif len(keywords) > 1:
+    ref['keyword'] = keywords
+  return {'reference': ref}
+
+def parse_page_stream(fp):
+  '''
+  レスポンスを受信しながらパース
+  output: (ヒット件数, 検索結果のリスト)
+  '''
+  hit_num = 0
+  ret = []
+  for name, elem in xml_stream.iter_end(fp, ('hit_num', 'result'), ('result',)):
+    if name == 'hit_num':
+      hit_num = int(xml_stream.text_of(elem) or 0)
+    else:
+      ret += [project_result(elem)]
+  return hit_num, ret
+
+def parse_page_dom(text):
+  '''
+  レスポンス全体をxmltodictでパース
+  output: (ヒット件数, 検索結果のリスト)
+  '''
+  # xmltodict は読み込みに時間がかかるので、使うときに読み込む
+  import xmltodict
+  results = xmltodict.parse(text)
   # print(results)
   results = results['result_set']
+  hit_num = int(results.get('hit_num') or 0)
   if 'result' in results:
     ret = results['result']
     if isinstance(ret, list):
-      return ret
+      return hit_num, ret
     else:
-      return [ret]
+      return hit_num, [ret]
   else:
-    return []
+    return hit_num, []
+
+def db_access_page(query):
+  '''
+  レファレンス協同DBにクエリ投げる
+  同じURLの問い合わせが進行中なら、その結果を待って共有する
+  output: (ヒット件数, 検索結果のリスト)
+  '''
+  return _flight.do(singleflight.normalize_url(query), _db_access_page, query)
+
+def _db_access_page(query):
+  if xml_stream.PARSER == 'stream':
+    with http_client.get(query, stream=True) as res:
+      return parse_page_stream(xml_stream.open_stream(res))
+  results = http_client.get(query)
+  return parse_page_dom(results.text)
+
+def db_access(query):
+  '''
+  レファレンス協同DBにクエリ投げる
+  '''
+  return db_access_page(query)[1]
+
+class EmptyWindow(Exception):
+  '''
+  窓が空だった (キャッシュしたヒット件数より実際の件数が減った)
+  '''
+
+def hit_count(query):
+  '''
+  検索式のヒット件数. キャッシュになければ1件だけ問い合わせて調べる
+  '''
+  hit_num = _hit_nums.get(query)
+  if hit_num is None:
+    hit_num = db_access_page(make_count_url(query))[0]
+    _hit_nums.set(query, hit_num)
+  return hit_num
+
+def pick_window(hit_num):
+  '''
+  ランダムに選んだ窓の番号 (ヒットしないときは None)
+  '''
+  if hit_num <= 0:
+    return None
+  return random.randrange((hit_num + SAMPLE_WINDOW - 1) // SAMPLE_WINDOW)
+
+def use_window():
+  '''
+  窓ごとに取得するかどうか (ローカルのインデックスを使うときは使わない)
+  '''
+  if SAMPLE_WINDOW <= 0:
+    return False
+  if BACKEND == 'mirror':
+    import crd_mirror
+    return not crd_mirror.available()
+  return True
+
+def load_window(keywords, page, debug=False):
+  '''
+  page 番目の窓を取得して、入力から返答を作成
+  窓が空のときは EmptyWindow (キャッシュさせない)
+  '''
+  url = make_window_url(make_query(keywords), page)
+  if debug:
+    print('url: {}'.format(url))
+    print()
+  results = db_access(url)
+  if len(results) == 0:
+    raise EmptyWindow(url)
+  with metrics.span('parse_result', source='ref'):
+    return [parse_result(keywords, x) for x in results]
+
+def search(keywords, debug=False):
+  '''
+  BACKEND に従って検索結果を取得
+  ローカルのインデックスがないときはAPIに問い合わせる
+  '''
+  if BACKEND == 'mirror':
+    import crd_mirror
+    if crd_mirror.available():
+      return crd_mirror.search(keywords)
+    if debug:
+      print('crd mirror not found: {}'.format(crd_mirror.DB_PATH))
+      print()
+  
+  # DBのクエリ文 (URL) を作成
+  url = make_url(keywords)
+  if debug:
+    print('url: {}'.format(url))
+    print()
+  
+  # DBにクエリを投げる
+  return db_access(url)
 
 def parse_result(keywords, result):
   '''
@@ -45,13 +247,12 @@ def parse_result(keywords, result):
   output: 辞書データ
   '''
   
-  # ヒットしたキーワード
-  hit = None
+  # ヒットしたキーワードの候補 (どれにするかは返答を作るときに選ぶ. message.choose_hits)
+  hits = []
   if 'keyword' in result['reference']:
     _kws = [] if result['reference']['keyword'] is None else result['reference']['keyword']
     hits = [x for x in keywords
             if len([y for y in _kws if x in y])>0]
-    hit = None if len(hits)==0 else random.choice(hits)
   # 質問
   question = re.sub(r"\s", " ", result['reference']['question']).strip()
   # 回答
@@ -62,7 +263,7 @@ def parse_result(keywords, result):
   qurl = re.sub("\s", " ", result['reference']['url']).strip()
   
   ref_data = {
-    'hit': hit,
+    'hits': hits,
     'question': question,
     'answer': answer,
     'lib': lib,
@@ -72,7 +273,124 @@ def parse_result(keywords, result):
 
 def access_db_to_data(keywords, debug=False):
   '''
-  入力から返答を作成
+  入力から返答を作成 (キャッシュつき)
+  input:
+    - keywords: キーワードリスト (unicode)
+    - debug: 中間結果を表示するかどうか (bool)
+  output: レファレンス事例ページデータ (dict) のリスト
+  '''
+  if use_window():
+    return access_window(keywords, debug=debug)
+  return cache.cached_data(_cache, keywords, load_data, debug=debug, shared=_shared)
+
+def access_window(keywords, debug=False):
+  '''
+  ランダムに選んだ窓から返答を作成 (窓ごとにキャッシュ)
+  窓が空だったときは、ヒット件数を調べ直して1回だけやり直す
+  '''
+  query = make_query(keywords)
+  for _ in range(2):
+    page = pick_window(hit_count(query))
+    if page is None:
+      return []
+    try:
+      return cache.cached_data(
+        _cache, keywords, lambda kw, debug=False, page=page: load_window(kw, page, debug),
+        debug=debug, shared=_shared, variant=('window', SAMPLE_WINDOW, page))
+    except EmptyWindow:
+      _hit_nums.delete(query)
+  return []
+
+async def access_db_to_data_async(keywords, debug=False):
+  '''
+  access_db_to_data の非同期版 (app_async.py 用)
+  '''
+  if use_window():
+    return await access_window_async(keywords, debug=debug)
+  return await cache.cached_data_async(
+    _cache, keywords, load_data_async, load_data, debug=debug, shared=_shared)
+
+async def db_access_page_async(query):
+  '''
+  db_access_page の非同期版. 受信し終わってからパースする
+  output: (ヒット件数, 検索結果のリスト)
+  '''
+  import http_client_async
+  body = await _flight.do_async(
+    singleflight.normalize_url(query), lambda: http_client_async.get(query))
+  if xml_stream.PARSER == 'stream':
+    return parse_page_stream(io.BytesIO(body))
+  return parse_page_dom(body.decode('utf-8'))
+
+async def db_access_async(query):
+  '''
+  db_access の非同期版
+  '''
+  return (await db_access_page_async(query))[1]
+
+async def hit_count_async(query):
+  '''
+  hit_count の非同期版
+  '''
+  hit_num = _hit_nums.get(query)
+  if hit_num is None:
+    hit_num = (await db_access_page_async(make_count_url(query)))[0]
+    _hit_nums.set(query, hit_num)
+  return hit_num
+
+async def load_window_async(keywords, page, debug=False):
+  '''
+  load_window の非同期版
+  '''
+  results = await db_access_async(make_window_url(make_query(keywords), page))
+  if len(results) == 0:
+    raise EmptyWindow(page)
+  with metrics.span('parse_result', source='ref'):
+    return [parse_result(keywords, x) for x in results]
+
+async def access_window_async(keywords, debug=False):
+  '''
+  access_window の非同期版
+  '''
+  query = make_query(keywords)
+  for _ in range(2):
+    page = pick_window(await hit_count_async(query))
+    if page is None:
+      return []
+    try:
+      return await cache.cached_data_async(
+        _cache, keywords, lambda kw, debug=False, page=page: load_window_async(kw, page, debug),
+        lambda kw, debug=False, page=page: load_window(kw, page, debug),
+        debug=debug, shared=_shared, variant=('window', SAMPLE_WINDOW, page))
+    except EmptyWindow:
+      _hit_nums.delete(query)
+  return []
+
+async def load_data_async(keywords, debug=False):
+  '''
+  load_data の非同期版 (APIに問い合わせている間はほかの会話を処理できる)
+  ローカルのインデックスを使うときは、同期版をスレッドで呼ぶ
+  '''
+  if BACKEND == 'mirror':
+    import asyncio
+    return await asyncio.to_thread(load_data, keywords, debug)
+  results = await db_access_async(make_url(keywords))
+  with metrics.span('parse_result', source='ref'):
+    return [parse_result(keywords, x) for x in results]
+
+def cache_stats():
+  '''
+  キャッシュのヒット/ミス/追い出し回数
+  '''
+  return {
+    'local': _cache.stats(),
+    'shared': None if _shared is None else _shared.stats(),
+    'hit_nums': _hit_nums.stats(),
+  }
+
+def load_data(keywords, debug=False):
+  '''
+  DBに問い合わせて、入力から返答を作成
   input:
     - keywords: キーワードリスト (unicode)
     - debug: 中間結果を表示するかどうか (bool)
@@ -84,21 +402,16 @@ def access_db_to_data(keywords, debug=False):
     print('keywords: {}'.format(keywords))
     print()
   
-  # DBのクエリ文 (URL) を作成
-  url = make_url(keywords)
-  if debug:
-    print('url: {}'.format(url))
-    print()
-  
   # DBにクエリを投げる
-  results = db_access(url)
+  results = search(keywords, debug=debug)
   if debug:
     print('results: {}'.format(json.dumps(results, indent=2, ensure_ascii=False)))
     # print(type(results))
     print()
   
   # レファレンスからデータ抽出
-  ref_data = [parse_result(keywords, x) for x in results]
+  with metrics.span('parse_result', source='ref'):
+    ref_data = [parse_result(keywords, x) for x in results]
   if debug:
     print('ref_data:')
     for _d in ref_data:
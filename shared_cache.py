@@ -0,0 +1,193 @@
+'''
+ワーカープロセス間で共有する永続キャッシュ (SQLite)
+gunicornの全ワーカーが同じファイルを読み書きするので、
+再起動直後やほかのワーカーが一度引いたキーワードもすぐに返せる
+
+stale-while-revalidate:
+  有効期限 (ttl) を過ぎても max_stale 以内のデータはすぐに返し、
+  裏で問い合わせ直して更新する
+
+設定は環境変数で変更できる
+- REHATCH_SHARED_CACHE_PATH: SQLiteファイルのパス. 空文字のとき無効
+'''
+
+import json
+import os
+import random
+import sqlite3
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import applog
+
+DEFAULT_PATH = os.path.join(tempfile.gettempdir(), 'rehatch_cache.sqlite3')
+PATH = os.environ.get('REHATCH_SHARED_CACHE_PATH', DEFAULT_PATH)
+
+# 裏での更新が終わらないときに、ほかのプロセスに更新を譲るまでの秒数
+REFRESH_LEASE = 60
+
+# 裏での更新用のスレッドプール (プロセス内で共有)
+_refresher = ThreadPoolExecutor(max_workers=2, thread_name_prefix='rehatch-refresh')
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS entries (
+  ns TEXT NOT NULL,
+  key TEXT NOT NULL,
+  value TEXT NOT NULL,
+  updated_at REAL NOT NULL,
+  refreshing_until REAL NOT NULL DEFAULT 0,
+  PRIMARY KEY (ns, key)
+)
+'''
+
+class SharedCache:
+  '''
+  SQLiteに保存する namespace 単位のキャッシュ
+  - path: SQLiteファイルのパス
+  - namespace: データベースの種類 ('ref', 'wiki' など)
+  - ttl: この秒数以内のデータは新鮮とみなす
+  - max_stale: この秒数以内のデータは古くても返す (裏で更新する)
+  '''
+  def __init__(self, path, namespace, ttl=3600, max_stale=7*24*3600):
+    self.path = path
+    self.namespace = namespace
+    self.ttl = ttl
+    self.max_stale = max_stale
+    self._local = threading.local()
+    self._refreshing = set()
+    self._lock = threading.Lock()
+    self.hits = 0
+    self.stale_hits = 0
+    self.misses = 0
+    self.refreshes = 0
+    self.errors = 0
+
+  def _conn(self):
+    '''
+    スレッドごとの接続
+    '''
+    conn = getattr(self._local, 'conn', None)
+    if conn is None:
+      conn = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+      conn.execute('PRAGMA journal_mode=WAL')
+      conn.execute('PRAGMA synchronous=NORMAL')
+      conn.execute(SCHEMA)
+      self._local.conn = conn
+    return conn
+
+  def get(self, key):
+    '''
+    キャッシュから取得
+    output: (データ, 新鮮かどうか). ないとき (古すぎるときも) None
+    '''
+    try:
+      row = self._conn().execute(
+        'SELECT value, updated_at FROM entries WHERE ns=? AND key=?',
+        (self.namespace, json.dumps(key, ensure_ascii=False))).fetchone()
+    except sqlite3.Error:
+      self.errors += 1
+      applog.error('shared_cache', 'get_failed', exc_info=True, namespace=self.namespace)
+      return None
+    if row is None:
+      self.misses += 1
+      return None
+    age = time.time() - row[1]
+    if age > self.max_stale:
+      self.misses += 1
+      return None
+    fresh = age <= self.ttl
+    if fresh:
+      self.hits += 1
+    else:
+      self.stale_hits += 1
+    return json.loads(row[0]), fresh
+
+  def set(self, key, value):
+    '''
+    キャッシュに保存
+    '''
+    try:
+      conn = self._conn()
+      conn.execute(
+        'INSERT OR REPLACE INTO entries (ns, key, value, updated_at, refreshing_until) '
+        'VALUES (?, ?, ?, ?, 0)',
+        (self.namespace, json.dumps(key, ensure_ascii=False),
+         json.dumps(value, ensure_ascii=False), time.time()))
+      # たまに古すぎるデータを掃除
+      if random.random() < 0.01:
+        conn.execute('DELETE FROM entries WHERE ns=? AND updated_at<?',
+                     (self.namespace, time.time() - self.max_stale))
+    except sqlite3.Error:
+      self.errors += 1
+      applog.error('shared_cache', 'set_failed', exc_info=True, namespace=self.namespace)
+
+  def _claim_refresh(self, key):
+    '''
+    更新担当を取る. ほかのプロセスが更新中なら False
+    '''
+    now = time.time()
+    try:
+      cur = self._conn().execute(
+        'UPDATE entries SET refreshing_until=? '
+        'WHERE ns=? AND key=? AND refreshing_until<?',
+        (now + REFRESH_LEASE, self.namespace,
+         json.dumps(key, ensure_ascii=False), now))
+    except sqlite3.Error:
+      self.errors += 1
+      applog.error('shared_cache', 'claim_failed', exc_info=True, namespace=self.namespace)
+      return False
+    return cur.rowcount == 1
+
+  def refresh_async(self, key, loader, on_done=None):
+    '''
+    裏で loader() を呼んでキャッシュを更新する
+    同じキーの更新は、プロセス内でもプロセス間でも1つだけ走る
+    '''
+    with self._lock:
+      if key in self._refreshing:
+        return
+      self._refreshing.add(key)
+    if not self._claim_refresh(key):
+      with self._lock:
+        self._refreshing.discard(key)
+      return
+    self.refreshes += 1
+    _refresher.submit(self._refresh, key, loader, on_done)
+
+  def _refresh(self, key, loader, on_done):
+    try:
+      value = loader()
+      self.set(key, value)
+      if on_done is not None:
+        on_done(value)
+    except Exception:
+      applog.error('shared_cache', 'refresh_failed', exc_info=True, namespace=self.namespace, key=key)
+    finally:
+      with self._lock:
+        self._refreshing.discard(key)
+
+  def stats(self):
+    '''
+    チューニング用のカウンタ
+    '''
+    return {
+      'name': self.namespace,
+      'path': self.path,
+      'ttl': self.ttl,
+      'max_stale': self.max_stale,
+      'hits': self.hits,
+      'stale_hits': self.stale_hits,
+      'misses': self.misses,
+      'refreshes': self.refreshes,
+      'errors': self.errors,
+    }
+
+def make_shared_cache(namespace, ttl, max_stale):
+  '''
+  設定に従って共有キャッシュを作成. 無効のとき None
+  '''
+  if not PATH:
+    return None
+  return SharedCache(PATH, namespace, ttl=ttl, max_stale=max_stale)
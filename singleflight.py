@@ -0,0 +1,126 @@
+'''
+同じ問い合わせの合流 (single-flight)
+同じキー (正規化したURL) の取得が進行中のあいだに来た呼び出しは、自分では問い合わせずに
+先に始めた呼び出しの結果を待って、同じ結果 (または同じ例外) を受け取る
+話題の地名にアクセスが集中しても、外部APIへの問い合わせは1件ずつで済む
+
+結果のオブジェクトは呼び出し元で共有されるので、書き換えないこと
+
+使い方:
+  _flight = singleflight.Group('ref')
+  results = _flight.do(singleflight.normalize_url(url), db_access, url)
+  body = await _flight.do_async(singleflight.normalize_url(url), lambda: http_client_async.get(url))
+
+合流した数は metrics の rehatch_singleflight_total{group, role} (role: leader / coalesced) に記録する
+'''
+
+import threading
+import urllib.parse
+
+import metrics
+
+def normalize_url(url):
+  '''
+  同じ問い合わせが同じキーになるように、スキーム・ホストの大文字小文字とクエリの順番をそろえる
+  '''
+  parts = urllib.parse.urlsplit(url)
+  query = sorted(urllib.parse.parse_qsl(parts.query, keep_blank_values=True))
+  return urllib.parse.urlunsplit((
+    parts.scheme.lower(), parts.netloc.lower(), parts.path,
+    urllib.parse.urlencode(query), ''))
+
+class _Call:
+  '''
+  進行中の呼び出し1件
+  '''
+  def __init__(self):
+    self.done = threading.Event()
+    self.value = None
+    self.error = None
+
+_groups = []
+
+class Group:
+  '''
+  キーごとに進行中の呼び出しを1つにまとめる
+  '''
+  def __init__(self, name):
+    self.name = name
+    self._lock = threading.Lock()
+    self._calls = {}
+    # asyncio 用 ((イベントループ, キー) → Task)
+    self._tasks = {}
+    self.leaders = 0
+    self.coalesced = 0
+    _groups.append(self)
+
+  def _record(self, role):
+    with self._lock:
+      if role == 'leader':
+        self.leaders += 1
+      else:
+        self.coalesced += 1
+    metrics.inc('rehatch_singleflight_total', group=self.name, role=role)
+
+  def do(self, key, fn, *args, **kwargs):
+    '''
+    fn(*args, **kwargs) の結果. 同じ key の呼び出しが進行中ならその結果を待つ
+    '''
+    with self._lock:
+      call = self._calls.get(key)
+      leader = call is None
+      if leader:
+        call = _Call()
+        self._calls[key] = call
+    if not leader:
+      self._record('coalesced')
+      call.done.wait()
+      if call.error is not None:
+        raise call.error
+      return call.value
+
+    self._record('leader')
+    try:
+      call.value = fn(*args, **kwargs)
+      return call.value
+    except BaseException as e:
+      call.error = e
+      raise
+    finally:
+      with self._lock:
+        del self._calls[key]
+      call.done.set()
+
+  async def do_async(self, key, fn):
+    '''
+    do の非同期版. await fn() の結果
+    fn() は呼び出し元から切り離したタスクで動かすので、
+    先に始めた呼び出しがキャンセルされても、待っているほかの呼び出しは影響を受けない
+    '''
+    import asyncio
+    loop = asyncio.get_running_loop()
+    task_key = (loop, key)
+    task = self._tasks.get(task_key)
+    if task is None:
+      self._record('leader')
+      task = loop.create_task(fn())
+      self._tasks[task_key] = task
+      task.add_done_callback(lambda _: self._tasks.pop(task_key, None))
+    else:
+      self._record('coalesced')
+    return await asyncio.shield(task)
+
+  def stats(self):
+    with self._lock:
+      return {
+        'name': self.name,
+        'in_flight': len(self._calls) + len(self._tasks),
+        'leaders': self.leaders,
+        'coalesced': self.coalesced,
+      }
+
+def stats():
+  '''
+  すべてのグループの合流の数
+  '''
+  return [g.stats() for g in _groups]
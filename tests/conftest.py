@@ -0,0 +1,7 @@
+import os
+import sys
+
+# リポジトリ直下のモジュール (wikitext, text_utils など) を読み込めるように
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+FIXTURES_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fixtures')
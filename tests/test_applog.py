@@ -0,0 +1,11 @@
+import logging
+
+import applog
+
+def test_level_names():
+  assert applog._level('debug') == logging.DEBUG
+  assert applog._level('15') == 15
+
+def test_unknown_level_is_info(capsys):
+  assert applog._level('verbose') == logging.INFO
+  assert 'verbose' in capsys.readouterr().err
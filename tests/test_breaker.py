@@ -0,0 +1,53 @@
+'''
+breaker.CircuitBreaker を閉じられるのは半開のときの試しの問い合わせだけ
+'''
+
+import pytest
+
+import breaker
+
+def make_open(reset_timeout=0):
+  b = breaker.CircuitBreaker('test', failures=2, reset_timeout=reset_timeout, half_open_calls=1)
+  for _ in range(2):
+    b.record_failure(b.check())
+  assert b.state == breaker.OPEN
+  return b
+
+def test_late_success_does_not_close():
+  b = breaker.CircuitBreaker('test', failures=2, reset_timeout=60)
+  late = b.check()
+  b.record_failure(b.check())
+  b.record_failure(b.check())
+  assert b.state == breaker.OPEN
+  b.record_success(late)
+  assert b.state == breaker.OPEN
+  with pytest.raises(breaker.CircuitOpenError):
+    b.check()
+
+def test_trial_success_closes():
+  b = make_open()
+  trial = b.check()
+  assert b.state == breaker.HALF_OPEN
+  b.record_result(0.1, trial)
+  assert b.state == breaker.CLOSED
+
+def test_trial_failure_reopens():
+  b = make_open()
+  b.record_failure(b.check())
+  assert b.state == breaker.OPEN
+
+def test_client_error_is_not_recovery():
+  b = make_open()
+  trial = b.check()
+  b.record_client_error(trial)
+  assert b.state == breaker.HALF_OPEN
+  # 試しの枠は返るので、次の問い合わせで確かめられる
+  b.record_success(b.check())
+  assert b.state == breaker.CLOSED
+
+def test_client_error_does_not_reset_failures():
+  b = breaker.CircuitBreaker('test', failures=2, reset_timeout=60)
+  b.record_failure(b.check())
+  b.record_client_error(b.check())
+  b.record_failure(b.check())
+  assert b.state == breaker.OPEN
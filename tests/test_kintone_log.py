@@ -0,0 +1,116 @@
+'''
+kintone_log.KintoneLogger の送れなかったときの扱い (偽の送り先で確かめる)
+'''
+
+import json
+import time
+
+import requests
+
+import kintone_log
+
+class Response:
+  def __init__(self, status_code):
+    self.status_code = status_code
+
+def http_error(status):
+  return requests.HTTPError('{} error'.format(status), response=Response(status))
+
+class Sender:
+  '''
+  'bad' を含むまとめは 400 で、down の間はすべて 503 で失敗する (一括登録と同じく全体が失敗)
+  '''
+  def __init__(self):
+    self.down = False
+    self.sent = []
+    self.calls = 0
+
+  def __call__(self, records):
+    self.calls += 1
+    if self.down:
+      raise http_error(503)
+    if any(r.get('bad') for r in records):
+      raise http_error(400)
+    self.sent += records
+
+def read_lines(path):
+  with open(path, encoding='utf-8') as f:
+    return [json.loads(l) for l in f]
+
+def make_logger(tmp_path, sender):
+  return kintone_log.KintoneLogger(spool_path=str(tmp_path / 'spool.jsonl'), sender=sender)
+
+def test_rejected_record_is_dead_lettered(tmp_path):
+  sender = Sender()
+  logger = make_logger(tmp_path, sender)
+  records = [{'n': i} for i in range(100)]
+  records[37]['bad'] = True
+  assert logger._send(records)
+  assert len(sender.sent) == 99
+  assert sender.calls < 20
+  assert [l['record'] for l in read_lines(logger.spool_path + '.dead')] == [records[37]]
+  assert logger.stats()['dead_lettered'] == 1
+  assert logger.replay() == 0
+
+def test_transient_failure_is_replayed(tmp_path):
+  sender = Sender()
+  logger = make_logger(tmp_path, sender)
+  sender.down = True
+  assert not logger._send([{'n': 1}, {'n': 2}])
+  assert [l['attempts'] for l in read_lines(logger.spool_path)] == [1, 1]
+  sender.down = False
+  assert logger.replay() == 2
+  assert sender.sent == [{'n': 1}, {'n': 2}]
+
+def test_retries_are_limited(tmp_path):
+  sender = Sender()
+  logger = make_logger(tmp_path, sender)
+  sender.down = True
+  logger._send([{'n': 1}])
+  for _ in range(kintone_log.MAX_ATTEMPTS + 5):
+    logger.replay()
+  assert sender.calls == kintone_log.MAX_ATTEMPTS
+  assert [l['record'] for l in read_lines(logger.spool_path + '.dead')] == [{'n': 1}]
+
+def test_old_spool_lines_are_replayed(tmp_path):
+  sender = Sender()
+  logger = make_logger(tmp_path, sender)
+  with open(logger.spool_path, 'w', encoding='utf-8') as f:
+    f.write(json.dumps({'n': 1}) + '\n')
+  assert logger.replay() == 1
+  assert sender.sent == [{'n': 1}]
+
+def test_overflow_is_spooled_by_flush(tmp_path, monkeypatch):
+  monkeypatch.setattr(kintone_log, 'MAX_BUFFER', 2)
+  sender = Sender()
+  logger = make_logger(tmp_path, sender)
+  monkeypatch.setattr(logger, '_start', lambda: None)
+  for i in range(4):
+    logger.log({'n': i})
+  assert logger.stats()['spooled'] == 0
+  assert logger.flush()
+  assert [l['record'] for l in read_lines(logger.spool_path)] == [{'n': 0}, {'n': 1}]
+  assert sender.sent == [{'n': 2}, {'n': 3}]
+
+def test_no_spool_path_drops(tmp_path):
+  sender = Sender()
+  logger = kintone_log.KintoneLogger(spool_path='', sender=sender)
+  sender.down = True
+  assert not logger._send([{'n': 1}])
+  assert logger.stats()['dropped'] == 1
+  assert logger.replay() == 0
+
+def test_flusher_survives_spool_errors(tmp_path, monkeypatch):
+  sender = Sender()
+  logger = kintone_log.KintoneLogger(
+    spool_path=str(tmp_path / 'missing' / 'spool.jsonl'), flush_interval=0.01, sender=sender)
+  sender.down = True
+  logger.log({'n': 1})
+  time.sleep(0.2)
+  assert logger._thread.is_alive()
+  sender.down = False
+  logger.log({'n': 2})
+  deadline = time.monotonic() + 2
+  while sender.sent != [{'n': 2}] and time.monotonic() < deadline:
+    time.sleep(0.01)
+  assert sender.sent == [{'n': 2}]
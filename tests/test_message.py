@@ -0,0 +1,76 @@
+'''
+message.fetch_dataset の期限とデータベースごとのスレッドプール
+'''
+
+import socket
+import threading
+import time
+
+import pytest
+
+import http_client
+import message
+import refkyo
+import wikipedia
+
+@pytest.fixture
+def hung_ref(monkeypatch):
+  '''
+  レファ協だけが応答しない (wikipedia はすぐに返す)
+  '''
+  release = threading.Event()
+  monkeypatch.setattr(message, 'DEFAULT_DEADLINE', 0.2)
+  monkeypatch.setattr(refkyo, 'access_db_to_data', lambda keywords, debug=False: release.wait(10) and [])
+  monkeypatch.setattr(wikipedia, 'access_db_to_data', lambda keywords, debug=False: [{'title': 'w'}])
+  yield
+  release.set()
+
+def test_hung_source_does_not_starve_the_other(hung_ref):
+  for _ in range(message.FETCH_WORKERS * 3):
+    data = message.fetch_dataset(['京都'])
+    assert data == {'wiki': [{'title': 'w'}], 'ref': []}
+
+@pytest.fixture
+def silent_server():
+  '''
+  接続は受けるが何も返さないサーバ
+  '''
+  server = socket.socket()
+  server.bind(('127.0.0.1', 0))
+  server.listen(16)
+  conns = []
+  def accept():
+    while True:
+      try:
+        conns.append(server.accept()[0])
+      except OSError:
+        return
+  threading.Thread(target=accept, daemon=True).start()
+  yield 'http://127.0.0.1:{}/'.format(server.getsockname()[1])
+  server.close()
+  for c in conns:
+    c.close()
+
+def test_deadline_bounds_http_request(silent_server):
+  started = time.monotonic()
+  with http_client.deadline(started + 0.5):
+    with pytest.raises(Exception):
+      http_client.get(silent_server)
+  assert time.monotonic() - started < 1.0
+  with http_client.deadline(time.monotonic() - 1):
+    with pytest.raises(http_client.DeadlineExceeded):
+      http_client.get(silent_server)
+
+def test_hit_is_chosen_per_request(monkeypatch):
+  '''
+  キャッシュしたデータでも、ヒットしたキーワードは問い合わせごとに選び直す
+  '''
+  cached = [{'hits': ['京都', '奈良'], 'title': 'w'}, {'hits': [], 'title': 'x'}]
+  monkeypatch.setattr(wikipedia, 'access_db_to_data', lambda keywords, debug=False: cached)
+  seen = set()
+  for _ in range(50):
+    data = message.fetch_source('wiki', ['京都', '奈良'])
+    seen.add(data[0]['hit'])
+    assert data[1]['hit'] is None
+  assert seen == {'京都', '奈良'}
+  assert 'hit' not in cached[0]
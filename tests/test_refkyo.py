@@ -0,0 +1,36 @@
+'''
+refkyo の窓 (REHATCH_REF_SAMPLE_WINDOW) と、負荷試験用のスタブ (loadtest/stub_server.py) の窓
+'''
+
+import os
+import sys
+
+import pytest
+
+import refkyo
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'loadtest'))
+import stub_server
+
+@pytest.mark.parametrize('fixture', ['crd_empty', 'crd_single', 'crd_small', 'crd_page200'])
+@pytest.mark.parametrize('window', [1, 3, 200])
+def test_every_window_is_filled(fixture, window, monkeypatch):
+  '''
+  pick_window が選びうる窓は、スタブでも空にならない (件数はヒット件数の残りか窓の大きさ)
+  '''
+  monkeypatch.setattr(refkyo, 'SAMPLE_WINDOW', window)
+  hit_num, results = stub_server.split_results(stub_server.load_fixture(fixture))
+  pages = (hit_num + window - 1) // window
+  for page in list(range(min(pages, 3))) + list(range(max(pages - 3, 0), pages)):
+    body = stub_server.make_crd_window(hit_num, results, page * window + 1, window)
+    count, records = refkyo.parse_page_dom(body.decode('utf-8'))
+    assert count == hit_num
+    assert len(records) == min(window, hit_num - page * window)
+
+def test_stub_caps_results_num():
+  '''
+  スタブもAPIと同じく1回に CRD_MAX_RESULTS 件までしか返さない
+  '''
+  assert stub_server.CRD_MAX_RESULTS == refkyo.MAX_RESULTS_NUM
+  body = stub_server.make_crd_window(4321, [b'<result></result>\n'], 1, 500)
+  assert body.count(b'<result>') == stub_server.CRD_MAX_RESULTS
@@ -0,0 +1,105 @@
+'''
+text_utils.scan_voice_text / make_voice が以前の処理 (空白・URLの除去と delete_brackets) と同じ結果になるか
+fixtures/voice/cases.json と、乱数で作った断片で比べる
+get_keywords の地名辞書 (gazetteer.py) を使う場合と使わない場合も比べる
+'''
+
+import json
+import os
+import random
+import re
+
+import pytest
+
+import gazetteer
+import text_utils
+from conftest import FIXTURES_DIR
+
+def old_voice_text(text):
+  '''
+  以前の make_voice の空白, URL, 括弧の除去
+  '''
+  ret = re.sub(r"\s", "", text)
+  ret = re.sub(r"(https?|ftp)(:\/\/[-_\.!~*\'()a-zA-Z0-9;\/?:\@&=\+$,%#]+)", "", ret)
+  return text_utils.delete_brackets(ret)
+
+with open(os.path.join(FIXTURES_DIR, 'voice', 'cases.json'), encoding='utf-8') as f:
+  CASES = json.load(f)
+
+@pytest.mark.parametrize('text', CASES)
+def test_fixture_same_as_delete_brackets(text):
+  ret = text_utils.scan_voice_text(text)
+  assert ret is None or ret == old_voice_text(text)
+  assert text_utils.make_voice(text) == text_utils.shorten_text(old_voice_text(text), max_length=100)
+
+def test_fixture_crossing_falls_back():
+  '''
+  種類の違う括弧が交差しているときだけ None
+  '''
+  assert text_utils.scan_voice_text('（交差【する）場合】') is None
+  assert text_utils.scan_voice_text('（入れ子【する】場合）') == ''
+
+# 断片の部品 (全角・半角の括弧, 消さない目印, URL, 空白, 文の区切り)
+TOKENS = list('あいう漢字。？\n ()<>{}[]（）【】＜＞［］「」｛｝〔〕〈〉|^ab:/h') + \
+  ['http://a.b/(x)', 'https://z?q=1', 'ftp://', '　']
+
+def test_random_fragments_same_as_delete_brackets():
+  rng = random.Random(20261018)
+  for _ in range(20000):
+    text = ''.join(rng.choice(TOKENS) for _ in range(rng.randint(0, 40)))
+    ret = text_utils.scan_voice_text(text)
+    assert ret is None or ret == old_voice_text(text), repr(text)
+    max_length = rng.randint(1, 30)
+    assert text_utils.make_voice(text, max_length) == \
+      text_utils.shorten_text(old_voice_text(text), max_length=max_length), repr(text)
+
+def naive_find(names, text):
+  '''
+  gazetteer.Gazetteer.find と同じ規則 (左から最長一致, 重ならない) を素朴に書いたもの
+  '''
+  names = [n for n in names if len(n) >= gazetteer.MIN_LENGTH]
+  ret = []
+  i = 0
+  while i < len(text):
+    lengths = [len(n) for n in names if text.startswith(n, i)]
+    if len(lengths) > 0:
+      ret += [(i, i + max(lengths))]
+      i += max(lengths)
+    else:
+      i += 1
+  return ret
+
+@pytest.fixture
+def use_gazetteer(monkeypatch):
+  def use(names):
+    g = gazetteer.Gazetteer(names)
+    monkeypatch.setattr(gazetteer, 'get_gazetteer', lambda: g)
+  return use
+
+def test_gazetteer_leftmost_longest(use_gazetteer):
+  text = '武蔵国府中の歴史'
+  assert sorted(text_utils.get_keywords(text)) == ['武蔵国府中', '歴史']
+  # 武蔵 より 武蔵国 (最長), 国府 は 武蔵国 と重なるのでとらない
+  use_gazetteer(['武蔵', '武蔵国', '国府', '府中'])
+  assert sorted(text_utils.get_keywords(text)) == ['府中', '武蔵国']
+
+def test_gazetteer_overlapping_entries(use_gazetteer):
+  # 京都 は 東京 と重なるのでとらない. 都 は短いので辞書に入らない
+  use_gazetteer(['東京', '京都', '京都府', '都'])
+  assert gazetteer.get_gazetteer().find('東京都と京都府') == [(0, 2), (4, 7)]
+  assert sorted(text_utils.get_keywords('東京都と京都府')) == ['京都府', '東京']
+
+def test_gazetteer_empty_dictionary(use_gazetteer):
+  text = '武蔵国府中の歴史'
+  without = sorted(text_utils.get_keywords(text))
+  use_gazetteer([])
+  assert gazetteer.get_gazetteer().size == 0
+  assert sorted(text_utils.get_keywords(text)) == without
+
+def test_gazetteer_same_as_naive():
+  rng = random.Random(20261018)
+  alphabet = '東京都府中武蔵国大阪'
+  for _ in range(2000):
+    names = [''.join(rng.choice(alphabet) for _ in range(rng.randint(1, 4))) for _ in range(rng.randint(0, 8))]
+    text = ''.join(rng.choice(alphabet + 'の') for _ in range(rng.randint(0, 30)))
+    assert gazetteer.Gazetteer(names).find(text) == naive_find(names, text), (names, text)
@@ -0,0 +1,91 @@
+'''
+wikitext.make_summary が以前の正規表現による実装 (wikipedia.make_summary) と同じ結果になるか
+fixtures/wikitext/*.wiki と、乱数で作った断片で比べる
+'''
+
+import glob
+import os
+import random
+import re
+import time
+
+import pytest
+
+import wikitext
+from conftest import FIXTURES_DIR
+
+def old_make_summary(text):
+  '''
+  以前の wikipedia.make_summary (比較用. 入力によっては二乗以上の時間がかかる)
+  '''
+  summary = '\n\n'.join(text.strip().split('\n\n',5)[:-1])
+
+  while re.search(r'{{(?!.*{{).*?}}', summary):
+    summary = re.sub(r'{{(?!.*{{).*?}}', ' ', summary)
+  summary = re.sub(r'{{(.|\s)*?}}', ' ', summary)
+
+  _ms = re.search(r'\[\[(?!.*(\[\[|:))(.|\s)*?\]\]', summary)
+  while _ms:
+    _span = _ms.span()
+    _m = summary[_span[0]:_span[1]]
+    _r = _m.split('[[',1)[-1].split(']]',1)[0].split('|',1)[-1]
+    summary = summary.replace(_m, _r)
+    _ms = re.search(r'\[\[(?!.*(\[\[|:))(.|\s)*?\]\]', summary)
+
+  summary = re.sub(r'\[\[.*:(.|\s)*?\]\]', ' ', summary)
+  summary = re.sub(r'<ref>(.|\s)*?</ref>', ' ', summary)
+  summary = re.sub(r'<!--.*?-->', ' ', summary)
+  summary = summary.replace('\'\'\'', '')
+  summary = summary.strip().split('\n\n',1)[0]
+  summary = re.sub(r'\s+', ' ', summary).strip()
+  return summary
+
+FIXTURES = sorted(glob.glob(os.path.join(FIXTURES_DIR, 'wikitext', '*.wiki')))
+
+@pytest.mark.parametrize('path', FIXTURES, ids=os.path.basename)
+def test_fixture_same_as_regex(path):
+  with open(path, encoding='utf-8') as f:
+    text = f.read()
+  assert wikitext.make_summary(text) == old_make_summary(text)
+
+# 断片の部品 (括弧・区切り・改行の組み合わせで境界の場合を作る)
+TOKENS = ['[[', ']]', '[', ']', '{{', '}}', '{', '}', '|', ':', '\n', '\n\n',
+          '<ref>', '</ref>', '<!--', '-->', "'''", ' ', 'a', 'b', '京', '都']
+
+def random_fragment(rng):
+  return ''.join(rng.choice(TOKENS) for _ in range(rng.randint(0, 40)))
+
+def test_random_fragments_same_as_regex():
+  rng = random.Random(20261018)
+  for _ in range(20000):
+    text = random_fragment(rng)
+    assert wikitext.make_summary(text) == old_make_summary(text), repr(text)
+
+@pytest.mark.parametrize('n', [800, 3200])
+def test_multiline_links_linear(n):
+  '''
+  行をまたぐリンクが多くても入力長に比例する時間で終わる
+  '''
+  text = "'''x'''" + ''.join('[[a{}\nb]]c'.format(i) for i in range(n)) + '\n\nend\n\n'
+  started = time.perf_counter()
+  summary = wikitext.make_summary(text)
+  assert time.perf_counter() - started < 1.0
+  assert summary.startswith('xa0 bca1 bc')
+  if n <= 800:
+    assert summary == old_make_summary(text)
+
+@pytest.mark.parametrize('text', [
+  '[[a\n' * 10000 + ']]',
+  '[[[[a\n' * 5000 + ']]' * 5000,
+  '[[' * 20000 + 'a' + ']]' * 20000,
+  '[[\n' * 20000 + 'a' + ']]' * 20000,
+  '[[a[]][' * 12000,
+], ids=['unclosed', 'deep', 'nested', 'nested_lines', 'merge'])
+def test_pathological_links_bounded(text):
+  '''
+  入り組んだリンクでも (LINK_BUDGET で打ち切って) すぐに終わる
+  '''
+  text = text[:wikitext.MAX_SOURCE_CHARS - 10] + '\n\nend'
+  started = time.perf_counter()
+  wikitext.make_summary(text)
+  assert time.perf_counter() - started < 1.0
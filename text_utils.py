@@ -4,21 +4,82 @@ import re
 import json
 import os
 import random
-import ftfy
+import hashlib
+import threading
+
+import cache
+import gazetteer
+
+# 文字タイプ (char_class の値)
+OTHER, HIRA, KATA, KANJI = 0, 1, 2, 3
+CHAR_TYPE_NAMES = ('other', 'hira', 'kata', 'kanji')
+
+# 文字タイプの範囲 (両端を含む)
+CHAR_TYPE_RANGES = [
+  (HIRA, 0x3041, 0x309F), # ひらがな
+  (KATA, 0x30A1, 0x30FF), # カタカナ
+  (KANJI, 0x2E80, 0x2FDF), # 漢字 (部首)
+  (KANJI, 0x3005, 0x3007), # 々〆〇
+  (KANJI, 0x3400, 0x4DBF), # 漢字 (拡張A)
+  (KANJI, 0x4E00, 0x9FFF), # 漢字
+  (KANJI, 0xF900, 0xFAFF), # 漢字 (互換)
+  (KANJI, 0x20000, 0x2EBEF), # 漢字 (拡張B~F)
+]
+
+def _make_char_type_table():
+  '''
+  コードポイント → 文字タイプ の表 (範囲外は OTHER)
+  '''
+  table = bytearray(max(x[2] for x in CHAR_TYPE_RANGES) + 1)
+  for t, lo, hi in CHAR_TYPE_RANGES:
+    table[lo:hi+1] = bytes([t]) * (hi - lo + 1)
+  return bytes(table)
+
+CHAR_TYPE_TABLE = _make_char_type_table()
+
+def char_class(c):
+  '''
+  文字タイプ判定 (OTHER, HIRA, KATA, KANJI)
+  '''
+  o = ord(c)
+  return CHAR_TYPE_TABLE[o] if o < len(CHAR_TYPE_TABLE) else OTHER
+
+def char_classes(text):
+  '''
+  各文字の文字タイプのリスト
+  '''
+  table = CHAR_TYPE_TABLE
+  n = len(table)
+  return [table[o] if o < n else OTHER for o in map(ord, text)]
 
 def get_char_type(c):
   '''
   文字タイプ判定
   out: 'hira', 'kata', 'kanji', or 'other'
   '''
-  if re.match('[\u3041-\u309F]', c):
-    return 'hira' # ひらがな
-  elif re.match('[\u30A1-\u30FF]', c):
-    return 'kata' # カタカナ
-  elif re.match('[\u2E80-\u2FDF\u3005-\u3007\u3400-\u4DBF\u4E00-\u9FFF\uF900-\uFAFF\U00020000-\U0002EBEF]', c):
-    return 'kanji' # 漢字
-  else:
-    return 'other' # その他
+  return CHAR_TYPE_NAMES[char_class(c)]
+
+def is_all_hira(text):
+  '''
+  ひらがなだけの文字列かどうか
+  '''
+  return all(t == HIRA for t in char_classes(text))
+
+def split_char_types(text):
+  '''
+  かな、カナ、漢字の切れ目で分割する
+  (その他の文字と隣り合うところでは切らない)
+  '''
+  ret = []
+  start = 0
+  prev = OTHER
+  for i, t in enumerate(char_classes(text)):
+    if prev != OTHER and t != OTHER and prev != t:
+      ret += [text[start:i]]
+      start = i
+    prev = t
+  ret += [text[start:]]
+  return ret
 
 def get_keywords(text):
   '''
@@ -43,6 +104,12 @@ def get_keywords(text):
           if len(_t)>1 and len(_t)<len(text):
             ret += [_t]
   
+  if len(ret)==0:
+    # 地名辞書があれば、辞書にある地名をキーワードとする
+    g = gazetteer.get_gazetteer()
+    if g is not None:
+      ret += g.extract(text)
+  
   if len(ret)==0:
     # for voice input
     # 'という'、'ていう'をヒントにキーワード化
@@ -60,17 +127,10 @@ def get_keywords(text):
   
   if len(ret)==0:
     # かな、カナ、漢字の切れ目でキーワードにする
-    _t = ''
-    for c in text:
-      if len(_t)>0:
-        t0 = get_char_type(_t[-1])
-        t1 = get_char_type(c)
-        if 'other' not in [t0, t1] and t0!=t1:
-          # 極端に短いものを削除
-          if len(_t)>1:
-            ret += [_t]
-          _t = ''
-      _t += c
+    segments = split_char_types(text)
+    # 極端に短いものを削除
+    ret += [_t for _t in segments[:-1] if len(_t)>1]
+    _t = segments[-1]
     if len(_t)>1 and len(_t)<len(text):
       ret += [_t]
   
@@ -78,11 +138,7 @@ def get_keywords(text):
   ret = list(set(ret))
   
   # ひらがなのみのキーワードを削除
-  _ret = []
-  for x in ret:
-    if not all(get_char_type(c)=='hira' for c in x):
-      _ret += [x]
-  ret = _ret
+  ret = [x for x in ret if not is_all_hira(x)]
   
   # キーワードが何も得られなかったとき、
   # しょうがないので元のベタテキストをキーボードにする
@@ -128,36 +184,150 @@ def delete_brackets(s):
     """ recursive processing """
     return delete_brackets(s) if sum([1 if re.search(l_, s) else 0 for l_ in l]) > 0 else s
 
+# ftfyが何も変えないことがわかっている文字だけでできた文字列 (ASCII (& を除く), かな, 漢字, 和文の句読点・括弧)
+# このときはftfyを呼ばない
+# (全角英数・全角括弧・全角スペース・引用符・半角カナ・ラテン文字などはftfyが変えることがあるので含めない)
+FTFY_NOOP = re.compile('[\t\n\x20-\x25\x27-\x7e\u3001-\u3029\u3030-\u303f\u3041-\u3096\u309d-\u309f\u30a1-\u30ff\u3400-\u4dbf\u4e00-\u9fff]*')
+
+# ftfyの結果のメモ (本文のハッシュ → 結果)
+_fix_text_memo = cache.TTLCache(
+  maxsize=int(os.environ.get('REHATCH_FTFY_MEMO_SIZE', '4096')), ttl=None, name='ftfy')
+_fix_text_counts = {'calls': 0, 'fast': 0, 'ftfy': 0}
+_fix_text_lock = threading.Lock()
+
+def _count(name):
+  with _fix_text_lock:
+    _fix_text_counts[name] += 1
+
+def fix_text(text):
+  '''
+  ftfy.fix_text と同じ結果を返す
+  ftfyが何も変えない文字列ならそのまま、同じ文字列を前に処理していればメモから返す
+  '''
+  _count('calls')
+  if FTFY_NOOP.fullmatch(text):
+    _count('fast')
+    return text
+  key = hashlib.blake2b(text.encode('utf-8', 'surrogatepass'), digest_size=16).digest()
+  ret = _fix_text_memo.get(key)
+  if ret is None:
+    _count('ftfy')
+    # ftfyは読み込みに時間がかかるので、はじめて必要になったときに読み込む
+    import ftfy
+    ret = ftfy.fix_text(text)
+    _fix_text_memo.set(key, ret)
+  return ret
+
+def fix_text_stats():
+  '''
+  fix_text の内訳 (fast: ftfyを呼ばずに返した数, ftfy: ftfyを呼んだ数, memo: メモのカウンタ)
+  '''
+  with _fix_text_lock:
+    ret = dict(_fix_text_counts)
+  ret['memo'] = _fix_text_memo.stats()
+  return ret
+
+# 文の区切り
+# SENTENCE_END = re.compile('[。？.?]')
+SENTENCE_END = re.compile('[。？\n]')
+
 def shorten_text(text, max_length=200):
   '''
   文章を、max_lengthを超えないN文にして、短くする
   '''
-  ret = ftfy.fix_text(text)
+  ret = fix_text(text)
   if len(ret)>max_length:
     # 長すぎる文を適当なところでカット
-    _ret = ''
-    _buf = ''
-    for c in ret:
-      _buf += c
-      # if c in ['。', '？', '.', '?']:
-      if c in ['。', '？', '\n']:
-        if len(_ret+_buf)>max_length:
-          ret = _ret
-          break
-        else:
-          _ret += _buf
-        _buf = ''
+    end = 0
+    for m in SENTENCE_END.finditer(ret):
+      if m.end()>max_length:
+        ret = ret[:end]
+        break
+      end = m.end()
   return ret
 
+URL_PATTERN = re.compile(r"(https?|ftp)(:\/\/[-_\.!~*\'()a-zA-Z0-9;\/?:\@&=\+$,%#]+)")
+
+# 括弧の全角化 (delete_brackets と同じ)
+ZENKAKU_BRACKETS = {
+  "(": "（",
+  ")": "）",
+  "<": "＜",
+  ">": "＞",
+  "{": "｛",
+  "}": "｝",
+  "[": "［",
+  "]": "］",
+}
+# 閉じ括弧 → 開き括弧
+CLOSE_BRACKETS = {
+  '）': '（',
+  '】': '【',
+  '＞': '＜',
+  '］': '［',
+  '」': '「',
+  '｝': '｛',
+  '〕': '〔',
+  '〉': '〈',
+}
+OPEN_BRACKETS = set(CLOSE_BRACKETS.values())
+
+# 括弧の走査で見る文字: 括弧と、括弧を消さない目印になる | と ^
+BRACKET_SPECIALS = re.compile('([{}])'.format(
+  re.escape(''.join(ZENKAKU_BRACKETS) + ''.join(CLOSE_BRACKETS) + ''.join(OPEN_BRACKETS) + '|^')))
+
+def scan_voice_text(text):
+  '''
+  空白, URL, 括弧と括弧内文字列を除去 (結果は make_voice の以前の処理と同じ)
+  括弧は1回の走査でスタックを使って対応をとり、閉じたところで中身ごと消す
+  delete_brackets と同じく、| か ^ を含む括弧 (とその外側の括弧) は消さない
+  種類の違う括弧が交差しているときは None (以前の処理でないと結果が合わない)
+  '''
+  s = URL_PATTERN.sub('', ''.join(text.split()))
+  # [文字列, 括弧, 文字列, 括弧, ..., 文字列]
+  parts = BRACKET_SPECIALS.split(s)
+  if len(parts) == 1:
+    return s
+  out = [parts[0]]
+  # [開き括弧, out の位置, | か ^ を含むか]
+  stack = []
+  for i in range(1, len(parts), 2):
+    c = parts[i]
+    c = ZENKAKU_BRACKETS.get(c, c)
+    if c in OPEN_BRACKETS:
+      stack.append([c, len(out), False])
+      out.append(c)
+    elif c in CLOSE_BRACKETS:
+      if len(stack) == 0:
+        out.append(c)
+      elif stack[-1][0] != CLOSE_BRACKETS[c]:
+        return None
+      else:
+        frame = stack.pop()
+        if frame[2]:
+          out.append(c)
+          if len(stack) > 0:
+            stack[-1][2] = True
+        else:
+          del out[frame[1]:]
+    else:
+      out.append(c)
+      if len(stack) > 0:
+        stack[-1][2] = True
+    out.append(parts[i+1])
+  return ''.join(out)
+
 def make_voice(text, max_length=100):
   '''
   ボイスメッセージ用に文章をトリミング
   '''
-  ret = re.sub(r"\s", "", text)
-  # URLの除去
-  ret = re.sub(r"(https?|ftp)(:\/\/[-_\.!~*\'()a-zA-Z0-9;\/?:\@&=\+$,%#]+)", "", ret)
-  # 括弧の除去
-  ret = delete_brackets(ret)
+  # 空白, URL, 括弧の除去
+  ret = scan_voice_text(text)
+  if ret is None:
+    # 種類の違う括弧が交差しているときは以前の処理
+    ret = re.sub(r"\s", "", text)
+    ret = URL_PATTERN.sub("", ret)
+    ret = delete_brackets(ret)
   # 長すぎる質問を適当なところでカット
   ret = shorten_text(ret, max_length=max_length)
   return ret
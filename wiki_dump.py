@@ -0,0 +1,240 @@
+'''
+jawikiのダンプ (jawiki-latest-pages-articles.xml.bz2) から、
+タイトル → 概要 の引けるコンパクトなストアを作る
+
+記事ごとの 概要/カテゴリー/出典の明記 の抽出はダンプ取り込み時に1回だけ行い、
+リダイレクトも転送先の記事に引けるようにしておく
+ストアはmmapで開くので、ワーカープロセス間でページキャッシュを共有できる
+
+wikipedia.py で REHATCH_WIKI_BACKEND=dump とすると、APIの代わりにここから引く
+
+使い方:
+  python wiki_dump.py build jawiki-latest-pages-articles.xml.bz2
+  python wiki_dump.py lookup 京都 奈良
+
+ストアの形式 (PREFIX.dat, PREFIX.idx):
+  .dat: 記事データ (JSON, utf-8) を並べたもの
+  .idx: ヘッダ (MAGIC, 件数) + (タイトルのハッシュ, .datの位置, 長さ) の配列. ハッシュ順
+'''
+
+import argparse
+import bz2
+import hashlib
+import json
+import mmap
+import os
+import struct
+import threading
+import xml.etree.ElementTree as ET
+
+import wikipedia
+
+STORE_PATH = os.environ.get('REHATCH_WIKI_DUMP_PATH', 'jawiki_store')
+
+MAGIC = b'RHWK0001'
+HEADER = struct.Struct('<8sQ')
+ENTRY = struct.Struct('<QQI')
+
+# リダイレクトの多段転送をたどる最大回数
+MAX_REDIRECT_HOPS = 3
+
+def normalize_title(title):
+  '''
+  MediaWikiのタイトル正規化 (空白/アンダースコア, 先頭の大文字化)
+  '''
+  title = ' '.join(title.replace('_', ' ').split())
+  return title[:1].upper() + title[1:]
+
+def title_hash(title):
+  '''
+  タイトルの64bitハッシュ
+  '''
+  return struct.unpack('<Q', hashlib.blake2b(
+    normalize_title(title).encode('utf-8'), digest_size=8).digest())[0]
+
+def make_record(title, text):
+  '''
+  1記事分のデータを作る (キーワードに依存しない部分だけ)
+  '''
+  return {
+    'title': title,
+    'hints': wikipedia.get_redirect_hints(text),
+    'categories': wikipedia.get_categories(text),
+    'summary': wikipedia.make_summary(text),
+    'not_enough': wikipedia.is_not_enough(text),
+  }
+
+def _local(tag):
+  return tag.rsplit('}', 1)[-1]
+
+def iter_pages(fp):
+  '''
+  ダンプXMLから (タイトル, リダイレクト先 or None, 本文) を順に取り出す
+  標準名前空間 (記事) のページだけ
+  '''
+  context = ET.iterparse(fp, events=('start', 'end'))
+  root = None
+  for event, elem in context:
+    if event == 'start':
+      if root is None:
+        root = elem
+      continue
+    if _local(elem.tag) != 'page':
+      continue
+    ns = title = redirect = text = None
+    for child in elem:
+      name = _local(child.tag)
+      if name == 'ns':
+        ns = child.text
+      elif name == 'title':
+        title = child.text
+      elif name == 'redirect':
+        redirect = child.get('title')
+      elif name == 'revision':
+        for c in child:
+          if _local(c.tag) == 'text':
+            text = c.text or ''
+    if ns == '0' and title:
+      yield title, redirect, text or ''
+    # 読み終わったページは捨ててメモリを一定に保つ
+    elem.clear()
+    if root is not None:
+      root.clear()
+
+def build(dump_path, prefix=None, limit=None, debug=False):
+  '''
+  ダンプからストアを作成
+  output: (記事数, リダイレクト数)
+  '''
+  prefix = prefix or STORE_PATH
+  opener = bz2.open if dump_path.endswith('.bz2') else open
+  offsets = {}
+  redirects = {}
+  with opener(dump_path, 'rb') as fp, open(prefix + '.dat.tmp', 'wb') as out:
+    for i, (title, redirect, text) in enumerate(iter_pages(fp)):
+      if limit is not None and i >= limit:
+        break
+      if redirect:
+        redirects[title_hash(title)] = redirect
+        continue
+      data = json.dumps(make_record(title, text), ensure_ascii=False).encode('utf-8')
+      offsets[title_hash(title)] = (out.tell(), len(data))
+      out.write(data)
+      if debug and len(offsets) % 10000 == 0:
+        print('{} articles'.format(len(offsets)))
+
+  # リダイレクトは転送先の記事の位置をそのまま指す
+  entries = dict(offsets)
+  for h, target in redirects.items():
+    for _ in range(MAX_REDIRECT_HOPS):
+      th = title_hash(target)
+      if th in offsets:
+        entries.setdefault(h, offsets[th])
+        break
+      if th not in redirects:
+        break
+      target = redirects[th]
+
+  with open(prefix + '.idx.tmp', 'wb') as out:
+    out.write(HEADER.pack(MAGIC, len(entries)))
+    for h in sorted(entries):
+      offset, length = entries[h]
+      out.write(ENTRY.pack(h, offset, length))
+  os.replace(prefix + '.dat.tmp', prefix + '.dat')
+  os.replace(prefix + '.idx.tmp', prefix + '.idx')
+  return len(offsets), len(entries) - len(offsets)
+
+class WikiStore:
+  '''
+  mmapで開いたストア
+  64bitハッシュの衝突は起こらないものとみなしている (数百万タイトルで 1e-7 程度)
+  '''
+  def __init__(self, prefix=None):
+    prefix = prefix or STORE_PATH
+    with open(prefix + '.idx', 'rb') as f:
+      self._idx = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    with open(prefix + '.dat', 'rb') as f:
+      self._dat = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    magic, self.count = HEADER.unpack_from(self._idx, 0)
+    if magic != MAGIC:
+      raise ValueError('not a wiki store: {}'.format(prefix))
+
+  def _key_at(self, i):
+    return struct.unpack_from('<Q', self._idx, HEADER.size + i*ENTRY.size)[0]
+
+  def lookup(self, title):
+    '''
+    タイトル (リダイレクト可) から記事データを引く. ないとき None
+    '''
+    h = title_hash(title)
+    lo, hi = 0, self.count
+    while lo < hi:
+      mid = (lo + hi) // 2
+      if self._key_at(mid) < h:
+        lo = mid + 1
+      else:
+        hi = mid
+    if lo >= self.count:
+      return None
+    key, offset, length = ENTRY.unpack_from(self._idx, HEADER.size + lo*ENTRY.size)
+    if key != h:
+      return None
+    return json.loads(self._dat[offset:offset+length].decode('utf-8'))
+
+_store = None
+_store_lock = threading.Lock()
+
+def available(prefix=None):
+  '''
+  ストアがあるかどうか
+  '''
+  prefix = prefix or STORE_PATH
+  return os.path.exists(prefix + '.idx') and os.path.exists(prefix + '.dat')
+
+def get_store():
+  '''
+  プロセス内で共有するストア (初回に開く)
+  '''
+  global _store
+  if _store is None:
+    with _store_lock:
+      if _store is None:
+        _store = WikiStore()
+  return _store
+
+def lookup_data(keywords, store=None):
+  '''
+  キーワードをタイトルとしてストアを引き、wikipedia.parse_result と同じ形のデータを返す
+  '''
+  store = store or get_store()
+  ret = []
+  titles = set()
+  for k in keywords:
+    record = store.lookup(k)
+    if record is None or record['title'] in titles:
+      continue
+    titles.add(record['title'])
+    ret += [{
+      'hits': wikipedia.find_hits(keywords, record['title'], record['hints']),
+      'title': record['title'],
+      'categories': record['categories'],
+      'summary': record['summary'],
+      'url': wikipedia.make_url_of_title(record['title']),
+      'not_enough': record['not_enough'],
+    }]
+  return ret
+
+if __name__ == '__main__':
+  argparser = argparse.ArgumentParser(description='jawikiダンプのタイトル→概要ストア')
+  argparser.add_argument('command', choices=['build', 'lookup'])
+  argparser.add_argument('args', nargs='*', help='build: ダンプのパス, lookup: キーワード')
+  argparser.add_argument('--store', default=None, help='ストアのパス (拡張子なし)')
+  argparser.add_argument('--limit', type=int, default=None, help='取り込むページ数の上限 (試験用)')
+  args = argparser.parse_args()
+
+  if args.command == 'build':
+    n, r = build(args.args[0], prefix=args.store, limit=args.limit, debug=True)
+    print('articles: {}, redirects: {}'.format(n, r))
+  else:
+    for d in lookup_data(args.args, store=WikiStore(args.store)):
+      print(json.dumps(d, indent=2, ensure_ascii=False))
@@ -1,19 +1,48 @@
 import sys
+import io
 import argparse
-import re
 import json
 import os
-from urllib import request as req
-import random
-import xmltodict
 import urllib.parse
-import requests
+
+import http_client
+import cache
+import shared_cache
+import wikitext
+import xml_stream
+import metrics
+import singleflight
+
+# 抽出済みデータのキャッシュ
+_cache = cache.TTLCache(
+  maxsize=int(os.environ.get('REHATCH_CACHE_WIKI_SIZE', '512')),
+  ttl=float(os.environ.get('REHATCH_CACHE_WIKI_TTL', '3600')),
+  name='wiki')
+# ワーカー間の共有キャッシュ (古くなっても max_stale の間は返して裏で更新)
+_shared = shared_cache.make_shared_cache(
+  'wiki',
+  ttl=float(os.environ.get('REHATCH_SHARED_CACHE_WIKI_TTL', '3600')),
+  max_stale=float(os.environ.get('REHATCH_SHARED_CACHE_WIKI_MAX_STALE', '604800')))
+
+ROOT_URL = http_client.upstream('https://ja.wikipedia.org/w/api.php')
+
+# 同じURLへの同時の問い合わせを1つにまとめる
+_flight = singleflight.Group('wiki')
+
+# データ取得元
+# - 'api': wikipedia API で本文 (wikitext) を取得してパース
+# - 'extracts': wikipedia API で冒頭部分のプレーンテキストだけ取得 (JSON)
+# - 'dump': jawikiダンプから作ったストア (wiki_dump.py)
+BACKEND = os.environ.get('REHATCH_WIKI_BACKEND', 'api')
+
+# 記事が不十分なことを示すテンプレート
+NOT_ENOUGH_TEMPLATE = 'Template:出典の明記'
 
 def make_url(keywords, serch_type="question"):
   '''
   wikipediaに投げるクエリ作成
   '''
-  root_url = 'https://ja.wikipedia.org/w/api.php'
+  root_url = ROOT_URL
   
   query = ['format=xml',
            'utf8=',
@@ -27,12 +56,105 @@ def make_url(keywords, serch_type="question"):
   url = '{}?{}'.format(root_url, '&'.join(query))
   return url
 
-def db_access(query):
+def make_extracts_url(keywords):
+  '''
+  冒頭部分のプレーンテキスト, カテゴリー, 出典の明記テンプレートの有無だけを
+  JSONで返してもらうクエリ作成
+  '''
+  query = ['format=json',
+           'formatversion=2',
+           'utf8=',
+           'action=query',
+           'prop=extracts|categories|templates',
+           'exintro=',
+           'explaintext=',
+           'exlimit=max',
+           'cllimit=max',
+           'clshow=!hidden',
+           'tllimit=max',
+           'tltemplates='+urllib.parse.quote(NOT_ENOUGH_TEMPLATE),
+           'redirects=',
+           'titles='+urllib.parse.quote('|'.join(keywords)),
+           ]
+  return '{}?{}'.format(ROOT_URL, '&'.join(query))
+
+def db_access_extracts(query):
+  '''
+  wikipediaに冒頭部分だけのクエリ投げる
+  output: (ページのリスト, {転送先タイトル: [転送元タイトル, ...]})
+  '''
+  return _flight.do(singleflight.normalize_url(query),
+                    lambda: parse_extracts(http_client.get(query).json()))
+
+def parse_extracts(response):
+  '''
+  冒頭部分のクエリレスポンス (JSON) からページと転送元を取り出す
+  output: (ページのリスト, {転送先タイトル: [転送元タイトル, ...]})
+  '''
+  results = response.get('query', {})
+  redirects = {}
+  for r in results.get('redirects', []):
+    redirects.setdefault(r['to'], []).append(r['from'])
+  pages = [x for x in results.get('pages', []) if 'extract' in x]
+  return pages, redirects
+
+def parse_extract(keywords, page, redirects):
+  '''
+  冒頭部分のクエリレスポンスから parse_result と同じ形のデータを抽出
+  input:
+    - keywords: キーワードのリスト
+    - page: 検索結果のページ
+    - redirects: 転送先タイトルごとの転送元タイトル
+  '''
+  title = page['title']
+  text = page['extract']
+  # 転送元のタイトルを {{redirect|...}} の代わりのヒントにする
+  hits = find_hits(keywords, title, [redirects.get(title), None])
+  categories = [x['title'].split(':',1)[-1] for x in page.get('categories', [])]
+  summary = ' '.join(text.strip().split('\n',1)[0].split())
+  wiki_data = {
+    'hits': hits,
+    'title': title,
+    'categories': categories,
+    'summary': summary,
+    'url': make_url_of_title(title),
+    'not_enough': len(page.get('templates', []))>0,
+  }
+  return wiki_data
+
+def project_page(elem):
+  '''
+  <page> 要素から parse_result で使う項目 (タイトル, 本文) だけを、xmltodictと同じ形で取り出す
+  本文のないページは None
+  '''
+  revisions = xml_stream.find_child(elem, 'revisions')
+  rev = None if revisions is None else xml_stream.find_child(revisions, 'rev')
+  if rev is None:
+    return None
+  page = {'@title': elem.get('title'), 'revisions': {'rev': {}}}
+  text = xml_stream.text_of(rev)
+  if text is not None:
+    page['revisions']['rev']['#text'] = text
+  return page
+
+def parse_pages_stream(fp):
+  '''
+  レスポンスを受信しながらパース
+  '''
+  ret = []
+  for name, elem in xml_stream.iter_end(fp, ('page',), ('page',)):
+    page = project_page(elem)
+    if page is not None:
+      ret += [page]
+  return ret
+
+def parse_pages_dom(text):
   '''
-  レファレンス協同DBにクエリ投げる
+  レスポンス全体をxmltodictでパース
   '''
-  results = requests.get(query)
-  results = xmltodict.parse(results.text)
+  # xmltodict は読み込みに時間がかかるので、使うときに読み込む
+  import xmltodict
+  results = xmltodict.parse(text)
   # print(results)
   ret = results['api']['query']['pages']['page']
   # print(ret)
@@ -48,6 +170,72 @@ def db_access(query):
   
   return ret
 
+def db_access(query):
+  '''
+  wikipediaにクエリ投げる
+  同じURLの問い合わせが進行中なら、その結果を待って共有する
+  '''
+  return _flight.do(singleflight.normalize_url(query), _db_access, query)
+
+def _db_access(query):
+  if xml_stream.PARSER == 'stream':
+    with http_client.get(query, stream=True) as res:
+      return parse_pages_stream(xml_stream.open_stream(res))
+  results = http_client.get(query)
+  return parse_pages_dom(results.text)
+
+def get_redirect_hints(text):
+  '''
+  本文冒頭の {{redirect|...}} / {{Redirect|...}} から、転送元の名前を取り出す
+  output: [redirectの名前リスト, Redirectの名前リスト] (ないときは None)
+  '''
+  ret = []
+  for tag in ['{{redirect|', '{{Redirect|']:
+    if tag in text:
+      ret += [text.split(tag,1)[-1].split('}}',1)[0].split('|')]
+    else:
+      ret += [None]
+  return ret
+
+def find_hits(keywords, title, hints):
+  '''
+  ヒットしたキーワードの候補 (どれにするかは返答を作るときに選ぶ. message.choose_hits)
+  input:
+    - keywords: キーワードのリスト
+    - title: ページタイトル
+    - hints: get_redirect_hints の出力
+  '''
+  hits = [x for x in keywords if x in title]
+  for _ts in hints:
+    if len(hits)==0 and _ts is not None:
+      hits = [x for x in keywords if len([y for y in _ts if x in y])>0]
+  return hits
+
+def get_categories(text):
+  '''
+  本文からカテゴリーを抽出
+  '''
+  return [x.split(']]',1)[0].split('|',1)[0].strip() for x in text.split('[[Category:')[1:]]
+
+def make_summary(text):
+  '''
+  本文 (wikitext) から概要 (最初の段落) を抽出
+  入力長に比例する時間で処理する (wikitext.py)
+  '''
+  return wikitext.make_summary(text)
+
+def is_not_enough(text):
+  '''
+  記事が不十分 (出典の明記) かどうか
+  '''
+  return '{{出典の明記|' in text
+
+def make_url_of_title(title):
+  '''
+  記事のURL
+  '''
+  return f'https://ja.wikipedia.org/wiki/{title}'
+
 def parse_result(keywords, result):
   '''
   クエリレスポンスをパースしてほしいデータを抽出
@@ -67,97 +255,28 @@ def parse_result(keywords, result):
   # print(f'text:\n{text}')
   # print()
   
-  # ヒットしたキーワード
-  hits = [x for x in keywords if x in title]
-  hit = None if len(hits)==0 else random.choice(hits)
-  if hit is None and '{{redirect|' in text:
-    _ts = text.split('{{redirect|',1)[-1].split('}}',1)[0].split('|')
-    hits = [x for x in keywords if len([y for y in _ts if x in y])>0]
-    hit = None if len(hits)==0 else random.choice(hits)
-  if hit is None and '{{Redirect|' in text:
-    _ts = text.split('{{Redirect|',1)[-1].split('}}',1)[0].split('|')
-    hits = [x for x in keywords if len([y for y in _ts if x in y])>0]
-    hit = None if len(hits)==0 else random.choice(hits)
+  # ヒットしたキーワードの候補
+  hits = find_hits(keywords, title, get_redirect_hints(text))
   # print(f'hit: {hit}')
   # print()
   
   # カテゴリー
-  categories = [x.split(']]',1)[0].split('|',1)[0].strip() for x in text.split('[[Category:')[1:]]
+  categories = get_categories(text)
   # print(f'categories: {categories}')
   # print()
   
   # 概要
-  summary = text
-  # print(f'summary:\n{summary}\n===')
-  
-  # とりあえず一回短めに本文をとる
-  summary = '\n\n'.join(summary.strip().split('\n\n',5)[:-1])
-  # print(f'summary:\n{summary}\n===')
-  
-  # {{.*}} の除去
-  # print('remove {{}}')
-  while re.search(r'{{(?!.*{{).*?}}', summary):
-    summary = re.sub(r'{{(?!.*{{).*?}}', ' ', summary)
-  # summary = re.sub(r'{{Maplink(.|\s)*?}}', ' ', summary)
-  # summary = re.sub(r'{{ウィキ(.|\s)*?}}', ' ', summary)
-  summary = re.sub(r'{{(.|\s)*?}}', ' ', summary)
-  
-  # [[.*]] の処理
-  # _ms = re.search(r'\[\[(.|\s)*?\]\]', summary)
-  _ms = re.search(r'\[\[(?!.*(\[\[|:))(.|\s)*?\]\]', summary)
-  while _ms:
-    _span = _ms.span()
-    _m = summary[_span[0]:_span[1]]
-    # print(_m)
-    _r = _m.split('[[',1)[-1].split(']]',1)[0].split('|',1)[-1]
-    # print(_r)
-    summary = summary.replace(_m, _r)
-    # print(summary)
-    # _ms = re.search(r'\[\[(.|\s)*?\]\]', summary)
-    _ms = re.search(r'\[\[(?!.*(\[\[|:))(.|\s)*?\]\]', summary)
-  # print(f'summary:\n{summary}\n===')
-  
-  # [[.*:.*]] の除去
-  # print('remove [[:]]')
-  summary = re.sub(r'\[\[.*:(.|\s)*?\]\]', ' ', summary)
-  # summary = re.sub(r'\[\[画像(.|\s)*?\]\]', ' ', summary)
-  # print(f'summary:\n{summary}\n===')
-  
-  # <ref>.*</ref> の除去
-  # print('remove <ref>')
-  # summary = re.sub('<ref(.|\s)*?</ref>', ' ', summary)
-  summary = re.sub(r'<ref>(.|\s)*?</ref>', ' ', summary)
-  # summary = re.sub(r'<ref (.|\s)*?</ref>', ' ', summary)
-  # print(f'summary:\n{summary}\n===')
-  
-  # <!--.*--> の除去
-  # print('remove <!-- -->')
-  summary = re.sub(r'<!--.*?-->', ' ', summary)
-  # print(f'summary:\n{summary}\n===')
-  
-  # ''' の除去
-  # print('remove \'\'\'')
-  summary = summary.replace('\'\'\'', '')
-  
-  summary = summary.strip().split('\n\n',1)[0]
-  # summary = summary.replace('\n', ' ')
-  # print(f'summary:\n{summary}\n===')
-  
-  summary = re.sub(r'\s+', ' ', summary).strip()
-  # print(f'summary:\n{summary}\n===')
+  summary = make_summary(text)
   
   # 記事のURL
-  wurl = f'https://ja.wikipedia.org/wiki/{title}'
+  wurl = make_url_of_title(title)
   
   # 記事の不十分さ
-  wiki_not_enough = False
-  if '{{出典の明記|' in text:
-    wiki_not_enough = True
+  wiki_not_enough = is_not_enough(text)
   
   wiki_data = {
-    'hit': hit,
+    'hits': hits,
     'title': title,
-    'text': text,
     'categories': categories,
     'summary': summary,
     'url': wurl,
@@ -167,7 +286,59 @@ def parse_result(keywords, result):
 
 def access_db_to_data(keywords, debug=False):
   '''
-  入力から返答を作成
+  入力から返答を作成 (キャッシュつき)
+  input:
+    - keywords: キーワードリスト (unicode)
+    - debug: 中間結果を表示するかどうか (bool)
+  output: wikipediaページデータ (dict) のリスト
+  '''
+  return cache.cached_data(_cache, keywords, load_data, debug=debug, shared=_shared)
+
+async def access_db_to_data_async(keywords, debug=False):
+  '''
+  access_db_to_data の非同期版 (app_async.py 用)
+  '''
+  return await cache.cached_data_async(
+    _cache, keywords, load_data_async, load_data, debug=debug, shared=_shared)
+
+async def load_data_async(keywords, debug=False):
+  '''
+  load_data の非同期版 (APIに問い合わせている間はほかの会話を処理できる)
+  ダンプから作ったストアを使うときは、同期版をスレッドで呼ぶ
+  '''
+  import http_client_async
+  if BACKEND == 'dump':
+    import asyncio
+    return await asyncio.to_thread(load_data, keywords, debug)
+  
+  if BACKEND == 'extracts':
+    url = make_extracts_url(keywords)
+    body = await _flight.do_async(singleflight.normalize_url(url), lambda: http_client_async.get(url))
+    pages, redirects = parse_extracts(json.loads(body))
+    with metrics.span('parse_result', source='wiki'):
+      return [parse_extract(keywords, x, redirects) for x in pages]
+  
+  url = make_url(keywords)
+  body = await _flight.do_async(singleflight.normalize_url(url), lambda: http_client_async.get(url))
+  if xml_stream.PARSER == 'stream':
+    results = parse_pages_stream(io.BytesIO(body))
+  else:
+    results = parse_pages_dom(body.decode('utf-8'))
+  with metrics.span('parse_result', source='wiki'):
+    return [parse_result(keywords, x) for x in results]
+
+def cache_stats():
+  '''
+  キャッシュのヒット/ミス/追い出し回数
+  '''
+  return {
+    'local': _cache.stats(),
+    'shared': None if _shared is None else _shared.stats(),
+  }
+
+def load_data(keywords, debug=False):
+  '''
+  DBに問い合わせて、入力から返答を作成
   input:
     - keywords: キーワードリスト (unicode)
     - debug: 中間結果を表示するかどうか (bool)
@@ -179,6 +350,35 @@ def access_db_to_data(keywords, debug=False):
     print('keywords: {}'.format(keywords))
     print()
   
+  # ダンプから作ったストアがあれば、通信もwikitextのパースもせずに引く
+  if BACKEND == 'dump':
+    import wiki_dump
+    if wiki_dump.available():
+      wiki_data = wiki_dump.lookup_data(keywords)
+      if debug:
+        print('wiki_data:')
+        for _d in wiki_data:
+          print(json.dumps(_d, indent=2, ensure_ascii=False))
+      return wiki_data
+    if debug:
+      print('wiki store not found: {}'.format(wiki_dump.STORE_PATH))
+      print()
+  
+  # 冒頭部分だけを取得
+  if BACKEND == 'extracts':
+    url = make_extracts_url(keywords)
+    if debug:
+      print('url: {}'.format(url))
+      print()
+    pages, redirects = db_access_extracts(url)
+    with metrics.span('parse_result', source='wiki'):
+      wiki_data = [parse_extract(keywords, x, redirects) for x in pages]
+    if debug:
+      print('wiki_data:')
+      for _d in wiki_data:
+        print(json.dumps(_d, indent=2, ensure_ascii=False))
+    return wiki_data
+  
   # DBのクエリ文 (URL) を作成
   url = make_url(keywords)
   if debug:
@@ -193,7 +393,8 @@ def access_db_to_data(keywords, debug=False):
     print()
   
   # wikipediaページデータ抽出結果
-  wiki_data = [parse_result(keywords, x) for x in results]
+  with metrics.span('parse_result', source='wiki'):
+    wiki_data = [parse_result(keywords, x) for x in results]
   if debug:
     print('wiki_data:')
     for _d in wiki_data:
@@ -0,0 +1,390 @@
+'''
+wikitext → 概要 の線形時間クリーナー
+
+以前の正規表現による実装 (テンプレートと内部リンクを1つずつ re.search し直すループ) と
+同じ結果になるように、各段階を str.find と行ごとの走査だけで処理する
+バックトラックする正規表現を使わないので、処理時間は入力長にほぼ比例する
+
+段階 (以前の実装の順番どおり):
+  1. 同じ行の中で閉じている {{...}} を内側から除去
+  2. 残った {{ から次の }} まで (行をまたいでもよい) を除去
+  3. 内部リンク [[...]] を表示文字列に置き換え
+     (その行の後ろに [[ や : が残っているリンクは置き換えない)
+     行をまたぐリンクが入り組んでいて処理量が LINK_BUDGET を超えたら、そこから後ろは捨てる
+  4. 残った [[...:...]] を除去
+  5. <ref>...</ref>, <!--...--> を除去
+'''
+
+import bisect
+
+# 1記事あたりの処理量の上限 (文字数). 概要は先頭の数段落しか見ないので十分
+MAX_SOURCE_CHARS = 100000
+# 段階3で処理してよい文字数 (入力長の何倍か). 行をまたぐリンクが入り組んだ入力でも時間を抑える
+LINK_BUDGET = 8
+
+def _lines(s):
+  '''
+  各行の (開始位置, 終了位置)
+  '''
+  ret = []
+  start = 0
+  while True:
+    end = s.find('\n', start)
+    if end < 0:
+      ret += [(start, len(s))]
+      return ret
+    ret += [(start, end)]
+    start = end + 1
+
+def _brace_run_opens(start, length):
+  '''
+  { が length 個続くときの {{ の開始位置 (左から順)
+  '''
+  ret = []
+  while length >= 3:
+    ret += [start + length - 3]
+    length -= 3
+  if length == 2:
+    ret += [start]
+  return ret[::-1]
+
+def remove_inline_templates(s):
+  '''
+  段階1: 行の中で閉じている {{...}} を除去して ' ' にする
+  行の右から順に対応をとり、閉じていない {{ が見つかったらその行はそこで打ち切る
+  '''
+  out = []
+  for start, end in _lines(s):
+    line = s[start:end]
+    if '{{' not in line:
+      out += [line]
+      continue
+    # 左から {{ / }} を拾って対応をとる
+    stack = []
+    pairs = []
+    i = 0
+    n = len(line)
+    while i < n - 1:
+      c = line[i]
+      if c == '{':
+        # { の連続は右から '{{' + '{' の組で区切る (以前の実装が右端から探していたのに合わせる)
+        k = i
+        while k < n and line[k] == '{':
+          k += 1
+        stack += _brace_run_opens(i, k - i)
+        i = k
+      elif c == '}' and line[i+1] == '}':
+        if len(stack) > 0:
+          pairs += [(stack.pop(), i + 2)]
+        i += 2
+      else:
+        i += 1
+    # 閉じていない一番右の {{ より右だけが除去対象
+    limit = stack[-1] if len(stack) > 0 else -1
+    spans = sorted(p for p in pairs if p[0] > limit)
+    buf = []
+    pos = 0
+    last_end = -1
+    for a, b in spans:
+      if a < last_end:
+        continue # 外側のテンプレートに含まれる
+      buf += [line[pos:a], ' ']
+      pos = b
+      last_end = b
+    buf += [line[pos:]]
+    out += [''.join(buf)]
+  return '\n'.join(out)
+
+def remove_between(s, left, right, repl=' '):
+  '''
+  left から最初の right までを repl にする (行をまたいでもよい)
+  '''
+  out = []
+  pos = 0
+  while True:
+    i = s.find(left, pos)
+    if i < 0:
+      break
+    j = s.find(right, i + len(left))
+    if j < 0:
+      break
+    out += [s[pos:i], repl]
+    pos = j + len(right)
+  out += [s[pos:]]
+  return ''.join(out)
+
+def remove_comments(s):
+  '''
+  段階5: 同じ行の中で閉じている <!--...--> を除去
+  '''
+  out = []
+  pos = 0
+  i = s.find('<!--')
+  while i >= 0:
+    line_end = s.find('\n', i)
+    if line_end < 0:
+      line_end = len(s)
+    j = s.find('-->', i + 4, line_end)
+    if j < 0:
+      # この行の残りの <!-- も閉じないので次の行へ
+      i = s.find('<!--', line_end)
+      continue
+    out += [s[pos:i], ' ']
+    pos = j + 3
+    i = s.find('<!--', pos)
+  out += [s[pos:]]
+  return ''.join(out)
+
+def _link_label(m):
+  '''
+  [[リンク先|表示]] の表示文字列
+  '''
+  return m.split('[[',1)[-1].split(']]',1)[0].split('|',1)[-1]
+
+class _Resolved(dict):
+  '''
+  置き換えたリンク {元: (順番, 表示)}
+  lengths: キーの長さ (長さの合わないところで文字列を切り出さないように)
+  '''
+  def __init__(self):
+    super().__init__()
+    self.lengths = set()
+
+  def add(self, m):
+    '''
+    output: 表示文字列
+    '''
+    if m not in self:
+      self[m] = (len(self), _link_label(m))
+      self.lengths.add(len(m))
+    return self[m][1]
+
+def _replaced_first(resolved, inner, outer):
+  '''
+  [[[ で始まるリンクで、内側 ([[ から) のほうを先に置き換えるべきか
+  以前の実装は置き換えたリンクを文字列全体で一度に置き換えていたので、先に置き換えたほうが残る
+  '''
+  if inner not in resolved:
+    return False
+  return outer not in resolved or resolved[inner][0] < resolved[outer][0]
+
+def _join_parts(parts):
+  '''
+  後ろから順に並べた断片 [(文字列, 開始位置, 終了位置)] をつなげる
+  '''
+  return ''.join(s[a:b] for s, a, b in reversed(parts))
+
+def _take_close(parts):
+  '''
+  後ろから順に並べた断片の先頭から、最初の ]] (断片のつなぎ目にできたものも含む) までを取り出す
+  output: (見つかったか, 取り出した文字列). 見つからなければすべて取り出す
+  '''
+  taken = ''
+  while len(parts) > 0:
+    s, start, end = parts.pop()
+    if taken[-1:] == ']' and s[start] == ']':
+      c = start - 1
+    else:
+      c = s.find(']]', start, end)
+      if c < 0:
+        taken += s[start:end]
+        continue
+    if c + 2 < end:
+      parts += [(s, c + 2, end)]
+    return True, taken + s[start:c+2]
+  return False, taken
+
+def _resolve_line(line, resolved, budget):
+  '''
+  1行分のリンクを右から置き換える. 置き換えたリンクは resolved {元: (順番, 表示)} に加える
+  まだ処理していない部分 line[:h] と、その右に続く処理済みの断片 (tail) に分けて持ち、
+  文字列を作り直さずに進める. 作り直した文字数が budget を超えたらそこで打ち切る
+  output: (置き換え後の行, 行内で閉じないリンクの開始位置 or None, 作り直した文字数)
+  '''
+  h = len(line)
+  tail = []
+  work = 0
+  while True:
+    r = line.rfind('[[', 0, h)
+    if r < 0:
+      break
+    j = r - 1 if r > 0 and line[r-1] == '[' else r
+    # 後ろに : があるリンクは置き換えない (段階4で除去される)
+    # (tail は置き換えた表示文字列と、: のない区間だけからなる)
+    if line.find(':', j + 2, h) >= 0:
+      break
+    tail += [(line, j + 2, h)]
+    closed, taken = _take_close(tail)
+    if not closed:
+      # 次の行以降で閉じている (か、閉じていない)
+      return line[:j+2] + taken, j, work
+    m = line[j:j+2] + taken
+    if j < r and line.find(']]', r + 2, h) >= 0 and _replaced_first(resolved, m[1:], m):
+      j, m = r, m[1:]
+    label = resolved.add(m)
+    h = j
+    first = tail[-1][0][tail[-1][1]] if len(tail) > 0 else ''
+    if '[[' in line[h-1:h] + label + first:
+      # 置き換えた結果で新しく [[ ができたときは、つなげて続きを処理
+      line = line[:h] + label + _join_parts(tail)
+      work += len(line)
+      if work > budget:
+        return line, None, work
+      h = len(line)
+      tail = []
+    elif len(label) > 0:
+      tail += [(label, 0, len(label))]
+  return line[:h] + _join_parts(tail), None, work
+
+def replace_resolved(lines, resolved):
+  '''
+  置き換え済みのリンク [[...]] (resolved のキー) を表示文字列にする
+  input: lines: [(行, その行にまだ置き換えていないリンクの順番の最小値)]
+    (以前の実装と同じく、1つのリンクを同じ位置で二度置き換えないように)
+  output: 改行でつなげた文字列
+  '''
+  s = '\n'.join(line for line, _ in lines)
+  if len(resolved) == 0 or '[[' not in s:
+    return s
+  starts = []
+  pos = 0
+  for line, _ in lines:
+    starts += [pos]
+    pos += len(line) + 1
+  buf = []
+  pos = 0
+  c = -1
+  i = s.find('[[')
+  while i >= 0:
+    if c < i + 2:
+      # ]] の位置は i とともに進むだけなので、追い越したときだけ探し直す
+      c = s.find(']]', i + 2)
+      if c < 0:
+        break
+    m = s[i:c+2] if c + 2 - i in resolved.lengths else None
+    if m in resolved and resolved[m][0] >= min(
+        lines[bisect.bisect_right(starts, i) - 1][1], lines[bisect.bisect_right(starts, c) - 1][1]):
+      buf += [s[pos:i], resolved[m][1]]
+      pos = c + 2
+      i = s.find('[[', pos)
+    else:
+      i = s.find('[[', i + 1)
+  buf += [s[pos:]]
+  return ''.join(buf)
+
+def resolve_links(s):
+  '''
+  段階3: 内部リンクを表示文字列に置き換える
+  行を先頭から1回ずつ処理する. 行をまたぐリンクは、次の行以降の最初の ]] までだけを取り出して
+  (それまでに置き換えたリンクを置き換えてから) 1つのリンクとして置き換え、その行からやり直す
+  同じ文字列のリンクは (置き換えられない位置にあっても) すべて置き換える
+  処理した文字数が LINK_BUDGET * 入力長 を超えたら、そこまでで打ち切る
+  '''
+  # 未処理の行 (末尾が次に処理する行). (行, その行にまだ置き換えていないリンクの順番の最小値)
+  todo = [(line, 0) for line in s.split('\n')[::-1]]
+  out = []
+  resolved = _Resolved()
+  budget = LINK_BUDGET * (len(s) + 1)
+  while len(todo) > 0:
+    line, since = todo.pop()
+    budget -= len(line) + 1
+    if budget >= 0:
+      line, j, work = _resolve_line(line, resolved, budget)
+      budget -= work
+    if budget < 0:
+      # 入力が異常に入り組んでいる. この行から後ろは捨てる (概要は先頭の段落しか使わない)
+      break
+    if j is None:
+      out += [(line, since)]
+      continue
+    # 次の行以降の最初の ]] までを1つのリンクとして置き換える
+    chunk = []
+    later = ''
+    c = -1
+    while c < 0 and len(todo) > 0:
+      chunk += [todo.pop()]
+      if ']]' not in chunk[-1][0]:
+        continue
+      later = replace_resolved(chunk, resolved)
+      budget -= len(later)
+      c = later.find(']]')
+      chunk = [(later, len(resolved))]
+    if c < 0:
+      # 残りの行にも ]] がないので、これ以上置き換えるリンクはない
+      out += [(line, since)]
+      out += [(x, _since) for text, _since in chunk for x in text.split('\n')]
+      break
+    m = line[j:] + '\n' + later[:c+2]
+    if line[j+1] == '[' and _replaced_first(resolved, m[1:], m):
+      j, m = j + 1, m[1:]
+    label = resolved.add(m)
+    rest = (label + later[c+2:].replace(m, label)).split('\n')
+    todo += [(x, len(resolved)) for x in rest[:0:-1]]
+    todo += [(line[:j] + rest[0], since)]
+
+  # 置き換えられなかった位置に残っている同じリンクも置き換える
+  return replace_resolved(out, resolved)
+
+def remove_colon_links(s):
+  '''
+  段階4: [[ から同じ行の : をへて、最初の ]] までを除去
+  : はその行で一番右のもの (後ろに ]] があるもの) をとる
+  '''
+  last_close = s.rfind(']]')
+  if last_close < 0:
+    return s
+  colons = []
+  k = s.find(':')
+  while k >= 0:
+    colons += [k]
+    k = s.find(':', k + 1)
+  if len(colons) == 0:
+    return s
+  out = []
+  pos = 0
+  i = s.find('[[')
+  while i >= 0:
+    line_end = s.find('\n', i)
+    if line_end < 0:
+      line_end = len(s)
+    limit = min(line_end, last_close)
+    k = bisect.bisect_left(colons, limit) - 1
+    if k < 0 or colons[k] < i + 2:
+      i = s.find('[[', i + 1)
+      continue
+    e = s.find(']]', colons[k] + 1)
+    out += [s[pos:i], ' ']
+    pos = e + 2
+    i = s.find('[[', pos)
+  out += [s[pos:]]
+  return ''.join(out)
+
+def make_summary(text):
+  '''
+  本文 (wikitext) から概要 (最初の段落) を抽出
+  '''
+  # とりあえず一回短めに本文をとる
+  summary = '\n\n'.join(text[:MAX_SOURCE_CHARS].strip().split('\n\n',5)[:-1])
+
+  # {{.*}} の除去
+  summary = remove_inline_templates(summary)
+  summary = remove_between(summary, '{{', '}}')
+
+  # [[.*]] の処理
+  summary = resolve_links(summary)
+
+  # [[.*:.*]] の除去
+  summary = remove_colon_links(summary)
+
+  # <ref>.*</ref> の除去
+  summary = remove_between(summary, '<ref>', '</ref>')
+
+  # <!--.*--> の除去
+  summary = remove_comments(summary)
+
+  # ''' の除去
+  summary = summary.replace('\'\'\'', '')
+
+  summary = summary.strip().split('\n\n',1)[0]
+  summary = ' '.join(summary.split())
+  return summary
@@ -0,0 +1,57 @@
+'''
+APIレスポンスのXMLを、受信しながら少しずつパースするための共通処理
+必要な要素だけを取り出して、読み終わった要素は捨てる (メモリを一定に保つ)
+'''
+
+import os
+import xml.etree.ElementTree as ET
+
+# 'stream': 受信しながら必要な項目だけパース, 'dom': xmltodictで全体をパース
+PARSER = os.environ.get('REHATCH_XML_PARSER', 'stream')
+
+def local_name(tag):
+  '''
+  名前空間をのぞいたタグ名
+  '''
+  return tag.rsplit('}', 1)[-1]
+
+def iter_end(fp, tags, records):
+  '''
+  fp を少しずつ読んで、tags の要素が閉じるたびに (タグ名, 要素) を返す
+  records の要素は返したあとに捨てる
+  '''
+  stack = []
+  for event, elem in ET.iterparse(fp, events=('start', 'end')):
+    if event == 'start':
+      stack += [elem]
+      continue
+    stack.pop()
+    name = local_name(elem.tag)
+    if name in tags:
+      yield name, elem
+      if name in records and len(stack) > 0:
+        stack[-1].remove(elem)
+
+def text_of(elem):
+  '''
+  xmltodictと同じく、前後の空白を除いたテキスト (空のときは None)
+  '''
+  if elem is None or elem.text is None:
+    return None
+  return elem.text.strip() or None
+
+def find_child(elem, name):
+  '''
+  名前空間をのぞいたタグ名で子要素を探す
+  '''
+  for child in elem:
+    if local_name(child.tag) == name:
+      return child
+  return None
+
+def open_stream(res):
+  '''
+  requestsのレスポンスから、(gzipなどを展開した) 生のバイト列ストリームを取り出す
+  '''
+  res.raw.decode_content = True
+  return res.raw